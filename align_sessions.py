@@ -0,0 +1,253 @@
+import argparse
+import csv
+import locale
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from clock_sync import load_samples as load_clock_sync
+from frame_index import FrameIndex, FRAME_INDEX_EXTENSION
+from oximeter_storage import open_binary_recording, BINARY_EXTENSION
+from video_segments import segment_index_path, read_segment_index
+
+'''
+离线批量对齐：把主机的视频会话(experiment_data/<会话>)与从机的生理数据
+(oximeter_data/<会话>)对齐为逐帧标签。
+- 帧时间优先使用帧索引(.fidx)，没有时逐帧读取视频计数，按视频开始时间和帧率推算
+- 从机时间按主机记录的时钟同步结果(clock_sync.csv)换算为主机时间，
+  没有同步结果时退回到从机记录的开始时间偏差
+- PPG线性插值，HR/SPO2取该帧之前最近一次的读数，全部使用numpy向量化计算
+- 多个会话用进程池并行处理，每个会话完成后写入align_info.txt，再次运行时跳过已完成的会话
+'''
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.wmv')
+SEGMENT_PATTERN = re.compile(r'_seg\d{4}$')
+LABEL_HEADER = ['帧号', '主机时间戳', 'PPG', 'HR', 'SPO2', '有效']
+DONE_FILE = "align_info.txt"
+
+
+def read_sync_lines(path):
+    """读取sync_info.txt的各行：现在以UTF-8写入，旧文件以系统默认编码(如cp936)写入"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        text = data.decode(locale.getpreferredencoding(False), errors='replace')
+    return text.splitlines()
+
+
+def read_sync_info(path):
+    """读取sync_info.txt中"键: 值"格式的行"""
+    info = {}
+    if not os.path.exists(path):
+        return info
+    for line in read_sync_lines(path):
+        key, sep, value = line.partition(': ')
+        if sep:
+            info[key] = value
+    return info
+
+
+def find_videos(session_dir):
+    """返回会话中的视频 [(名称, 视频路径或None, 帧索引路径或None)]，分段视频按整体处理"""
+    videos = {}
+    for name in sorted(os.listdir(session_dir)):
+        base, ext = os.path.splitext(name)
+        path = os.path.join(session_dir, name)
+        if ext == FRAME_INDEX_EXTENSION:
+            videos.setdefault(base, [None, None])[1] = path
+        elif ext.lower() in VIDEO_EXTENSIONS and not SEGMENT_PATTERN.search(base):
+            videos.setdefault(base, [None, None])[0] = path
+    return [(base, video, index) for base, (video, index) in sorted(videos.items())]
+
+
+def video_files(video_path, index_path):
+    """返回按顺序组成该视频的文件，分段录制时为分段索引中的各分段"""
+    if video_path:
+        return [video_path]
+    base = os.path.splitext(index_path)[0]
+    segments_path = segment_index_path(base + ".mp4")
+    if not os.path.exists(segments_path):
+        return []
+    directory = os.path.dirname(index_path)
+    return [os.path.join(directory, segment['filename']) for segment in read_segment_index(segments_path)]
+
+
+def find_oximeter_files(oximeter_dirs, session_id):
+    """在从机数据目录中查找该会话的生理数据文件(主机在PREPARE命令中指定的文件名)"""
+    prefix = f"oxygen_data_{session_id}"
+    files = []
+    for root_dir in oximeter_dirs:
+        for directory, _, names in os.walk(root_dir):
+            for name in sorted(names):
+                # 跳过信号质量分析结果文件(*_quality.csv)
+                if name.endswith("_quality.csv"):
+                    continue
+                if name.startswith(prefix) and name.endswith(('.csv', BINARY_EXTENSION)):
+                    files.append(os.path.join(directory, name))
+    return files
+
+
+def stream_frame_count(video_path):
+    """逐帧读取(不解码)统计视频帧数"""
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        count = 0
+        while cap.grab():
+            count += 1
+    finally:
+        cap.release()
+    return count, fps
+
+
+def load_frame_times(video_path, index_path, sync_info):
+    """返回每帧的主机时间戳"""
+    if index_path:
+        return np.array(FrameIndex(index_path).times('wall'))
+    count, fps = stream_frame_count(video_path)
+    if fps <= 0:
+        raise ValueError(f"无法获取视频帧率: {video_path}")
+    start_time = float(sync_info['视频开始时间戳'])
+    return start_time + np.arange(count) / fps
+
+
+def load_oximeter_samples(path):
+    """返回(从机时间戳, PPG, HR, SPO2)数组"""
+    if path.endswith(BINARY_EXTENSION):
+        _, records = open_binary_recording(path)
+        return (np.array(records['timestamp']), np.array(records['ppg'], dtype=np.float64),
+                np.array(records['hr']), np.array(records['spo2']))
+    data = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(1, 4, 5, 6), ndmin=2)
+    return data[:, 0], data[:, 1], data[:, 2].astype(np.int64), data[:, 3].astype(np.int64)
+
+
+def slave_to_master_time(times, slave_info, estimators):
+    """把从机时间换算为主机时间，返回(主机时间, 使用的方法)"""
+    address = slave_info.get('本机地址')
+    if address in estimators and estimators[address].estimate():
+        return estimators[address].to_master_time(times), f"时钟同步({address})"
+    if len(estimators) == 1:
+        address, estimator = next(iter(estimators.items()))
+        if estimator.estimate():
+            return estimator.to_master_time(times), f"时钟同步({address})"
+    return times - float(slave_info.get('时间偏差', 0.0)), "开始时间偏差"
+
+
+def align_frames(frame_times, sample_times, ppg, hr, spo2, max_gap=0.1):
+    """
+    向量化对齐: PPG线性插值，HR/SPO2取帧时间之前最近的样本
+    帧时间超出采样范围或前后样本间隔超过max_gap(如丢数据)时标记为无效
+    """
+    order = np.argsort(sample_times, kind='stable')
+    sample_times, ppg, hr, spo2 = sample_times[order], ppg[order], hr[order], spo2[order]
+
+    frame_ppg = np.interp(frame_times, sample_times, ppg)
+    before = np.searchsorted(sample_times, frame_times, side='right') - 1
+    held = np.clip(before, 0, len(sample_times) - 1)
+    after = np.minimum(before + 1, len(sample_times) - 1)
+    gap = sample_times[after] - sample_times[held]
+    valid = (before >= 0) & (before < len(sample_times) - 1) & (gap <= max_gap)
+    return frame_ppg, hr[held], spo2[held], valid
+
+
+def write_labels(path, frame_times, ppg, hr, spo2, valid):
+    """写入逐帧标签，先写临时文件再替换，避免中断时留下不完整的文件"""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LABEL_HEADER)
+        writer.writerows(zip(range(len(frame_times)), frame_times.tolist(), np.round(ppg, 3).tolist(),
+                             hr.tolist(), spo2.tolist(), valid.astype(np.int8).tolist()))
+    os.replace(temp_path, path)
+
+
+def align_session(session_dir, oximeter_dirs, output_dir, max_gap=0.1):
+    """对齐一个会话，返回摘要文本行"""
+    session_id = os.path.basename(os.path.normpath(session_dir))
+    sync_info = read_sync_info(os.path.join(session_dir, "sync_info.txt"))
+    clock_sync_path = os.path.join(session_dir, "clock_sync.csv")
+    estimators = load_clock_sync(clock_sync_path) if os.path.exists(clock_sync_path) else {}
+
+    videos = find_videos(session_dir)
+    oximeter_files = find_oximeter_files(oximeter_dirs, session_id)
+    if not videos:
+        raise ValueError(f"会话 {session_id} 中没有视频")
+    if not oximeter_files:
+        raise ValueError(f"未找到会话 {session_id} 的生理数据")
+
+    session_output = os.path.join(output_dir, session_id)
+    os.makedirs(session_output, exist_ok=True)
+    frame_times = {base: load_frame_times(video, index, sync_info) for base, video, index in videos}
+
+    lines = [f"会话: {session_id}"]
+    for oximeter_path in oximeter_files:
+        slave_info = read_sync_info(os.path.join(os.path.dirname(oximeter_path), "sync_info.txt"))
+        times, ppg, hr, spo2 = load_oximeter_samples(oximeter_path)
+        if len(times) < 2:
+            lines.append(f"{os.path.basename(oximeter_path)}: 样本不足，跳过")
+            continue
+        master_times, method = slave_to_master_time(times, slave_info, estimators)
+        oximeter_base = os.path.splitext(os.path.basename(oximeter_path))[0]
+
+        for base, times_of_frames in frame_times.items():
+            frame_ppg, frame_hr, frame_spo2, valid = align_frames(
+                times_of_frames, master_times, ppg, hr, spo2, max_gap)
+            label_name = f"{base}__{oximeter_base}.csv"
+            write_labels(os.path.join(session_output, label_name),
+                         times_of_frames, frame_ppg, frame_hr, frame_spo2, valid)
+            lines.append(f"{label_name}: {len(times_of_frames)} 帧, 有效 {int(valid.sum())} 帧, 对齐方式 {method}")
+
+    # 最后写入完成标记
+    with open(os.path.join(session_output, DONE_FILE), 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return lines
+
+
+def find_sessions(experiment_dir):
+    """返回包含sync_info.txt的主机会话目录"""
+    sessions = []
+    for name in sorted(os.listdir(experiment_dir)):
+        path = os.path.join(experiment_dir, name)
+        if os.path.isfile(os.path.join(path, "sync_info.txt")):
+            sessions.append(path)
+    return sessions
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='批量对齐视频帧与生理数据')
+    parser.add_argument('experiment_dir', help='主机数据目录(experiment_data)')
+    parser.add_argument('oximeter_dirs', nargs='+', help='从机数据目录(oximeter_data)，可以有多个')
+    parser.add_argument('--output', type=str, default='aligned_data', help='输出目录')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='并行处理的进程数')
+    parser.add_argument('--max-gap', type=float, default=0.1,
+                        help='前后样本间隔超过该值(秒)的帧标记为无效')
+    parser.add_argument('--force', action='store_true', help='重新处理已完成的会话')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    sessions = find_sessions(args.experiment_dir)
+    pending = [session for session in sessions if args.force or not os.path.exists(
+        os.path.join(args.output, os.path.basename(session), DONE_FILE))]
+    print(f"共 {len(sessions)} 个会话，待处理 {len(pending)} 个")
+
+    start = time.time()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(align_session, session, args.oximeter_dirs, args.output, args.max_gap): session
+                   for session in pending}
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                print("\n".join(future.result()))
+            except Exception as e:
+                failed += 1
+                print(f"会话 {os.path.basename(session)} 对齐失败: {str(e)}")
+    print(f"完成 {len(pending) - failed} 个会话，失败 {failed} 个，用时 {time.time() - start:.1f}秒")
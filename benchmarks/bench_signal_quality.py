@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cms50e_decoder import NOMINAL_SAMPLE_RATE, SAMPLES_PER_REPORT
+from oximeter_devices import SyntheticDevice
+from signal_quality import SignalAnalyzer, AnalysisWorker
+
+'''
+在线信号分析的CPU开销测试。
+- 分析: 每个设备一个SignalAnalyzer，逐批处理合成PPG，统计每个样本的CPU时间和实时采集时单核占用
+- 提交: 采集线程调用AnalysisWorker.submit()的耗时，即分析对HID读取循环增加的延迟
+'''
+
+
+def synthetic_ppg(seconds, heart_rate, seed):
+    """生成合成PPG样本(时间戳, PPG)"""
+    device = SyntheticDevice(heart_rate=heart_rate, seed=seed)
+    count = int(seconds * NOMINAL_SAMPLE_RATE)
+    timestamps = np.arange(count) / NOMINAL_SAMPLE_RATE
+    ppg = np.array([device._ppg_value(t) for t in timestamps], dtype=np.int64)
+    return timestamps, ppg
+
+
+def bench_analyzer(devices, seconds, batch_size):
+    """逐批处理每个设备的数据，返回每个样本的平均CPU时间(秒)"""
+    data = [synthetic_ppg(seconds, 60 + 7 * n, n) for n in range(devices)]
+    analyzers = [SignalAnalyzer() for _ in range(devices)]
+    samples = 0
+    start = time.process_time()
+    for begin in range(0, len(data[0][0]), batch_size):
+        for analyzer, (timestamps, ppg) in zip(analyzers, data):
+            rows = analyzer.process(begin, timestamps[begin:begin + batch_size].tolist(),
+                                    ppg[begin:begin + batch_size].tolist())
+            samples += len(rows)
+    return (time.process_time() - start) / samples
+
+
+def bench_submit(seconds, batch_size):
+    """采集线程提交一批样本的耗时(秒)，返回(中位数, 最大值, 分析线程统计)"""
+    timestamps, ppg = synthetic_ppg(seconds, 72, 0)
+    worker = AnalysisWorker(SignalAnalyzer())
+    costs = []
+    for begin in range(0, len(timestamps), batch_size):
+        batch_times, batch_ppg = timestamps[begin:begin + batch_size], ppg[begin:begin + batch_size]
+        start = time.perf_counter()
+        worker.submit(begin, batch_times, batch_ppg)
+        costs.append(time.perf_counter() - start)
+        # 按实时速率的十分之一间隔提交，模拟HID读取节奏
+        time.sleep(batch_size / NOMINAL_SAMPLE_RATE / 10)
+    stats = worker.stop()
+    return float(np.median(costs)), float(np.max(costs)), stats
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='在线信号分析CPU开销测试')
+    parser.add_argument('--devices', type=int, default=4, help='设备数')
+    parser.add_argument('--seconds', type=float, default=300, help='每个设备的数据时长(秒)')
+    parser.add_argument('--batch-reports', type=int, default=4, help='每批报告数(与采集程序的解码批量一致)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    batch_size = args.batch_reports * SAMPLES_PER_REPORT
+
+    per_sample = bench_analyzer(args.devices, args.seconds, batch_size)
+    print(f"分析: {args.devices} 个设备 x {args.seconds:.0f}秒, {per_sample * 1e6:.2f} 微秒/样本, "
+          f"每个设备实时采集时占用单核 {per_sample * NOMINAL_SAMPLE_RATE * 100:.3f}%")
+
+    median, worst, stats = bench_submit(min(args.seconds, 60), batch_size)
+    print(f"提交: 每批 {batch_size} 个样本, 中位数 {median * 1e6:.1f} 微秒, 最大 {worst * 1e6:.1f} 微秒, "
+          f"分析线程 {stats['cpu_per_sample'] * 1e6:.2f} 微秒/样本, 丢弃批次 {stats['dropped_batches']}")
@@ -0,0 +1,326 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from camera_recorder import CameraRecorder
+from roi_recording import load_detector
+from cms50e_decoder import NOMINAL_SAMPLE_RATE
+from command_channel import CommandChannel
+from oximeter_devices import SyntheticDevice
+from oximeter1 import OximeterDataCollector
+from bench_signal_quality import bench_analyzer
+
+'''
+单机基准测试，不需要摄像头、血氧仪和第二台电脑:
+- 采集: OximeterDataCollector 使用按指定速率产生报告的合成设备，统计持续采集速率、丢弃行数和每分钟写入字节数
+- 录制: CameraRecorder 以合成的视频文件作为摄像头，统计实际帧率、丢帧率、编码耗时和每分钟写入字节数
+- 人脸区域录制: 同一输入只录制人脸区域(含人脸检测和跟踪的开销)，与整帧录制比较写入量和编码耗时
+- 命令: 本机回环地址上运行N个从机(127.0.0.2起)，统计PREPARE/START/STOP的确认延迟
+- 分析: 在线信号分析每个样本的CPU时间
+结果以JSON输出，并与 baselines.json 中的基准比较，超出容差时返回非零退出码。
+'''
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baselines.json")
+
+# 参与比较的指标: (方向, 允许的绝对误差)，higher越大越好，lower越小越好
+# 毫秒级的延迟受系统调度影响较大，只有同时超出绝对误差才算退化
+METRICS = {
+    'acquisition_csv.samples_per_second': ('higher', 0),
+    'acquisition_csv.dropped_rows': ('lower', 0),
+    'acquisition_csv.bytes_per_minute': ('lower', 0),
+    'acquisition_bin.samples_per_second': ('higher', 0),
+    'acquisition_bin.dropped_rows': ('lower', 0),
+    'acquisition_bin.bytes_per_minute': ('lower', 0),
+    'recording.fps': ('higher', 0),
+    'recording.drop_rate': ('lower', 0.001),
+    'recording.bytes_per_minute': ('lower', 0),
+    'recording.encode_ms': ('lower', 1.0),
+    'recording_roi.fps': ('higher', 0),
+    'recording_roi.drop_rate': ('lower', 0.001),
+    'recording_roi.bytes_per_minute': ('lower', 0),
+    'recording_roi.encode_ms': ('lower', 1.0),
+    'commands.prepare_ms': ('lower', 5.0),
+    'commands.start_ms': ('lower', 5.0),
+    'commands.stop_ms': ('lower', 20.0),
+    'commands.ack_rate': ('higher', 0),
+    'analysis.us_per_sample': ('lower', 1.0),
+}
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """屏蔽被测模块的打印输出(包括其后台线程)"""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def directory_size(path):
+    """目录下所有文件的总字节数"""
+    total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            total += os.path.getsize(os.path.join(directory, name))
+    return total
+
+
+def synthetic_device_factory(rate):
+    """按rate(样本/秒)产生报告的合成设备，rate为0时尽可能快"""
+    speed = rate / 60.0 if rate else 0
+    return lambda: SyntheticDevice(sample_rate=60.0, speed=speed)
+
+
+def bench_acquisition(work_dir, output_format, devices, rate, seconds, verbose=False):
+    """在本机采集指定时长，返回持续采集速率和写入量(按每个设备60样本/秒的实际采集速率折算为每分钟字节数)"""
+    data_dir = os.path.join(work_dir, f"acquisition_{output_format}")
+    with quiet(not verbose):
+        collector = OximeterDataCollector(0, 0, port=0, bind_host='127.0.0.1')
+        collector.data_dir = data_dir
+        collector.output_format = output_format
+        collector.device_factories = [({'path': f'synthetic:{n}', 'serial': ''}, synthetic_device_factory(rate))
+                                      for n in range(devices)]
+        collector._process_command("PREPARE", None)
+        collector._process_command(f"START,{time.time()}", None)
+        start = time.monotonic()
+        time.sleep(seconds)
+        samples = collector.sample_count
+        dropped = sum(stats['dropped_rows'] for stats in collector.get_writer_stats().values())
+        elapsed = time.monotonic() - start
+        collector._process_command(f"STOP,{time.time()}", None)
+        collector.udp_socket.close()
+    bytes_per_sample = directory_size(data_dir) / max(samples, 1)
+    return {
+        'samples_per_second': samples / elapsed,
+        'dropped_rows': dropped,
+        'bytes_per_sample': bytes_per_sample,
+        'bytes_per_minute': bytes_per_sample * NOMINAL_SAMPLE_RATE * 60 * devices,
+    }
+
+
+def make_test_video(path, width, height, fps, seconds=2):
+    """生成合成视频文件(移动的渐变加少量噪声)，作为文件摄像头的输入"""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    rng = np.random.default_rng(0)
+    gradient = np.tile(np.linspace(0, 255, width, dtype=np.float32), (height, 1))
+    for n in range(int(fps * seconds)):
+        frame = np.roll(gradient, n * 4, axis=1) + rng.normal(0, 4, (height, width)).astype(np.float32)
+        frame = np.clip(frame, 0, 255).astype(np.uint8)
+        writer.write(cv2.merge((frame, np.flipud(frame), frame // 2)))
+    writer.release()
+    return path
+
+
+def bench_recording(work_dir, width, height, fps, seconds, roi=None, verbose=False):
+    """以合成视频文件为摄像头录制指定时长，返回实际帧率、丢帧率、编码耗时和写入量，roi为人脸区域录制参数"""
+    source = os.path.join(work_dir, "source.mp4")
+    if not os.path.exists(source):
+        make_test_video(source, width, height, fps)
+    output_dir = os.path.join(work_dir, "output_roi" if roi else "output")
+    os.makedirs(output_dir)
+    video_path = os.path.join(output_dir, "recording.mp4")
+    recorder = CameraRecorder(source)
+    with quiet(not verbose):
+        recorder.open()
+        try:
+            start = time.monotonic()
+            recorder.start_recording(video_path, time.time(), roi=roi)
+            time.sleep(seconds)
+            stats = recorder.stop_recording()
+            elapsed = time.monotonic() - start
+        finally:
+            recorder.close()
+    captured = max(stats['captured_frames'], 1)
+    results = {
+        'fps': stats['achieved_fps'],
+        'drop_rate': stats['dropped_frames'] / captured,
+        'bytes_per_minute': directory_size(output_dir) / elapsed * 60,
+        # 编码阶段的耗时，人脸区域录制时包括检测、跟踪和裁剪
+        'encode_ms': stats['encode']['mean_ms'],
+    }
+    if roi:
+        results['detect_ms'] = stats['roi']['detect']['mean_ms']
+        results['track_ms'] = stats['roi']['track']['mean_ms']
+    return results
+
+
+def roi_benchmark_options(model, size, full_scale):
+    """人脸区域录制测试的参数，检测模型无法加载时返回None(跳过该测试，不记录不含检测开销的结果)"""
+    try:
+        load_detector(model)
+    except ValueError as e:
+        print(f"跳过人脸区域录制测试，人脸检测模型不可用: {str(e)}", file=sys.stderr)
+        return None
+    return {'model': model, 'size': size, 'full_scale': full_scale}
+
+
+def bench_commands(work_dir, slaves, port, rounds, verbose=False):
+    """本机回环地址上运行多个从机，返回各命令所有从机确认的中位延迟(毫秒)"""
+    ips = [f"127.0.0.{2 + n}" for n in range(slaves)]
+    collectors = []
+    with quiet(not verbose):
+        for n, ip in enumerate(ips):
+            collector = OximeterDataCollector(0, 0, port=port, bind_host=ip)
+            collector.data_dir = os.path.join(work_dir, f"slave{n}")
+            collector.analysis_enabled = False
+            collector.device_factories = [({'path': 'synthetic:0', 'serial': ''}, synthetic_device_factory(60))]
+            collector.start_udp_listener()
+            collectors.append(collector)
+
+        master_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        master_socket.bind(('127.0.0.1', 0))
+        channel = CommandChannel(master_socket, port)
+        latencies = {'prepare_ms': [], 'start_ms': [], 'stop_ms': []}
+        acked = sent = 0
+        for _ in range(rounds):
+            for key, command in (('prepare_ms', "PREPARE,bench.csv"), ('start_ms', f"START,{time.time()}"),
+                                 ('stop_ms', f"STOP,{time.time()}")):
+                start = time.perf_counter()
+                results = channel.send(ips, command)
+                latencies[key].append((time.perf_counter() - start) * 1000)
+                acked += sum(result.acknowledged for result in results.values())
+                sent += len(results)
+                if key == 'start_ms':
+                    time.sleep(0.5)
+        master_socket.close()
+
+    metrics = {key: statistics.median(values) for key, values in latencies.items()}
+    metrics['ack_rate'] = acked / sent if sent else 0.0
+    return metrics
+
+
+def flatten(results):
+    """{'组': {'指标': 值}} -> {'组.指标': 值}"""
+    return {f"{group}.{name}": value for group, values in results.items() for name, value in values.items()}
+
+
+def compare(metrics, baseline, tolerance):
+    """与基准比较，返回[(指标, 当前值, 基准值, 变化比例, 是否退化)]"""
+    rows = []
+    for name, value in sorted(metrics.items()):
+        if name not in baseline or name not in METRICS:
+            continue
+        direction, slack = METRICS[name]
+        reference = baseline[name]
+        change = (value - reference) / abs(reference) if reference else (0.0 if value == reference else float('inf'))
+        worse = -change if direction == 'higher' else change
+        regressed = worse > tolerance and abs(value - reference) > slack
+        rows.append((name, value, reference, change, regressed))
+    return rows
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='采集、录制和命令通道的单机基准测试')
+    parser.add_argument('--only', nargs='+', choices=['acquisition', 'recording', 'roi', 'commands', 'analysis'],
+                        default=['acquisition', 'recording', 'roi', 'commands', 'analysis'], help='只运行指定的测试')
+    parser.add_argument('--seconds', type=float, default=5, help='采集和录制测试的时长(秒)')
+    parser.add_argument('--devices', type=int, default=2, help='采集测试的合成设备数')
+    parser.add_argument('--hid-rate', type=float, default=0,
+                        help='每个合成设备的样本速率(样本/秒)，0为尽可能快(测试最大采集速率)')
+    parser.add_argument('--video-size', type=str, default='1280x720', help='合成视频分辨率 宽x高')
+    parser.add_argument('--video-fps', type=int, default=30, help='合成视频帧率')
+    parser.add_argument('--roi-size', type=str, default='256x256', help='人脸区域视频的输出尺寸')
+    parser.add_argument('--roi-model', type=str, default=None,
+                        help='人脸检测模型，默认为 models/ 下的YuNet模型；不可用时跳过人脸区域录制测试')
+    parser.add_argument('--roi-full-scale', type=float, default=0.25,
+                        help='人脸区域录制时同时保存的整帧视频缩放比例，0为不保存')
+    parser.add_argument('--slaves', type=int, default=8, help='模拟从机数')
+    parser.add_argument('--command-port', type=int, default=5960, help='模拟从机的命令端口')
+    parser.add_argument('--rounds', type=int, default=5, help='命令测试的轮数')
+    parser.add_argument('--output', type=str, default=None, help='结果JSON保存路径')
+    parser.add_argument('--baseline', type=str, default=BASELINE_PATH, help='基准JSON路径')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='允许的退化比例')
+    parser.add_argument('--update-baseline', action='store_true', help='用本次结果更新基准')
+    parser.add_argument('--verbose', action='store_true', help='显示被测模块的输出')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    width, height = (int(value) for value in args.video_size.lower().split('x'))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        # 采集程序在当前目录创建数据目录，测试期间切换到临时目录
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            if 'acquisition' in args.only:
+                for output_format in ('csv', 'bin'):
+                    results[f'acquisition_{output_format}'] = bench_acquisition(
+                        work_dir, output_format, args.devices, args.hid_rate, args.seconds, args.verbose)
+            recording_dir = os.path.join(work_dir, "recording")
+            if 'recording' in args.only or 'roi' in args.only:
+                os.makedirs(recording_dir)
+            if 'recording' in args.only:
+                results['recording'] = bench_recording(recording_dir, width, height, args.video_fps,
+                                                       args.seconds, verbose=args.verbose)
+            roi = None
+            if 'roi' in args.only:
+                roi = roi_benchmark_options(args.roi_model, args.roi_size, args.roi_full_scale)
+            if roi:
+                cropped = bench_recording(recording_dir, width, height, args.video_fps,
+                                          args.seconds, roi, args.verbose)
+                if 'recording' in results:
+                    # 相对整帧录制的写入量和编码耗时
+                    full = results['recording']
+                    cropped['bytes_ratio'] = cropped['bytes_per_minute'] / max(full['bytes_per_minute'], 1)
+                    cropped['encode_ratio'] = cropped['encode_ms'] / max(full['encode_ms'], 1e-6)
+                results['recording_roi'] = cropped
+            if 'commands' in args.only:
+                results['commands'] = bench_commands(work_dir, args.slaves, args.command_port,
+                                                     args.rounds, args.verbose)
+            if 'analysis' in args.only:
+                results['analysis'] = {'us_per_sample': bench_analyzer(args.devices, 60, 12) * 1e6}
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'update_baseline', 'verbose')},
+        'metrics': flatten(results),
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+        print(f"已更新基准: {args.baseline}")
+        raise SystemExit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f"没有基准文件 {args.baseline}，使用 --update-baseline 创建")
+        raise SystemExit(0)
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['metrics']
+    rows = compare(report['metrics'], baseline, args.tolerance)
+    for name, value, reference, change, regressed in rows:
+        print(f"{'退化' if regressed else '正常'} {name}: {value:.3f} (基准 {reference:.3f}, {change:+.1%})",
+              file=sys.stderr)
+    regressions = sum(row[4] for row in rows)
+    print(f"共比较 {len(rows)} 个指标，退化 {regressions} 个", file=sys.stderr)
+    raise SystemExit(1 if regressions else 0)
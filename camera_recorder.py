@@ -0,0 +1,333 @@
+import multiprocessing
+import os
+import threading
+import time
+import cv2
+from frame_broadcaster import FrameBroadcaster
+from frame_index import FrameIndexWriter, FrameIndexGroup, frame_index_path
+from roi_recording import open_roi_writer
+from video_pipeline import VideoPipeline
+from video_segments import SegmentedVideoWriter
+
+'''
+单个摄像头的录制单元，以及多摄像头的配置解析。
+CameraRecorder 在当前进程中运行读帧线程和编码线程；
+CameraProcess 把 CameraRecorder 放到独立进程中运行，避免多路摄像头争用GIL。
+所有摄像头的帧索引都使用同一台机器的 time.monotonic() 和 time.time()，
+跨进程也是同一个时钟，因此多路视频可以按帧索引精确对齐。
+'''
+
+
+def parse_camera_sources(text):
+    """解析摄像头配置，逗号分隔，数字为摄像头索引，其余为视频文件路径(用于测试)"""
+    sources = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        sources.append(int(item) if item.isdigit() else item)
+    if not sources:
+        raise ValueError("未配置摄像头")
+    return sources
+
+
+def camera_video_filename(video_filename, camera_number):
+    """第一个摄像头沿用原文件名，其余摄像头追加编号"""
+    if camera_number == 0:
+        return video_filename
+    base, ext = os.path.splitext(video_filename)
+    return f"{base}_cam{camera_number}{ext}"
+
+
+def draw_timestamp(frame, elapsed):
+    """录制时在帧上叠加从开始录制起的时间"""
+    cv2.putText(frame, f"Time: {elapsed:.2f}s", (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+
+
+class PacedCapture:
+    """按视频文件自身的帧率读取，使文件输入的行为接近实时摄像头"""
+    def __init__(self, cap, fps):
+        self.cap = cap
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.next_time = None
+
+    def _wait(self):
+        now = time.perf_counter()
+        if self.next_time is None:
+            self.next_time = now
+        delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time + self.interval, time.perf_counter() - self.interval)
+
+    def read(self, image=None):
+        self._wait()
+        ret, frame = self.cap.read(image)
+        if not ret:
+            # 文件读完后从头循环
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read(image)
+        return ret, frame
+
+    def grab(self):
+        self._wait()
+        return self.cap.grab()
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self.cap.release()
+
+
+def open_capture(source):
+    """打开摄像头或视频文件，视频文件按原帧率读取"""
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise ValueError(f"无法打开摄像头 {source}")
+    if isinstance(source, str):
+        return PacedCapture(cap, cap.get(cv2.CAP_PROP_FPS))
+    return cap
+
+
+class CameraRecorder:
+    """当前进程中的单路摄像头：读帧线程 + 录制流水线"""
+    def __init__(self, source, ring_size=64, fourcc='mp4v'):
+        self.source = source
+        self.ring_size = ring_size
+        self.fourcc = fourcc
+        self.cap = None
+        self.broadcaster = None
+        self.writer = None
+        self.frame_index = None
+        self.pipeline = None
+        self.video_path = None
+        self.frame_size = None
+        self.fps = 0
+
+    def open(self):
+        """打开摄像头并启动读帧线程，已打开时直接返回"""
+        if self.broadcaster and self.broadcaster.running:
+            return
+        self.cap = open_capture(self.source)
+        width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = int(self.cap.get(cv2.CAP_PROP_FPS)) or 30
+        self.frame_size = (width, height)
+        cap = self.cap
+        self.broadcaster = FrameBroadcaster(
+            cap, (height, width, 3), ring_size=self.ring_size,
+            position_getter=lambda: cap.get(cv2.CAP_PROP_POS_MSEC)
+        )
+        self.broadcaster.start()
+
+    @property
+    def is_open(self):
+        return self.broadcaster is not None and self.broadcaster.running
+
+    def start_recording(self, video_path, start_time, duration=None, on_duration_reached=None, overlay=None,
+                        segment_seconds=None, segment_frames=None, roi=None):
+        """
+        开始写入视频和帧索引，指定分段时长或帧数时按分段轮转视频文件
+        roi: 可选的ROI录制参数(见roi_recording.DEFAULT_ROI_OPTIONS)，指定时只写入人脸区域
+        """
+        self.video_path = video_path
+        fourcc = cv2.VideoWriter_fourcc(*self.fourcc)
+
+        def open_writer(path, frame_size):
+            if segment_seconds or segment_frames:
+                return SegmentedVideoWriter(path, fourcc, self.fps, frame_size,
+                                            segment_seconds=segment_seconds, segment_frames=segment_frames)
+            return cv2.VideoWriter(path, fourcc, self.fps, frame_size)
+
+        if roi:
+            self.writer, full_path = open_roi_writer(video_path, self.frame_size, roi, open_writer)
+        else:
+            self.writer, full_path = open_writer(video_path, self.frame_size), None
+        self.frame_index = FrameIndexWriter(frame_index_path(video_path))
+        if full_path:
+            # 低分辨率整帧视频与ROI视频的帧一一对应
+            self.frame_index = FrameIndexGroup([self.frame_index, FrameIndexWriter(frame_index_path(full_path))])
+        self.pipeline = VideoPipeline(
+            self.broadcaster.subscribe("recorder", mode="all"), self.writer, start_time,
+            duration=duration,
+            on_duration_reached=on_duration_reached,
+            overlay=overlay,
+            frame_index=self.frame_index
+        )
+        self.pipeline.start()
+
+    def stop_recording(self):
+        """停止录制，返回流水线统计"""
+        stats = None
+        if self.pipeline:
+            self.pipeline.stop()
+            stats = self.pipeline.stats()
+            self.pipeline = None
+        if self.writer:
+            self.writer.release()
+            if stats is not None and getattr(self.writer, 'completed_segments', None) is not None:
+                stats['segments'] = self.writer.completed_segments
+            if stats is not None and hasattr(self.writer, 'roi_stats'):
+                stats['roi'] = self.writer.roi_stats()
+            self.writer = None
+        if self.frame_index:
+            self.frame_index.close()
+            self.frame_index = None
+        return stats
+
+    def live_stats(self):
+        """返回读帧帧率与录制进度，用于界面显示"""
+        if not self.broadcaster:
+            return {'fps': 0.0, 'frames': 0, 'encoded_frames': 0, 'dropped_frames': 0}
+        stats = self.broadcaster.stats()
+        pipeline = self.pipeline
+        return {
+            'fps': stats['fps'],
+            'frames': stats['frames'],
+            'encoded_frames': pipeline.encoded_frames if pipeline else 0,
+            'dropped_frames': pipeline.subscription.dropped if pipeline else 0,
+        }
+
+    def close(self):
+        """停止录制并释放摄像头"""
+        self.stop_recording()
+        if self.broadcaster:
+            self.broadcaster.stop()
+            self.broadcaster = None
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+
+
+def _camera_process_main(source, options, connection):
+    """摄像头子进程：按主进程的命令运行CameraRecorder"""
+    recorder = CameraRecorder(source, **options)
+    try:
+        recorder.open()
+        connection.send(('ready', recorder.frame_size))
+    except Exception as e:
+        connection.send(('error', str(e)))
+        return
+
+    while True:
+        command, argument = connection.recv()
+        try:
+            if command == 'start':
+                recorder.start_recording(argument['video_path'], argument['start_time'],
+                                         duration=argument.get('duration'),
+                                         segment_seconds=argument.get('segment_seconds'),
+                                         segment_frames=argument.get('segment_frames'),
+                                         roi=argument.get('roi'))
+                connection.send(('started', None))
+            elif command == 'stop':
+                connection.send(('stopped', recorder.stop_recording()))
+            elif command == 'stats':
+                connection.send(('stats', recorder.live_stats()))
+            elif command == 'close':
+                recorder.close()
+                connection.send(('closed', None))
+                break
+        except Exception as e:
+            connection.send(('error', str(e)))
+
+
+class CameraProcess:
+    """在独立进程中运行的单路摄像头，接口与CameraRecorder相同"""
+    def __init__(self, source, ring_size=64, fourcc='mp4v', timeout=10):
+        self.source = source
+        self.options = {'ring_size': ring_size, 'fourcc': fourcc}
+        self.timeout = timeout
+        self.process = None
+        self.connection = None
+        self.frame_size = None
+        self.video_path = None
+        self.broadcaster = None  # 子进程中的帧无法在主进程预览
+        self._request_lock = threading.Lock()  # 管道上一问一答，多个线程请求时不能交错
+
+    def _request(self, command, argument=None):
+        with self._request_lock:
+            self.connection.send((command, argument))
+            return self._reply()
+
+    def _reply(self):
+        if not self.connection.poll(self.timeout):
+            raise TimeoutError(f"摄像头 {self.source} 进程无响应")
+        status, value = self.connection.recv()
+        if status == 'error':
+            raise RuntimeError(f"摄像头 {self.source}: {value}")
+        return value
+
+    def open(self):
+        if self.is_open:
+            return
+        parent, child = multiprocessing.Pipe()
+        self.connection = parent
+        self.process = multiprocessing.Process(
+            target=_camera_process_main, args=(self.source, self.options, child), daemon=True)
+        self.process.start()
+        self.frame_size = self._reply()
+
+    @property
+    def is_open(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start_recording(self, video_path, start_time, duration=None, on_duration_reached=None, overlay=None,
+                        segment_seconds=None, segment_frames=None, roi=None):
+        # 时长由主进程控制，叠加文字仅在主进程的摄像头上支持
+        self.video_path = video_path
+        self._request('start', {'video_path': video_path, 'start_time': start_time, 'duration': duration,
+                                'segment_seconds': segment_seconds, 'segment_frames': segment_frames,
+                                'roi': roi})
+
+    def stop_recording(self):
+        if not self.is_open:
+            return None
+        return self._request('stop')
+
+    def live_stats(self):
+        if not self.is_open:
+            return {'fps': 0.0, 'frames': 0, 'encoded_frames': 0, 'dropped_frames': 0}
+        return self._request('stats')
+
+    def close(self):
+        if self.is_open:
+            try:
+                self._request('close')
+            except (TimeoutError, RuntimeError, EOFError) as e:
+                print(f"关闭摄像头进程失败: {str(e)}")
+            self.process.join(timeout=self.timeout)
+        self.process = None
+
+
+def open_cameras(sources, use_process=False, ring_size=64):
+    """打开所有摄像头，use_process为True时第一路之外的摄像头在独立进程中运行，失败时关闭已打开的摄像头"""
+    cameras = []
+    try:
+        for number, source in enumerate(sources):
+            # 第一路摄像头始终在本进程中，供预览使用
+            if use_process and number > 0:
+                camera = CameraProcess(source, ring_size=ring_size)
+            else:
+                camera = CameraRecorder(source, ring_size=ring_size)
+            camera.open()
+            cameras.append(camera)
+    except Exception:
+        for camera in cameras:
+            camera.close()
+        raise
+    return cameras
+
+
+def wait_for_frames(cameras, frames=1, timeout=10):
+    """等待每路摄像头都已读到指定帧数(摄像头预热、自动曝光稳定)，超时抛出TimeoutError"""
+    deadline = time.monotonic() + timeout
+    for number, camera in enumerate(cameras):
+        while camera.live_stats()['frames'] < frames:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"摄像头{number} ({camera.source}) 在{timeout}秒内未读到画面")
+            time.sleep(0.01)
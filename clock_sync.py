@@ -0,0 +1,241 @@
+import csv
+import socket
+import threading
+import time
+import numpy as np
+
+'''
+主机与从机的NTP式时钟同步。
+主机发送 SYNC,<编号>,<t1>，从机收到后立即回复 SYNCR,<编号>,<t1>,<t2>,<t3>，
+t2为从机收到时间，t3为从机回复时间，主机收到回复的时间为t4，均为各自的 time.time()。
+    偏差 offset = ((t2 - t1) + (t3 - t4)) / 2   (从机时钟 - 主机时钟)
+    往返延迟 delay = (t4 - t1) - (t3 - t2)
+每轮测量发送多次，只保留延迟最小的样本(排队和调度延迟最小，偏差估计最准)，
+再对整个会话中各轮的最佳样本做线性拟合，得到时钟漂移。
+对齐时: 主机时间 = 从机时间 - offset_at(主机时间)，漂移很小时可用从机时间近似主机时间代入
+'''
+
+SYNC_REQUEST = "SYNC"
+SYNC_REPLY = "SYNCR"
+SAMPLE_HEADER = ['从机', '轮次', '编号', 't1', 't2', 't3', 't4', '偏差', '往返延迟', '最佳']
+
+
+def make_sync_reply(command, receive_time):
+    """从机根据SYNC命令生成回复，receive_time为收到命令的本地时间"""
+    parts = command.split(',')
+    if len(parts) < 3:
+        raise ValueError(f"无效的同步命令: {command}")
+    return f"{SYNC_REPLY},{parts[1]},{parts[2]},{receive_time!r},{time.time()!r}"
+
+
+def sample_delay(t1, t2, t3, t4):
+    return (t4 - t1) - (t3 - t2)
+
+
+def sample_offset(t1, t2, t3, t4):
+    return ((t2 - t1) + (t3 - t4)) / 2
+
+
+class ClockSyncEstimator:
+    """单个从机的偏差和漂移估计"""
+    def __init__(self):
+        self.samples = []  # (轮次, 编号, t1, t2, t3, t4)
+        self.best = []     # 每轮延迟最小的样本
+
+    def add_round(self, round_number, samples):
+        """加入一轮测量的样本，保留其中延迟最小的一个"""
+        valid = [sample for sample in samples if sample is not None]
+        self.samples.extend((round_number,) + sample for sample in valid)
+        if valid:
+            self.best.append(min(valid, key=lambda sample: sample_delay(*sample[1:])))
+
+    def estimate(self):
+        """返回偏差、漂移和延迟估计，没有有效样本时返回None"""
+        if not self.best:
+            return None
+        best = np.array([sample[1:] for sample in self.best], dtype=np.float64)
+        t1, t2, t3, t4 = best.T
+        offsets = ((t2 - t1) + (t3 - t4)) / 2
+        delays = (t4 - t1) - (t3 - t2)
+        midpoints = (t1 + t4) / 2
+
+        # 样本跨度足够时拟合漂移，否则只取延迟最小样本的偏差
+        reference_time = float(midpoints[0])
+        drift = 0.0
+        offset = float(offsets[np.argmin(delays)])
+        residual = 0.0
+        if len(offsets) >= 3 and midpoints[-1] - midpoints[0] > 1.0:
+            drift, offset = np.polyfit(midpoints - reference_time, offsets, 1)
+            fitted = offset + drift * (midpoints - reference_time)
+            residual = float(np.std(offsets - fitted))
+        return {
+            'offset': float(offset),
+            'drift': float(drift),
+            'drift_ppm': float(drift) * 1e6,
+            'reference_time': reference_time,
+            'min_delay': float(delays.min()),
+            'median_delay': float(np.median(delays)),
+            'residual': residual,
+            'rounds': len(self.best),
+            'samples': len(self.samples),
+        }
+
+    def offset_at(self, master_time):
+        """主机时间master_time时从机时钟相对主机的偏差"""
+        estimate = self.estimate()
+        if estimate is None:
+            return 0.0
+        return estimate['offset'] + estimate['drift'] * (master_time - estimate['reference_time'])
+
+    def to_master_time(self, slave_time):
+        """把从机时间换算为主机时间，slave_time可以是numpy数组"""
+        estimate = self.estimate()
+        if estimate is None:
+            return slave_time
+        # 从机时间 = 主机时间 + offset + drift * (主机时间 - 参考时间)
+        drift = estimate['drift']
+        return (slave_time - estimate['offset'] + drift * estimate['reference_time']) / (1.0 + drift)
+
+
+class ClockSyncClient:
+    """主机端的同步测量，使用独立的UDP套接字接收回复"""
+    def __init__(self, port=5000, timeout=0.2):
+        self.port = port
+        self.timeout = timeout
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('0.0.0.0', 0))
+        self.lock = threading.Lock()
+        self._next_id = 0
+
+    def measure(self, ip, rounds=8, interval=0.01):
+        """向从机发送rounds次同步请求，返回(编号, t1, t2, t3, t4)列表，超时的请求为None"""
+        samples = []
+        with self.lock:
+            for _ in range(rounds):
+                self._next_id += 1
+                request_id = self._next_id
+                t1 = time.time()
+                self.socket.sendto(f"{SYNC_REQUEST},{request_id},{t1!r}".encode(), (ip, self.port))
+                samples.append(self._wait_reply(request_id, t1))
+                if interval:
+                    time.sleep(interval)
+        return samples
+
+    def _wait_reply(self, request_id, t1):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.socket.settimeout(remaining)
+            try:
+                data, _ = self.socket.recvfrom(1024)
+            except socket.timeout:
+                return None
+            t4 = time.time()
+            parts = data.decode().strip().split(',')
+            # 丢弃过期的回复
+            if len(parts) != 5 or parts[0] != SYNC_REPLY or int(parts[1]) != request_id:
+                continue
+            return request_id, t1, float(parts[3]), float(parts[4]), t4
+
+    def close(self):
+        self.socket.close()
+
+
+class ClockSyncMonitor:
+    """
+    录制前及录制中定期测量所有从机的时钟偏差
+    interval: 两轮测量的间隔(秒)
+    rounds: 每轮发送的同步请求数
+    """
+    def __init__(self, ips, port=5000, interval=10.0, rounds=8, timeout=0.2):
+        self.ips = list(ips)
+        self.interval = interval
+        self.rounds = rounds
+        self.client = ClockSyncClient(port, timeout)
+        self.estimators = {ip: ClockSyncEstimator() for ip in self.ips}
+        self.round_number = 0
+        self.running = False
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def measure_all(self):
+        """对所有从机进行一轮测量"""
+        self.round_number += 1
+        for ip in self.ips:
+            try:
+                samples = self.client.measure(ip, self.rounds)
+            except OSError as e:
+                print(f"时钟同步 {ip} 失败: {str(e)}")
+                continue
+            self.estimators[ip].add_round(self.round_number, samples)
+
+    def start(self):
+        """立即测量一轮，之后每隔interval秒测量一轮"""
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self.running:
+            self.measure_all()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def stop(self, final_round=True):
+        """停止定期测量，final_round为True时再测量一轮用于拟合漂移"""
+        self.running = False
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + self.rounds * self.client.timeout * len(self.ips))
+            self._thread = None
+        if final_round:
+            self.measure_all()
+        self.client.close()
+
+    def results(self):
+        """返回每个从机的估计结果"""
+        return {ip: estimator.estimate() for ip, estimator in self.estimators.items()}
+
+    def save_samples(self, path):
+        """保存所有同步样本，用于离线对齐时重新拟合"""
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(SAMPLE_HEADER)
+            for ip, estimator in self.estimators.items():
+                best = set(estimator.best)
+                for round_number, request_id, t1, t2, t3, t4 in estimator.samples:
+                    sample = (request_id, t1, t2, t3, t4)
+                    writer.writerow([ip, round_number, request_id, repr(t1), repr(t2), repr(t3), repr(t4),
+                                     sample_offset(t1, t2, t3, t4), sample_delay(t1, t2, t3, t4),
+                                     int(sample in best)])
+
+
+def load_samples(path):
+    """读取clock_sync.csv，返回 {从机: ClockSyncEstimator}"""
+    rounds = {}
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            sample = (int(row[2]), float(row[3]), float(row[4]), float(row[5]), float(row[6]))
+            rounds.setdefault(row[0], {}).setdefault(int(row[1]), []).append(sample)
+    estimators = {}
+    for ip, samples_by_round in rounds.items():
+        estimator = estimators[ip] = ClockSyncEstimator()
+        for round_number in sorted(samples_by_round):
+            estimator.add_round(round_number, samples_by_round[round_number])
+    return estimators
+
+
+def format_result(ip, result):
+    """将估计结果格式化为会话记录中的文本行"""
+    if result is None:
+        return [f"从机 {ip} 时钟同步: 无有效样本"]
+    return [
+        f"从机 {ip} 时钟偏差: {result['offset']:.6f}秒 (参考时间 {result['reference_time']})",
+        f"从机 {ip} 时钟漂移: {result['drift_ppm']:.3f}ppm",
+        f"从机 {ip} 往返延迟: 最小 {result['min_delay'] * 1000:.3f}ms, 中位 {result['median_delay'] * 1000:.3f}ms",
+        f"从机 {ip} 同步轮数: {result['rounds']}, 样本数: {result['samples']}, 拟合残差: {result['residual'] * 1000:.3f}ms",
+    ]
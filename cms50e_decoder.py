@@ -0,0 +1,227 @@
+import numpy as np
+
+'''
+Contec CMS50E HID报告解码模块。
+每个18字节的报告包含3个6字节子包，子包格式为:
+    [校验位, 数据更新位, 状态位, 数据1, 数据2, 保留]
+数据更新位为0时数据1为PPG；为1时数据1为HR，数据2为SPO2。
+未更新的字段沿用上一个值(与逐字节解析的行为一致)。
+
+decode_reports 对一批报告做一次向量化解析，实时采集与离线处理共用。
+TimestampReconstructor / reconstruct_timestamps 通过拟合主机接收时间与
+样本序号之间的线性关系，为每个样本重建等间隔、已校正漂移的时间戳。
+'''
+
+REPORT_SIZE = 18
+SUBPACKET_SIZE = 6
+SAMPLES_PER_REPORT = REPORT_SIZE // SUBPACKET_SIZE
+NOMINAL_SAMPLE_RATE = 60.0  # CMS50E标称采样率(Hz)
+
+# 数据更新位取值
+UPDATE_PPG = 0
+UPDATE_HR_SPO2 = 1
+
+
+class DecoderState:
+    """解码器状态，保存跨批次沿用的PPG/HR/SPO2值"""
+    def __init__(self, ppg=0, hr=0, spo2=0):
+        self.ppg = ppg
+        self.hr = hr
+        self.spo2 = spo2
+
+
+def pack_reports(reports):
+    """
+    将多次device.read()返回的报告打包为(N, 18)的uint8数组
+    不足18字节的报告以0填充，返回(数组, 各报告实际长度)
+    """
+    buffer = np.zeros((len(reports), REPORT_SIZE), dtype=np.uint8)
+    lengths = np.zeros(len(reports), dtype=np.int64)
+    for row, report in enumerate(reports):
+        length = min(len(report), REPORT_SIZE)
+        buffer[row, :length] = report[:length]
+        lengths[row] = length
+    return buffer, lengths
+
+
+def _carry_forward(values, mask, initial):
+    """mask为True处取values，其余位置沿用之前最近一次的值(首个之前使用initial)"""
+    positions = np.where(mask, np.arange(len(values)), -1)
+    np.maximum.accumulate(positions, out=positions)
+    result = values[np.maximum(positions, 0)].astype(np.int64)
+    result[positions < 0] = initial
+    return result
+
+
+def decode_reports(reports, lengths=None, state=None):
+    """
+    向量化解析一批报告
+    reports: (N, 18)的uint8数组，或可被numpy.frombuffer解析的原始字节
+    lengths: 各报告实际长度，None表示均为完整报告
+    state: DecoderState，解析后原地更新，用于跨批次沿用HR/SPO2
+    返回字典: check/update/status/ppg/hr/spo2 (每个有效子包一个样本)，
+    以及 report_index(样本所属报告) 和 sub_index(报告内子包序号)
+    """
+    if state is None:
+        state = DecoderState()
+
+    if isinstance(reports, (bytes, bytearray, memoryview)):
+        reports = np.frombuffer(reports, dtype=np.uint8)
+    reports = np.asarray(reports, dtype=np.uint8)
+    if reports.ndim == 1:
+        reports = reports[:len(reports) - len(reports) % REPORT_SIZE].reshape(-1, REPORT_SIZE)
+    count = reports.shape[0]
+    if lengths is None:
+        lengths = np.full(count, REPORT_SIZE, dtype=np.int64)
+
+    sub = reports.reshape(count * SAMPLES_PER_REPORT, SUBPACKET_SIZE)
+    check = sub[:, 0]
+    update = sub[:, 1]
+    status = sub[:, 2]
+
+    # 与逐字节解析一致：字段所在字节不超出实际长度才更新，
+    # 子包所需字节超出实际长度时不输出该样本(已读到的HR仍会沿用)
+    sub_index = np.tile(np.arange(SAMPLES_PER_REPORT), count)
+    report_index = np.repeat(np.arange(count), SAMPLES_PER_REPORT)
+    available = np.repeat(np.asarray(lengths), SAMPLES_PER_REPORT) - SUBPACKET_SIZE * sub_index
+    ppg_mask = (update == UPDATE_PPG) & (available >= 4)
+    hr_mask = (update == UPDATE_HR_SPO2) & (available >= 4)
+    spo2_mask = (update == UPDATE_HR_SPO2) & (available >= 5)
+    valid = available >= np.where(update == UPDATE_PPG, 4, np.where(update == UPDATE_HR_SPO2, 5, 3))
+
+    ppg = _carry_forward(sub[:, 3], ppg_mask, state.ppg)
+    hr = _carry_forward(sub[:, 3], hr_mask, state.hr)
+    spo2 = _carry_forward(sub[:, 4], spo2_mask, state.spo2)
+
+    # 状态按最后一个子包更新(包括未输出的子包)
+    if len(ppg):
+        state.ppg, state.hr, state.spo2 = int(ppg[-1]), int(hr[-1]), int(spo2[-1])
+
+    return {
+        'check': check[valid],
+        'update': update[valid],
+        'status': status[valid],
+        'ppg': ppg[valid],
+        'hr': hr[valid],
+        'spo2': spo2[valid],
+        'report_index': report_index[valid],
+        'sub_index': sub_index[valid],
+    }
+
+
+class TimestampReconstructor:
+    """
+    实时时间戳重建
+    以报告中最后一个样本的序号为自变量、主机接收时间为因变量，
+    增量维护最小二乘拟合 t = a + b*n (每个报告O(1))，
+    得到等间隔且随时钟漂移校正的样本时间。
+    接收时间偏离拟合超过 gap_threshold 秒(如USB中断丢包)时重新开始拟合。
+    拟合更新(包括从标称周期切换到拟合)可能使新样本的时间早于已输出的样本，
+    sample_times() 把样本间隔限制为不小于标称周期的 min_step_ratio 倍，保证时间单调递增。
+    """
+    def __init__(self, nominal_rate=NOMINAL_SAMPLE_RATE, min_reports=20, gap_threshold=0.5, min_step_ratio=0.5):
+        self.nominal_period = 1.0 / nominal_rate
+        self.min_reports = min_reports
+        self.gap_threshold = gap_threshold
+        self.min_step = self.nominal_period * min_step_ratio
+        self.last_time = None     # 最后输出的样本时间
+        self.resets = 0
+        self._reset()
+
+    def _reset(self):
+        # 以首个点为原点累加，避免大数相减损失精度
+        self.origin_index = None
+        self.origin_time = None
+        self.n = 0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+    def _fit(self):
+        """返回(截距, 斜率)，数据不足时使用标称采样周期"""
+        if self.n >= self.min_reports:
+            denominator = self.n * self.sum_xx - self.sum_x * self.sum_x
+            if denominator > 0:
+                slope = (self.n * self.sum_xy - self.sum_x * self.sum_y) / denominator
+                intercept = (self.sum_y - slope * self.sum_x) / self.n
+                return intercept, slope
+        # 数据不足时按标称周期，以平均接收时间为基准
+        return self.sum_y / self.n - self.nominal_period * self.sum_x / self.n, self.nominal_period
+
+    def add_report(self, arrival_time, last_sample_index):
+        """加入一个报告的接收时间及其最后一个样本的序号"""
+        if self.origin_index is not None and self.n >= self.min_reports:
+            predicted = self.predict(last_sample_index)
+            if abs(arrival_time - predicted) > self.gap_threshold:
+                self.resets += 1
+                self._reset()
+
+        if self.origin_index is None:
+            self.origin_index = last_sample_index
+            self.origin_time = arrival_time
+        x = float(last_sample_index - self.origin_index)
+        y = arrival_time - self.origin_time
+        self.n += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x * x
+        self.sum_xy += x * y
+
+    def predict(self, sample_index):
+        """按当前拟合计算样本时间，sample_index可以是numpy数组"""
+        intercept, slope = self._fit()
+        return self.origin_time + intercept + slope * (np.asarray(sample_index, dtype=np.float64) - self.origin_index)
+
+    def sample_times(self, sample_index):
+        """计算新样本的时间，每个样本比前一个输出的样本至少晚min_step秒"""
+        times = np.atleast_1d(self.predict(sample_index))
+        if self.last_time is not None and len(times):
+            # t'[k] = max(t[k], t'[k-1] + min_step)，减去 k*min_step 后即为累积最大值
+            steps = self.min_step * np.arange(1, len(times) + 1)
+            times = np.maximum.accumulate(np.maximum(times - steps, self.last_time)) + steps
+        if len(times):
+            self.last_time = float(times[-1])
+        return times
+
+    @property
+    def sample_rate(self):
+        """当前估计的实际采样率(Hz)"""
+        if self.n == 0:
+            return 1.0 / self.nominal_period
+        return 1.0 / self._fit()[1]
+
+
+def reconstruct_timestamps(arrival_times, last_sample_index, sample_index,
+                           nominal_rate=NOMINAL_SAMPLE_RATE, gap_threshold=0.5):
+    """
+    离线时间戳重建
+    arrival_times / last_sample_index: 每个报告的接收时间及其最后一个样本的序号
+    sample_index: 需要计算时间的样本序号
+    对整个会话做线性拟合，接收时间相对拟合出现超过gap_threshold的跳变时分段拟合
+    """
+    arrival_times = np.asarray(arrival_times, dtype=np.float64)
+    x = np.asarray(last_sample_index, dtype=np.float64)
+    sample_index = np.asarray(sample_index, dtype=np.float64)
+    if len(arrival_times) == 0:
+        return np.zeros(len(sample_index))
+
+    # 以标称周期估计的残差跳变位置作为分段边界
+    residual = arrival_times - x / nominal_rate
+    jumps = np.flatnonzero(np.abs(np.diff(residual)) > gap_threshold) + 1
+    bounds = np.concatenate(([0], jumps, [len(arrival_times)]))
+
+    result = np.empty(len(sample_index))
+    # 样本归属于第一个最后序号不小于它的报告所在的分段
+    owner = np.minimum(np.searchsorted(x, sample_index), len(x) - 1)
+    segment_of = np.searchsorted(bounds, owner, side='right') - 1
+    for segment, (begin, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        seg_x = x[begin:end]
+        seg_t = arrival_times[begin:end]
+        if len(seg_x) >= 2 and seg_x[-1] > seg_x[0]:
+            slope, intercept = np.polyfit(seg_x - seg_x[0], seg_t - seg_t[0], 1)
+        else:
+            slope, intercept = 1.0 / nominal_rate, 0.0
+        members = segment_of == segment
+        result[members] = seg_t[0] + intercept + slope * (sample_index[members] - seg_x[0])
+    return result
@@ -0,0 +1,231 @@
+import collections
+import os
+import select
+import socket
+import time
+
+'''
+带确认和重传的UDP命令通道。
+主机发送 SEQ,<通道号>,<序号>,<命令>，从机处理后回复 ACK,<通道号>,<序号>,<状态>。
+通道号在每次启动主机程序时随机生成，避免主机重启后序号重复被从机误判为重传。
+主机先向所有从机连续发出命令，再统一等待确认，超时未确认的从机单独重传，
+因此命令到达所有从机的时间只取决于网络，不随从机数量线性增长。
+从机按(发送方, 通道号, 序号)缓存已处理命令的回复，收到重传时直接重发确认而不重复执行。
+从机在命令执行完成后才回复确认，PREPARE/STOP 需要打开或关闭设备和文件，等待确认的时间比START长。
+不带SEQ前缀的命令仍按原方式处理，不回复确认。
+从机可以用主机名配置，发送前解析为IP地址，确认按来源地址对应回配置的名称。
+'''
+
+COMMAND_PREFIX = "SEQ"
+ACK_PREFIX = "ACK"
+STATUS_OK = "OK"
+STATUS_FAILED = "FAIL"
+
+# 各命令等待确认的时间(秒)，其余命令为 retry_interval * max_attempts
+COMMAND_TIMEOUTS = {'PREPARE': 5.0, 'STOP': 10.0}
+MAX_RETRY_INTERVAL = 1.0   # 超过max_attempts后重传间隔加倍，最长间隔
+
+
+def parse_sequenced_command(message):
+    """解析带序号的命令，返回(通道号, 序号, 命令)，不是带序号的命令时返回None"""
+    if not message.startswith(COMMAND_PREFIX + ","):
+        return None
+    parts = message.split(',', 3)
+    if len(parts) < 4:
+        raise ValueError(f"无效的序号命令: {message}")
+    return parts[1], int(parts[2]), parts[3]
+
+
+def make_ack(channel_id, seq, status):
+    return f"{ACK_PREFIX},{channel_id},{seq},{status}"
+
+
+class CommandDeduplicator:
+    """从机端的重复命令过滤，缓存最近处理过的命令的确认"""
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.replies = collections.OrderedDict()
+        self.duplicates = 0
+
+    def cached_reply(self, sender, channel_id, seq):
+        """已处理过的命令返回缓存的确认，否则返回None"""
+        reply = self.replies.get((sender, channel_id, seq))
+        if reply is not None:
+            self.duplicates += 1
+        return reply
+
+    def remember(self, sender, channel_id, seq, reply):
+        self.replies[(sender, channel_id, seq)] = reply
+        while len(self.replies) > self.capacity:
+            self.replies.popitem(last=False)
+
+
+class CommandResult:
+    """单个从机对一条命令的送达结果"""
+    __slots__ = ('ip', 'command', 'seq', 'status', 'attempts', 'sent_time', 'latency')
+
+    def __init__(self, ip, command, seq):
+        self.ip = ip
+        self.command = command
+        self.seq = seq
+        self.status = None       # 从机回复的状态，超时为None
+        self.attempts = 0
+        self.sent_time = None    # 第一次发送的时间
+        self.latency = None      # 第一次发送到收到确认的时间(秒)
+
+    @property
+    def acknowledged(self):
+        return self.status is not None
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+    def as_dict(self):
+        return {
+            'status': self.status,
+            'attempts': self.attempts,
+            'latency_ms': self.latency * 1000 if self.latency is not None else None,
+        }
+
+
+class CommandChannel:
+    """
+    主机端的命令分发
+    sock: 主机的UDP套接字，确认回复也从该套接字接收
+    retry_interval: 未收到确认时的重传间隔(秒)
+    max_attempts: 按retry_interval间隔发送的次数，未在timeouts中的命令发送这些次数后不再等待
+    timeouts: 各命令等待确认的时间，在此期间继续重传，间隔逐次加倍(不超过MAX_RETRY_INTERVAL)
+    metrics: 可选的MetricsRegistry，记录每条命令的确认延迟、重传和未确认次数
+    """
+    def __init__(self, sock, port=5000, retry_interval=0.05, max_attempts=5, timeouts=None, metrics=None):
+        self.socket = sock
+        self.port = port
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.timeouts = dict(COMMAND_TIMEOUTS if timeouts is None else timeouts)
+        self.metrics = metrics
+        self.channel_id = os.urandom(4).hex()
+        self._next_seq = 0
+        self._addresses = {}   # 从机名称(主机名或IP) -> 解析后的IP地址
+
+    def _resolve(self, ips):
+        """将从机名称解析为IP地址(每个名称只解析一次)，返回{名称: IP}，无法解析的名称不包含在内"""
+        addresses = {}
+        for ip in ips:
+            if ip not in self._addresses:
+                try:
+                    self._addresses[ip] = socket.gethostbyname(ip)
+                except OSError as e:
+                    print(f"无法解析从机地址 {ip}: {str(e)}")
+                    continue
+            addresses[ip] = self._addresses[ip]
+        return addresses
+
+    def send(self, ips, command):
+        """向所有从机发送命令并等待确认，返回 {ip: CommandResult}"""
+        self._next_seq += 1
+        seq = self._next_seq
+        message = f"{COMMAND_PREFIX},{self.channel_id},{seq},{command}".encode()
+        results = {ip: CommandResult(ip, command, seq) for ip in ips}
+        # 确认的来源是IP地址，按地址对应回配置的名称；无法解析的从机不发送，记为未确认
+        addresses = self._resolve(ips)
+        names = collections.defaultdict(list)
+        for ip, address in addresses.items():
+            names[address].append(ip)
+        pending = {ip: result for ip, result in results.items() if ip in addresses}
+        next_send = {}
+
+        # 丢弃之前超时后才到达的确认
+        self._drain()
+        send_start = time.perf_counter()
+
+        # 所有从机并发发送，之后统一等待确认
+        timeout = self.timeouts.get(command.split(',')[0], self.retry_interval * self.max_attempts)
+        deadline = time.monotonic() + timeout
+        while pending:
+            now = time.monotonic()
+            for ip, result in pending.items():
+                if next_send.get(ip, 0) <= now:
+                    try:
+                        self.socket.sendto(message, (addresses[ip], self.port))
+                    except OSError as e:
+                        print(f"发送命令到 {ip} 失败: {str(e)}")
+                    if result.sent_time is None:
+                        result.sent_time = time.perf_counter()
+                    result.attempts += 1
+                    next_send[ip] = now + self._retry_interval(result.attempts)
+
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait = min([next_send[ip] for ip in pending] + [deadline]) - now
+            for address, status in self._receive(max(wait, 0), seq):
+                for ip in names.get(address, []):
+                    result = pending.pop(ip, None)
+                    if result is not None:
+                        result.status = status
+                        result.latency = time.perf_counter() - result.sent_time
+        if self.metrics:
+            self._record(command, results, time.perf_counter() - send_start)
+        return results
+
+    def _retry_interval(self, attempts):
+        """第attempts次发送后到下次重传的间隔"""
+        if attempts < self.max_attempts:
+            return self.retry_interval
+        return min(self.retry_interval * 2 ** (attempts - self.max_attempts + 1), MAX_RETRY_INTERVAL)
+
+    def _record(self, command, results, elapsed):
+        """记录命令的送达统计"""
+        name = command.split(',')[0]
+        metrics = self.metrics
+        metrics.histogram(f"command.{name}.all_acked").add(elapsed)
+        ack_latency = metrics.histogram(f"command.{name}.ack")
+        for result in results.values():
+            if result.latency is not None:
+                ack_latency.add(result.latency)
+        metrics.counter("command.sent").add(sum(result.attempts for result in results.values()))
+        metrics.counter("command.retransmits").add(sum(max(result.attempts - 1, 0) for result in results.values()))
+        metrics.counter("command.unacked").add(sum(not result.acknowledged for result in results.values()))
+        metrics.counter("command.failed").add(sum(result.acknowledged and not result.ok for result in results.values()))
+
+    def _receive(self, timeout, seq):
+        """在timeout内接收确认，返回[(ip, 状态)]"""
+        acks = []
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            readable, _, _ = select.select([self.socket], [], [], max(remaining, 0))
+            if not readable:
+                return acks
+            try:
+                data, addr = self.socket.recvfrom(1024)
+            except ConnectionResetError:
+                # Windows上之前发往未运行从机程序的主机的数据报返回ICMP端口不可达，继续等待其他确认
+                continue
+            parts = data.decode(errors='replace').strip().split(',')
+            if (len(parts) == 4 and parts[0] == ACK_PREFIX and parts[1] == self.channel_id
+                    and parts[2] == str(seq)):
+                acks.append((addr[0], parts[3]))
+                # 收到确认后尽快返回，以便更新剩余从机的重传时间
+                end = time.monotonic()
+
+    def _drain(self):
+        while select.select([self.socket], [], [], 0)[0]:
+            try:
+                self.socket.recvfrom(1024)
+            except ConnectionResetError:
+                pass
+
+
+def format_results(results):
+    """将送达结果格式化为状态文本行"""
+    lines = []
+    for ip, result in results.items():
+        if result.acknowledged:
+            lines.append(f"{ip}: {result.command.split(',')[0]} {result.status}, "
+                         f"延迟 {result.latency * 1000:.2f}ms, 发送 {result.attempts} 次")
+        else:
+            lines.append(f"{ip}: {result.command.split(',')[0]} 未确认, 发送 {result.attempts} 次")
+    return lines
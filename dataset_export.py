@@ -0,0 +1,341 @@
+import argparse
+import collections
+import json
+import os
+import numpy as np
+from align_sessions import (read_sync_info, find_videos, video_files, find_oximeter_files, load_frame_times,
+                            load_oximeter_samples, slave_to_master_time, align_frames)
+from clock_sync import load_samples as load_clock_sync
+
+'''
+可随机访问的训练数据集导出。
+每个(视频, 生理数据文件)对导出为一个目录:
+    meta.json          帧尺寸、分块大小、压缩方式、来源等
+    frame_times.npy    每帧的主机时间戳(时间索引)
+    labels.npy         每帧对齐后的PPG/HR/SPO2/有效标记
+    samples.npy        原始采样率的生理数据(主机时间)
+    frames/00000.npy   按帧序号分块保存的缩小或裁剪后的帧，压缩时为.npz
+未压缩的文件都以numpy.memmap方式打开，读取任意时间窗口只需二分查找时间索引，
+再读取覆盖该窗口的帧分块，不需要读取整个文件或从头解码视频。
+'''
+
+LABEL_DTYPE = np.dtype([('ppg', '<f4'), ('hr', 'u1'), ('spo2', 'u1'), ('valid', 'u1')])
+SAMPLE_DTYPE = np.dtype([('timestamp', '<f8'), ('ppg', '<f4'), ('hr', 'u1'), ('spo2', 'u1')])
+COMPRESSIONS = ('none', 'zlib')
+
+
+def parse_size(text):
+    """解析 宽x高"""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_roi(text):
+    """解析 x,y,宽,高"""
+    x, y, width, height = (int(value) for value in text.split(','))
+    return x, y, width, height
+
+
+class ChunkWriter:
+    """把帧按固定帧数分块写入"""
+    def __init__(self, directory, chunk_frames, frame_shape, compression='none'):
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.buffer = np.empty((chunk_frames,) + frame_shape, dtype=np.uint8)
+        self.filled = 0
+        self.chunks = 0
+        self.frames = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, frame):
+        self.buffer[self.filled] = frame
+        self.filled += 1
+        self.frames += 1
+        if self.filled == self.chunk_frames:
+            self._flush()
+
+    def _flush(self):
+        if not self.filled:
+            return
+        chunk = self.buffer[:self.filled]
+        path = os.path.join(self.directory, f"{self.chunks:05d}")
+        if self.compression == 'zlib':
+            np.savez_compressed(path + ".npz", frames=chunk)
+        else:
+            np.save(path + ".npy", chunk)
+        self.chunks += 1
+        self.filled = 0
+
+    def close(self):
+        self._flush()
+
+
+def read_frames(video_paths, max_frames):
+    """按顺序读取一个或多个视频文件(分段录制的各分段)的帧，最多max_frames帧"""
+    import cv2
+    count = 0
+    for path in video_paths:
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise ValueError(f"无法打开视频: {path}")
+        try:
+            while count < max_frames:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                count += 1
+                yield frame
+        finally:
+            cap.release()
+        if count >= max_frames:
+            return
+
+
+def video_fps(video_path):
+    """返回视频文件的帧率"""
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    try:
+        return cap.get(cv2.CAP_PROP_FPS)
+    finally:
+        cap.release()
+
+
+def export_dataset(video_paths, frame_times, sample_times, ppg, hr, spo2, output_dir,
+                   size=None, roi=None, chunk_frames=256, compression='none', max_gap=0.1, source=None):
+    """
+    逐帧读取视频，裁剪/缩小后分块保存，并保存对齐后的标签和时间索引
+    video_paths: 视频文件路径，分段录制时为按顺序排列的分段列表
+    """
+    import cv2
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"未知的压缩方式: {compression}")
+    if isinstance(video_paths, str):
+        video_paths = [video_paths]
+    if not video_paths:
+        raise ValueError("没有视频文件")
+    os.makedirs(output_dir, exist_ok=True)
+
+    fps = video_fps(video_paths[0])
+    writer = None
+    try:
+        for frame in read_frames(video_paths, len(frame_times)):
+            if roi:
+                x, y, width, height = roi
+                frame = frame[y:y + height, x:x + width]
+            if size:
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            if writer is None:
+                writer = ChunkWriter(os.path.join(output_dir, "frames"), chunk_frames, frame.shape, compression)
+            writer.write(frame)
+    finally:
+        if writer:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"视频中没有帧: {video_paths[0]}")
+
+    # 视频实际帧数可能少于帧索引(如录制中断)，以两者较少的为准
+    frame_count = writer.frames
+    frame_times = np.asarray(frame_times[:frame_count], dtype=np.float64)
+    np.save(os.path.join(output_dir, "frame_times.npy"), frame_times)
+
+    frame_ppg, frame_hr, frame_spo2, valid = align_frames(frame_times, sample_times, ppg, hr, spo2, max_gap)
+    labels = np.empty(frame_count, dtype=LABEL_DTYPE)
+    labels['ppg'] = frame_ppg
+    labels['hr'] = frame_hr
+    labels['spo2'] = frame_spo2
+    labels['valid'] = valid
+    np.save(os.path.join(output_dir, "labels.npy"), labels)
+
+    order = np.argsort(sample_times, kind='stable')
+    samples = np.empty(len(order), dtype=SAMPLE_DTYPE)
+    samples['timestamp'] = sample_times[order]
+    samples['ppg'] = ppg[order]
+    samples['hr'] = hr[order]
+    samples['spo2'] = spo2[order]
+    np.save(os.path.join(output_dir, "samples.npy"), samples)
+
+    meta = {
+        'frame_count': frame_count,
+        'frame_shape': list(writer.buffer.shape[1:]),
+        'chunk_frames': chunk_frames,
+        'chunk_count': writer.chunks,
+        'compression': compression,
+        'fps': fps,
+        'size': list(size) if size else None,
+        'roi': list(roi) if roi else None,
+        'start_time': float(frame_times[0]),
+        'end_time': float(frame_times[-1]),
+        'valid_frames': int(valid.sum()),
+        'source': source or {'video': [os.path.basename(path) for path in video_paths]},
+    }
+    # 最后写入meta.json，作为导出完成的标记
+    with open(os.path.join(output_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def export_session(session_dir, oximeter_dirs, output_dir, **options):
+    """导出一个会话中所有(视频, 生理数据文件)对，已导出的跳过，返回数据集目录列表"""
+    session_id = os.path.basename(os.path.normpath(session_dir))
+    sync_info = read_sync_info(os.path.join(session_dir, "sync_info.txt"))
+    clock_sync_path = os.path.join(session_dir, "clock_sync.csv")
+    estimators = load_clock_sync(clock_sync_path) if os.path.exists(clock_sync_path) else {}
+
+    datasets = []
+    for oximeter_path in find_oximeter_files(oximeter_dirs, session_id):
+        slave_info = read_sync_info(os.path.join(os.path.dirname(oximeter_path), "sync_info.txt"))
+        times, ppg, hr, spo2 = load_oximeter_samples(oximeter_path)
+        if len(times) < 2:
+            continue
+        master_times, method = slave_to_master_time(times, slave_info, estimators)
+        oximeter_base = os.path.splitext(os.path.basename(oximeter_path))[0]
+
+        for base, video_path, index_path in find_videos(session_dir):
+            # 分段录制没有单一视频文件，按分段索引依次读取各分段
+            paths = video_files(video_path, index_path)
+            if not paths:
+                print(f"会话 {session_id} 的视频 {base} 没有视频文件或分段索引，跳过")
+                continue
+            dataset_dir = os.path.join(output_dir, f"{session_id}__{base}__{oximeter_base}")
+            if not os.path.exists(os.path.join(dataset_dir, "meta.json")):
+                export_dataset(paths, load_frame_times(video_path, index_path, sync_info),
+                               master_times, ppg, hr, spo2, dataset_dir,
+                               source={'session': session_id,
+                                       'video': os.path.basename(video_path) if video_path else
+                                       [os.path.basename(path) for path in paths],
+                                       'oximeter': os.path.basename(oximeter_path), 'alignment': method},
+                               **options)
+            datasets.append(dataset_dir)
+    return datasets
+
+
+class TrainingDataset:
+    """
+    导出数据集的随机访问接口
+    window(start, duration) 返回从数据集开始start秒起duration秒内的帧、时间、标签和原始样本
+    """
+    def __init__(self, path, cache_chunks=4):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.frame_times = np.load(os.path.join(path, "frame_times.npy"), mmap_mode='r')
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode='r')
+        self.samples = np.load(os.path.join(path, "samples.npy"), mmap_mode='r')
+        self.chunk_frames = self.meta['chunk_frames']
+        self.cache_chunks = cache_chunks
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return self.meta['frame_count']
+
+    @property
+    def start_time(self):
+        return self.meta['start_time']
+
+    @property
+    def duration(self):
+        return self.meta['end_time'] - self.meta['start_time']
+
+    def _chunk(self, number):
+        """读取一个帧分块，未压缩的分块以memmap方式打开"""
+        chunk = self._cache.get(number)
+        if chunk is not None:
+            self._cache.move_to_end(number)
+            return chunk
+        base = os.path.join(self.path, "frames", f"{number:05d}")
+        if self.meta['compression'] == 'zlib':
+            with np.load(base + ".npz") as data:
+                chunk = data['frames']
+        else:
+            chunk = np.load(base + ".npy", mmap_mode='r')
+        self._cache[number] = chunk
+        while len(self._cache) > self.cache_chunks:
+            self._cache.popitem(last=False)
+        return chunk
+
+    def frames(self, first, last):
+        """返回帧序号[first, last)的帧"""
+        first, last = max(first, 0), min(last, len(self))
+        shape = tuple(self.meta['frame_shape'])
+        result = np.empty((max(last - first, 0),) + shape, dtype=np.uint8)
+        position = first
+        while position < last:
+            number, offset = divmod(position, self.chunk_frames)
+            chunk = self._chunk(number)
+            count = min(last - position, len(chunk) - offset)
+            result[position - first:position - first + count] = chunk[offset:offset + count]
+            position += count
+        return result
+
+    def frame_range(self, start, duration):
+        """返回窗口内的帧序号范围[first, last)"""
+        t0 = self.start_time + start
+        first = int(np.searchsorted(self.frame_times, t0, side='left'))
+        last = int(np.searchsorted(self.frame_times, t0 + duration, side='left'))
+        return first, last
+
+    def window(self, start, duration, with_frames=True):
+        """返回时间窗口内的数据"""
+        first, last = self.frame_range(start, duration)
+        t0 = self.start_time + start
+        sample_first = int(np.searchsorted(self.samples['timestamp'], t0, side='left'))
+        sample_last = int(np.searchsorted(self.samples['timestamp'], t0 + duration, side='left'))
+        return {
+            'frames': self.frames(first, last) if with_frames else None,
+            'frame_times': np.array(self.frame_times[first:last]),
+            'labels': np.array(self.labels[first:last]),
+            'samples': np.array(self.samples[sample_first:sample_last]),
+        }
+
+    def random_window(self, duration, rng=None, with_frames=True):
+        """返回随机位置的时间窗口"""
+        rng = rng or np.random.default_rng()
+        start = rng.uniform(0, max(self.duration - duration, 0))
+        return self.window(start, duration, with_frames)
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='导出可随机访问的训练数据集')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='导出会话')
+    export_parser.add_argument('sessions', nargs='+', help='主机会话目录(experiment_data/<会话>)')
+    export_parser.add_argument('--oximeter-dir', action='append', required=True,
+                               help='从机数据目录(oximeter_data)，可指定多次')
+    export_parser.add_argument('--output', type=str, default='datasets', help='输出目录')
+    export_parser.add_argument('--size', type=parse_size, default=None, help='帧缩小到 宽x高，如 128x128')
+    export_parser.add_argument('--roi', type=parse_roi, default=None, help='先裁剪区域 x,y,宽,高')
+    export_parser.add_argument('--chunk-frames', type=int, default=256, help='每个分块的帧数')
+    export_parser.add_argument('--compression', choices=COMPRESSIONS, default='none',
+                               help='分块压缩方式，none可直接memmap，zlib体积更小但读取时需解压')
+    export_parser.add_argument('--max-gap', type=float, default=0.1,
+                               help='前后样本间隔超过该值(秒)的帧标记为无效')
+
+    info_parser = subparsers.add_parser('info', help='显示数据集信息')
+    info_parser.add_argument('datasets', nargs='+', help='数据集目录')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.command == 'export':
+        for session in args.sessions:
+            try:
+                datasets = export_session(session, args.oximeter_dir, args.output, size=args.size, roi=args.roi,
+                                          chunk_frames=args.chunk_frames, compression=args.compression,
+                                          max_gap=args.max_gap)
+                for path in datasets:
+                    print(f"已导出: {path}")
+            except Exception as e:
+                print(f"导出会话 {session} 失败: {str(e)}")
+
+    elif args.command == 'info':
+        for path in args.datasets:
+            dataset = TrainingDataset(path)
+            meta = dataset.meta
+            print(f"{path}: {meta['frame_count']} 帧 {tuple(meta['frame_shape'])}, 时长 {dataset.duration:.2f}秒, "
+                  f"有效 {meta['valid_frames']} 帧, {meta['chunk_count']} 个分块({meta['compression']})")
@@ -0,0 +1,122 @@
+import json
+import os
+import select
+import socket
+import time
+
+'''
+局域网从机发现。
+主机在命令端口上广播 DISCOVER,<编号>，每个从机回复 HELLO,<编号>,<JSON>，
+JSON中包含主机名、血氧仪设备状态、剩余磁盘空间、程序版本和采集状态。
+主机用一个套接字在截止时间内并发接收所有回复，整个网段的发现时间只取决于截止时间。
+SlaveRegistry 记录每个从机最后一次回复的时间，超过max_age未回复的从机被移除。
+'''
+
+DISCOVER_REQUEST = "DISCOVER"
+DISCOVER_REPLY = "HELLO"
+
+
+def make_discover_reply(command, info):
+    """从机根据DISCOVER命令生成回复"""
+    parts = command.split(',')
+    if len(parts) < 2:
+        raise ValueError(f"无效的发现命令: {command}")
+    return f"{DISCOVER_REPLY},{parts[1]},{json.dumps(info, ensure_ascii=False)}"
+
+
+class DiscoveryClient:
+    """
+    主机端的从机发现
+    targets: 发送查询的地址，默认为局域网广播，也可以是子网广播地址或单个IP
+    timeout: 等待回复的截止时间(秒)
+    """
+    def __init__(self, port=5000, targets=('<broadcast>',), timeout=0.5):
+        self.port = port
+        self.targets = list(targets)
+        self.timeout = timeout
+
+    def discover(self):
+        """发送查询并收集截止时间前的所有回复，返回 {ip: 信息}"""
+        request_id = os.urandom(4).hex()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        replies = {}
+        try:
+            sent_time = time.perf_counter()
+            for target in self.targets:
+                try:
+                    sock.sendto(f"{DISCOVER_REQUEST},{request_id}".encode(), (target, self.port))
+                except OSError as e:
+                    print(f"发送发现请求到 {target} 失败: {str(e)}")
+
+            deadline = time.monotonic() + self.timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if not readable:
+                    break
+                data, addr = sock.recvfrom(4096)
+                parts = data.decode(errors='replace').split(',', 2)
+                if len(parts) != 3 or parts[0] != DISCOVER_REPLY or parts[1] != request_id:
+                    continue
+                try:
+                    info = json.loads(parts[2])
+                except ValueError:
+                    continue
+                info['latency'] = time.perf_counter() - sent_time
+                replies[addr[0]] = info
+        finally:
+            sock.close()
+        return replies
+
+
+class SlaveRegistry:
+    """已发现的从机，超过max_age秒未回复的从机自动移除"""
+    def __init__(self, max_age=60.0):
+        self.max_age = max_age
+        self.slaves = {}  # ip -> (最后回复时间, 信息)
+
+    def update(self, replies, now=None):
+        """记录一次发现的回复，返回被移除的过期从机"""
+        now = time.monotonic() if now is None else now
+        for ip, info in replies.items():
+            self.slaves[ip] = (now, info)
+        return self.expire(now)
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        stale = [ip for ip, (seen, _) in self.slaves.items() if now - seen > self.max_age]
+        for ip in stale:
+            del self.slaves[ip]
+        return stale
+
+    def ips(self):
+        """按IP排序的从机列表"""
+        return sorted(self.slaves, key=_ip_sort_key)
+
+    def info(self, ip):
+        return self.slaves[ip][1]
+
+    def age(self, ip, now=None):
+        now = time.monotonic() if now is None else now
+        return now - self.slaves[ip][0]
+
+
+def _ip_sort_key(ip):
+    try:
+        return tuple(int(part) for part in ip.split('.'))
+    except ValueError:
+        return (ip,)
+
+
+def format_slave(ip, info):
+    """将从机信息格式化为一行文本"""
+    free_gb = info.get('disk_free', 0) / 1024 ** 3
+    text = (f"{ip} {info.get('hostname', '?')} 设备:{info.get('device', '?')} "
+            f"状态:{info.get('state', '?')} 剩余空间:{free_gb:.1f}GB 版本:{info.get('version', '?')}")
+    # 采集中的从机附带每个设备的在线分析结果
+    for quality in info.get('quality') or []:
+        text += f" [HR {quality.get('hr_peak', 0):.0f} {quality.get('quality', '')}]"
+    return text
@@ -0,0 +1,387 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import write_summary
+
+'''
+会话结束后从机数据文件的TCP批量传输。
+- 从机运行 TransferServer: LIST 按主机会话编号列出已完成会话的文件(大小和SHA-256)，
+  GET 从指定偏移发送文件内容(socket.sendfile，Linux上为零拷贝的os.sendfile)
+- 主机 pull_session() 并行连接所有从机，下载到主机会话目录下的 oximeter/<从机IP>/<从机会话>/，
+  未完成的文件保存为 .part，再次收集时从已下载的位置续传，完成后校验SHA-256
+- 传输中定期报告进度和吞吐量，结果写入 oximeter/transfer.json
+'''
+
+TRANSFER_PORT = 5002
+BUFFER_SIZE = 1 << 20           # 读写缓冲(1MiB)
+PART_EXTENSION = ".part"
+TRANSFER_DIR = "oximeter"       # 主机会话目录下保存从机数据的子目录
+TRANSFER_SUMMARY = "transfer.json"
+
+
+def file_checksum(path, buffer_size=BUFFER_SIZE):
+    """计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_line(sock_file):
+    line = sock_file.readline(65536)
+    if not line:
+        raise ConnectionError("连接已关闭")
+    status, _, value = line.decode('utf-8').rstrip('\n').partition(',')
+    if status != "OK":
+        raise RuntimeError(value or "未知错误")
+    return value
+
+
+class _TransferHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.transfer
+        while True:
+            line = self.rfile.readline(65536)
+            if not line:
+                return
+            parts = line.decode('utf-8', errors='replace').rstrip('\n').split(',')
+            try:
+                if parts[0] == "LIST" and len(parts) == 2:
+                    body = json.dumps(server.list_session(parts[1]), ensure_ascii=False)
+                    self.wfile.write(f"OK,{body}\n".encode('utf-8'))
+                elif parts[0] == "GET" and len(parts) == 4:
+                    path = server.file_path(parts[1], parts[2])
+                    offset = int(parts[3])
+                    size = os.path.getsize(path)
+                    if not 0 <= offset <= size:
+                        raise ValueError(f"偏移超出文件大小: {offset}")
+                    self.wfile.write(f"OK,{size - offset}\n".encode('utf-8'))
+                    self.wfile.flush()
+                    with open(path, 'rb') as f:
+                        sent = self.request.sendfile(f, offset, size - offset)
+                    server.add_sent(sent)
+                else:
+                    raise ValueError(f"未知请求: {parts[0]}")
+            except (OSError, ValueError) as e:
+                try:
+                    self.wfile.write(f"ERR,{str(e)}\n".encode('utf-8'))
+                except OSError:
+                    return
+            self.wfile.flush()
+
+
+class _TransferTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class TransferServer:
+    """
+    从机数据文件服务
+    data_dir: 从机数据目录(oximeter_data)
+    busy: 返回正在采集的会话目录(不提供下载)的函数
+    """
+    def __init__(self, data_dir, port=TRANSFER_PORT, host='0.0.0.0', busy=None):
+        self.data_dir = os.path.abspath(data_dir)
+        self.busy = busy or (lambda: None)
+        self.checksums = {}   # 路径 -> (大小, 修改时间, SHA-256)
+        self.sent_bytes = 0
+        self.lock = threading.Lock()
+        self.server = _TransferTCPServer((host, port), _TransferHandler)
+        self.server.transfer = self
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_sent(self, count):
+        with self.lock:
+            self.sent_bytes += count
+
+    def _session_dirs(self, master_session):
+        """返回属于该主机会话的从机会话目录(按session.json或数据文件名匹配)，不包括正在采集的会话"""
+        from session_catalog import SESSION_FILE
+        busy = self.busy()
+        busy = os.path.abspath(busy) if busy else None
+        prefix = f"oxygen_data_{master_session}"
+        sessions = []
+        for entry in sorted(os.scandir(self.data_dir), key=lambda entry: entry.name):
+            if not entry.is_dir() or entry.path == busy:
+                continue
+            try:
+                with open(os.path.join(entry.path, SESSION_FILE), 'r', encoding='utf-8') as f:
+                    matched = json.load(f).get('master_session') == master_session
+            except (OSError, ValueError):
+                matched = any(name.startswith(prefix) for name in os.listdir(entry.path))
+            if matched:
+                sessions.append(entry.path)
+        return sessions
+
+    def _checksum(self, path):
+        stat = os.stat(path)
+        cached = self.checksums.get(path)
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        digest = file_checksum(path)
+        self.checksums[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def list_session(self, master_session):
+        """列出主机会话对应的从机会话和文件"""
+        sessions = []
+        for session_dir in self._session_dirs(master_session):
+            files = []
+            for entry in sorted(os.scandir(session_dir), key=lambda entry: entry.name):
+                if entry.is_file() and not entry.name.endswith(('.tmp', PART_EXTENSION)):
+                    files.append({'name': entry.name, 'size': entry.stat().st_size,
+                                  'sha256': self._checksum(entry.path)})
+            sessions.append({'session': os.path.basename(session_dir), 'files': files})
+        return {'hostname': socket.gethostname(), 'sessions': sessions}
+
+    def file_path(self, session, name):
+        """返回数据目录中会话文件的路径，拒绝目录之外的路径和正在采集的会话"""
+        if not session or not name or any(sep in session + name for sep in ('/', '\\')) \
+                or session in ('.', '..') or name in ('.', '..'):
+            raise ValueError("无效的文件名")
+        session_dir = os.path.join(self.data_dir, session)
+        busy = self.busy()
+        if busy and os.path.abspath(busy) == session_dir:
+            raise ValueError("会话正在采集")
+        path = os.path.join(session_dir, name)
+        if not os.path.isfile(path):
+            raise ValueError(f"文件不存在: {session}/{name}")
+        return path
+
+
+class TransferProgress:
+    """汇总所有从机的传输进度"""
+    def __init__(self, ips):
+        self.start = time.monotonic()
+        self.total = {ip: 0 for ip in ips}
+        self.received = {ip: 0 for ip in ips}
+        self.finished = set()
+        self.lock = threading.Lock()
+
+    def add_total(self, ip, count):
+        with self.lock:
+            self.total[ip] += count
+
+    def add(self, ip, count):
+        with self.lock:
+            self.received[ip] += count
+
+    def finish(self, ip):
+        with self.lock:
+            self.finished.add(ip)
+
+    def snapshot(self):
+        with self.lock:
+            received = sum(self.received.values())
+            total = sum(self.total.values())
+            finished = len(self.finished)
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return {'received': received, 'total': total, 'finished': finished, 'slaves': len(self.total),
+                'elapsed': elapsed, 'throughput': received / elapsed}
+
+
+def format_progress(progress):
+    """进度文本"""
+    return (f"已传输 {progress['received'] / 1e6:.1f}/{progress['total'] / 1e6:.1f}MB, "
+            f"{progress['throughput'] / 1e6:.1f}MB/s, 完成 {progress['finished']}/{progress['slaves']} 个从机")
+
+
+def _download_file(ip, port, session, entry, directory, progress, timeout, retries):
+    """下载一个文件，已有的 .part 文件从末尾续传，返回(接收字节数, 续传字节数, 是否跳过)"""
+    path = os.path.join(directory, entry['name'])
+    part_path = path + PART_EXTENSION
+    # 已下载或续传的部分不计入本次传输量
+    if os.path.exists(path) and os.path.getsize(path) == entry['size'] and file_checksum(path) == entry['sha256']:
+        progress.add_total(ip, -entry['size'])
+        return 0, 0, True
+
+    received = 0
+    resumed = 0
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > entry['size']:
+            os.remove(part_path)
+            offset = 0
+        digest = hashlib.sha256()
+        if offset:
+            # 续传时先计算已下载部分的校验
+            with open(part_path, 'rb') as f:
+                while True:
+                    chunk = f.read(BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            if attempt == 0:
+                resumed = offset
+                progress.add_total(ip, -offset)
+        try:
+            with socket.create_connection((ip, port), timeout=timeout) as sock:
+                # 响应头不经缓冲读取，之后的文件内容直接recv_into到大缓冲区
+                sock_file = sock.makefile('rb', buffering=0)
+                sock.sendall(f"GET,{session},{entry['name']},{offset}\n".encode('utf-8'))
+                remaining = int(_read_line(sock_file))
+                view = memoryview(bytearray(BUFFER_SIZE))
+                with open(part_path, 'ab', buffering=BUFFER_SIZE) as f:
+                    while remaining > 0:
+                        count = sock.recv_into(view, min(remaining, BUFFER_SIZE))
+                        if not count:
+                            raise ConnectionError("传输中断")
+                        f.write(view[:count])
+                        digest.update(view[:count])
+                        remaining -= count
+                        received += count
+                        progress.add(ip, count)
+        except (OSError, ConnectionError) as e:
+            if attempt == retries:
+                raise
+            print(f"{ip}: {entry['name']} 传输中断，续传 ({str(e)})")
+            continue
+        if digest.hexdigest() == entry['sha256']:
+            os.replace(part_path, path)
+            return received, resumed, False
+        # 校验失败时丢弃已下载的部分重新传输
+        os.remove(part_path)
+        progress.add_total(ip, entry['size'])
+        print(f"{ip}: {entry['name']} 校验失败，重新传输")
+    raise RuntimeError(f"{entry['name']} 多次校验失败")
+
+
+def pull_slave(ip, master_session, dest_dir, port=TRANSFER_PORT, progress=None, timeout=10.0, retries=3):
+    """从一个从机下载该主机会话的所有文件，返回传输统计"""
+    progress = progress or TransferProgress([ip])
+    start = time.monotonic()
+    stats = {'ip': ip, 'sessions': [], 'files': 0, 'skipped_files': 0, 'bytes': 0, 'resumed_bytes': 0,
+             'seconds': 0.0, 'throughput': 0.0, 'error': None}
+    try:
+        with socket.create_connection((ip, port), timeout=timeout) as sock:
+            sock_file = sock.makefile('rb')
+            sock.sendall(f"LIST,{master_session}\n".encode('utf-8'))
+            listing = json.loads(_read_line(sock_file))
+        for session in listing['sessions']:
+            progress.add_total(ip, sum(entry['size'] for entry in session['files']))
+        for session in listing['sessions']:
+            directory = os.path.join(dest_dir, ip, session['session'])
+            os.makedirs(directory, exist_ok=True)
+            stats['sessions'].append(session['session'])
+            for entry in session['files']:
+                received, resumed, skipped = _download_file(ip, port, session['session'], entry, directory,
+                                                            progress, timeout, retries)
+                stats['files'] += 1
+                stats['skipped_files'] += int(skipped)
+                stats['bytes'] += received
+                stats['resumed_bytes'] += resumed
+        if not listing['sessions']:
+            stats['error'] = "从机上没有该会话的数据"
+    except Exception as e:
+        stats['error'] = str(e)
+    stats['seconds'] = time.monotonic() - start
+    stats['throughput'] = stats['bytes'] / max(stats['seconds'], 1e-9)
+    progress.finish(ip)
+    return stats
+
+
+def pull_session(ips, session_dir, port=TRANSFER_PORT, workers=16, on_progress=None, progress_interval=1.0,
+                 timeout=10.0, retries=3):
+    """
+    并行从所有从机收集该主机会话的数据到 <会话目录>/oximeter/，返回 {ip: 传输统计}
+    on_progress: 定期以进度字典调用，默认打印
+    """
+    master_session = os.path.basename(os.path.normpath(session_dir))
+    dest_dir = os.path.join(session_dir, TRANSFER_DIR)
+    os.makedirs(dest_dir, exist_ok=True)
+    progress = TransferProgress(ips)
+    on_progress = on_progress or (lambda snapshot: print(format_progress(snapshot)))
+
+    done = threading.Event()
+    def report():
+        while not done.wait(progress_interval):
+            on_progress(progress.snapshot())
+    reporter = threading.Thread(target=report, daemon=True)
+    reporter.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ips)))) as pool:
+            results = list(pool.map(lambda ip: pull_slave(ip, master_session, dest_dir, port, progress,
+                                                          timeout, retries), ips))
+    finally:
+        done.set()
+        reporter.join()
+    summary = progress.snapshot()
+    on_progress(summary)
+
+    results = {stats['ip']: stats for stats in results}
+    write_summary(os.path.join(dest_dir, TRANSFER_SUMMARY), {
+        'session_id': master_session,
+        'time': time.time(),
+        'bytes': summary['received'],
+        'seconds': summary['elapsed'],
+        'throughput': summary['throughput'],
+        'slaves': results,
+    })
+    return results
+
+
+def format_transfer(stats):
+    """单个从机的传输结果文本"""
+    if stats['error']:
+        return f"{stats['ip']}: 收集失败 ({stats['error']})"
+    return (f"{stats['ip']}: {stats['files']} 个文件 (跳过 {stats['skipped_files']}), "
+            f"{stats['bytes'] / 1e6:.1f}MB, 续传 {stats['resumed_bytes'] / 1e6:.1f}MB, "
+            f"{stats['throughput'] / 1e6:.1f}MB/s")
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='从机数据文件传输')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='在从机上提供数据文件(采集程序已自动启动时不需要)')
+    serve.add_argument('--data-dir', type=str, default='oximeter_data', help='从机数据目录')
+    serve.add_argument('--port', type=int, default=TRANSFER_PORT, help='TCP端口')
+    serve.add_argument('--host', type=str, default='0.0.0.0', help='监听地址')
+
+    pull = subparsers.add_parser('pull', help='从所有从机收集一个会话的数据')
+    pull.add_argument('session_dir', help='主机会话目录(experiment_data/<会话>)')
+    pull.add_argument('--slaves', type=str, nargs='+', required=True, help='从机IP列表')
+    pull.add_argument('--port', type=int, default=TRANSFER_PORT, help='TCP端口')
+    pull.add_argument('--workers', type=int, default=16, help='同时连接的从机数')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.command == 'serve':
+        server = TransferServer(args.data_dir, args.port, args.host).start()
+        print(f"数据传输服务已启动: {args.host}:{server.port}, 目录 {server.data_dir}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.stop()
+    else:
+        results = pull_session(args.slaves, args.session_dir, args.port, args.workers)
+        for stats in results.values():
+            print(format_transfer(stats))
+        failed = [ip for ip, stats in results.items() if stats['error']]
+        raise SystemExit(1 if failed else 0)
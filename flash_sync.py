@@ -0,0 +1,223 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from align_sessions import read_sync_info, find_videos, video_files, load_frame_times, find_sessions
+
+'''
+屏幕闪烁同步标记。
+- 主机开始录制后由Tk定时器切换全屏窗口的颜色(不阻塞界面)，每次切换后记录显示时间到 flash_markers.csv
+- 离线检测: 分块读取视频，向量化计算每帧平均亮度，找出亮/暗跳变，按跨越跳变的帧已切换的比例得到亚帧精度的跳变时间，
+  与记录的显示时间配对，得到视频时间相对屏幕显示时间的偏差(包括显示、曝光和采集的延迟)
+- 多个会话用进程池并行处理，结果写入会话目录下的 flash_sync.txt
+'''
+
+FLASH_SEQUENCE = ('white', 'black') * 3   # 依次显示的颜色
+FLASH_INTERVAL_MS = 200                   # 每种颜色的显示时间(毫秒)
+MARKER_FILE = "flash_markers.csv"
+MARKER_HEADER = ['序号', '颜色', '系统时间', '单调时钟']
+RESULT_FILE = "flash_sync.txt"
+
+
+class FlashMarkerLog:
+    """记录每次闪烁颜色切换的显示时间"""
+    def __init__(self):
+        self.markers = []
+
+    def add(self, color):
+        self.markers.append((len(self.markers), color, time.time(), time.monotonic()))
+
+    def save(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(MARKER_HEADER)
+            writer.writerows(self.markers)
+
+
+def load_markers(path):
+    """读取闪烁标记，返回(系统时间数组, 是否变亮数组)"""
+    times, rising = [], []
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            times.append(float(row[2]))
+            rising.append(row[1] == 'white')
+    return np.array(times), np.array(rising, dtype=bool)
+
+
+def frame_brightness(paths, max_frames=None, chunk_frames=64, step=4):
+    """分块读取视频帧，按step间隔取像素计算每帧平均亮度"""
+    import cv2
+    values = []
+    total = 0
+    for path in paths:
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise ValueError(f"无法打开视频: {path}")
+        try:
+            chunk = None
+            while max_frames is None or total < max_frames:
+                count = 0
+                while count < chunk_frames and (max_frames is None or total + count < max_frames):
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    sampled = frame[::step, ::step]
+                    if chunk is None:
+                        chunk = np.empty((chunk_frames,) + sampled.shape, dtype=np.uint8)
+                    chunk[count] = sampled
+                    count += 1
+                if count:
+                    values.append(chunk[:count].reshape(count, -1).mean(axis=1))
+                    total += count
+                if count < chunk_frames:
+                    break
+        finally:
+            cap.release()
+        if max_frames is not None and total >= max_frames:
+            break
+    return np.concatenate(values) if values else np.zeros(0)
+
+
+def detect_transitions(brightness, frame_times, threshold=0.25):
+    """
+    找出亮度跳变，返回(跳变时间数组, 是否变亮数组)
+    threshold: 跳变幅度占亮度范围的比例；曝光跨越跳变时连续几帧同向变化，合并为一次跳变
+    """
+    brightness = np.asarray(brightness, dtype=np.float64)
+    frame_times = np.asarray(frame_times[:len(brightness)], dtype=np.float64)
+    brightness = brightness[:len(frame_times)]
+    if len(brightness) < 3:
+        return np.zeros(0), np.zeros(0, dtype=bool)
+    low, high = np.percentile(brightness, [1, 99])
+    if high - low <= 0:
+        return np.zeros(0), np.zeros(0, dtype=bool)
+    diff = np.diff(brightness)
+    direction = np.where(diff > (high - low) * threshold * 0.5, 1, np.where(diff < -(high - low) * threshold * 0.5, -1, 0))
+
+    # 同向的连续变化合并为一段: [starts[k], ends[k]] 为帧间变化的下标范围
+    changes = np.flatnonzero(np.diff(np.concatenate(([0], direction, [0]))))
+    starts, ends = changes[:-1], changes[1:] - 1
+    keep = direction[starts] != 0
+    starts, ends = starts[keep], ends[keep]
+
+    # 曝光跨越切换的帧可能在段的任一端，前后亮度取段外一帧
+    before = brightness[np.maximum(starts - 1, 0)]
+    after = brightness[np.minimum(ends + 2, len(brightness) - 1)]
+    keep = np.abs(after - before) >= (high - low) * threshold
+    starts, ends, before, after = starts[keep], ends[keep], before[keep], after[keep]
+    if not len(starts):
+        return np.zeros(0), np.zeros(0, dtype=bool)
+
+    # 按曝光时间等于帧间隔估计屏幕切换的时刻: 段内每帧已切换的比例f_k(亮度在前后之间的位置)，
+    # 切换时刻 = 段前一帧的时间 + 帧间隔 * sum(1 - f_k)，帧时间为曝光结束的时间
+    rising = after > before
+    frame_interval = np.median(np.diff(frame_times))
+    first = np.maximum(starts - 1, 0)
+    offsets = np.arange(1, (ends - first).max() + 3)
+    positions = first[:, None] + offsets[None, :]
+    inside = positions <= (ends + 1)[:, None]
+    values = brightness[np.minimum(positions, len(brightness) - 1)]
+    fraction = np.clip((values - before[:, None]) / (after - before)[:, None], 0.0, 1.0)
+    times = frame_times[first] + frame_interval * np.where(inside, 1.0 - fraction, 0.0).sum(axis=1)
+    return times, rising
+
+
+def match_markers(transition_times, transition_rising, marker_times, marker_rising, tolerance=0.05):
+    """
+    把检测到的跳变与记录的显示时间配对，返回(偏差, 配对数, 残差标准差)
+    偏差 = 视频中的跳变时间 - 记录的显示时间；先按同向配对的所有候选偏差投票，再取配对残差的中位数
+    """
+    if not len(transition_times) or not len(marker_times):
+        return None, 0, None
+    same = transition_rising[:, None] == marker_rising[None, :]
+    candidates = (transition_times[:, None] - marker_times[None, :])[same]
+
+    def matched(offset):
+        error = transition_times[:, None] - marker_times[None, :] - offset
+        error = np.where(same, np.abs(error), np.inf)
+        best = error.min(axis=0)
+        return best <= tolerance, error.argmin(axis=0)
+
+    votes = [matched(offset)[0].sum() for offset in candidates]
+    offset = candidates[int(np.argmax(votes))]
+    ok, nearest = matched(offset)
+    residuals = transition_times[nearest[ok]] - marker_times[ok]
+    offset = float(np.median(residuals))
+    spread = float(np.std(residuals - offset)) if ok.sum() > 1 else 0.0
+    return offset, int(ok.sum()), spread
+
+
+def sync_session(session_dir, scan_seconds=10.0, chunk_frames=64, step=4):
+    """检测一个会话中每个视频的闪烁标记，写入flash_sync.txt，返回摘要文本行"""
+    session_id = os.path.basename(os.path.normpath(session_dir))
+    sync_info = read_sync_info(os.path.join(session_dir, "sync_info.txt"))
+    marker_path = os.path.join(session_dir, MARKER_FILE)
+    if os.path.exists(marker_path):
+        marker_times, marker_rising = load_markers(marker_path)
+    else:
+        marker_times, marker_rising = np.zeros(0), np.zeros(0, dtype=bool)
+
+    lines = [f"会话: {session_id}", f"闪烁标记数: {len(marker_times)}"]
+    for base, video_path, index_path in find_videos(session_dir):
+        paths = video_files(video_path, index_path)
+        if not paths:
+            continue
+        frame_times = load_frame_times(paths[0] if video_path else None, index_path, sync_info)
+        if len(frame_times) < 2:
+            continue
+        frame_interval = float(np.median(np.diff(frame_times)))
+        # 只扫描开始一段时间(闪烁在开始录制后立即显示)
+        max_frames = int(scan_seconds / frame_interval) + 1 if scan_seconds else None
+        brightness = frame_brightness(paths, max_frames, chunk_frames, step)
+        times, rising = detect_transitions(brightness, frame_times)
+        offset, matched, spread = match_markers(times, rising, marker_times, marker_rising,
+                                                tolerance=max(frame_interval, 0.05))
+        lines.append(f"{base} 检测到跳变: {len(times)}")
+        if offset is None or not matched:
+            lines.append(f"{base} 闪烁偏差: 未能配对")
+            continue
+        lines.append(f"{base} 闪烁偏差: {offset:.6f}秒 ({offset / frame_interval:.2f}帧)")
+        lines.append(f"{base} 配对数: {matched}/{len(marker_times)}, 残差标准差: {spread * 1000:.2f}ms")
+
+    with open(os.path.join(session_dir, RESULT_FILE), 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    return lines
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='检测视频中的屏幕闪烁标记，计算视频与同步时间戳的偏差')
+    parser.add_argument('experiment_dir', help='主机数据目录(experiment_data)或单个会话目录')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='并行处理的进程数')
+    parser.add_argument('--scan-seconds', type=float, default=10.0, help='只扫描视频开始的秒数，0为整个视频')
+    parser.add_argument('--chunk-frames', type=int, default=64, help='每次读取的帧数')
+    parser.add_argument('--step', type=int, default=4, help='计算亮度时的像素间隔')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if os.path.isfile(os.path.join(args.experiment_dir, "sync_info.txt")):
+        sessions = [args.experiment_dir]
+    else:
+        sessions = find_sessions(args.experiment_dir)
+    print(f"共 {len(sessions)} 个会话")
+
+    start = time.time()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(sync_session, session, args.scan_seconds, args.chunk_frames, args.step): session
+                   for session in sessions}
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                print("\n".join(future.result()))
+            except Exception as e:
+                failed += 1
+                print(f"会话 {os.path.basename(session)} 检测失败: {str(e)}")
+    print(f"完成 {len(sessions) - failed} 个会话，失败 {failed} 个，用时 {time.time() - start:.1f}秒")
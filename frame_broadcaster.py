@@ -0,0 +1,273 @@
+import math
+import threading
+import time
+import numpy as np
+from video_pipeline import StageTimer
+
+'''
+摄像头帧分发。
+FrameBroadcaster 独占摄像头，以摄像头原生帧率把帧读入预分配的环形缓冲，
+预览、录制、实时质量检查等订阅者直接读取环形缓冲中的帧(不复制)。
+
+订阅模式:
+- all: 按顺序获取每一帧，落后超过环形缓冲容量时跳过被覆盖的帧并计为丢帧
+- latest: 只获取最新的一帧，跳过的帧不计为丢帧(适用于预览)
+
+订阅者通过 get() 取得的帧在 release() 之前不会被覆盖，读线程会跳过被占用的缓冲。
+'''
+
+
+class BroadcastFrame:
+    """环形缓冲中的一帧，image为缓冲本身(不复制)"""
+    __slots__ = ('seq', 'slot', 'image', 'wall_time', 'monotonic_time', 'camera_pos')
+
+    def __init__(self, seq, slot, image, wall_time, monotonic_time, camera_pos):
+        self.seq = seq
+        self.slot = slot
+        self.image = image
+        self.wall_time = wall_time
+        self.monotonic_time = monotonic_time
+        self.camera_pos = camera_pos
+
+
+class Subscription:
+    """一个订阅者的读取位置与统计"""
+    def __init__(self, broadcaster, name, mode):
+        self.broadcaster = broadcaster
+        self.name = name
+        self.mode = mode
+        self.next_seq = broadcaster.latest_seq + 1
+        self.closed = False
+
+        # 统计
+        self.received = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.max_lag = 0
+
+    def get(self, timeout=None):
+        """等待并返回下一帧(已占用，用完须release)，超时或订阅关闭时返回None"""
+        return self.broadcaster._get(self, timeout)
+
+    def release(self, frame):
+        """释放帧，允许读线程覆盖该缓冲"""
+        self.broadcaster._release(frame)
+
+    @property
+    def lag(self):
+        """尚未读取的帧数"""
+        return max(0, self.broadcaster.latest_seq - self.next_seq + 1)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'mode': self.mode,
+            'received': self.received,
+            'dropped': self.dropped,
+            'skipped': self.skipped,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+        }
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+class FrameBroadcaster:
+    """
+    独占摄像头的读帧线程
+    cap: cv2.VideoCapture 或具有相同read(image)接口的对象
+    frame_shape: 帧形状(高, 宽, 通道)
+    position_getter: 可选，返回摄像头报告的当前位置(毫秒)
+    """
+    def __init__(self, cap, frame_shape, ring_size=64, position_getter=None):
+        # 摄像头
+        self.cap = cap
+        self.frame_shape = frame_shape
+        self.position_getter = position_getter
+
+        # 环形缓冲及每个缓冲的帧信息
+        self.ring_size = ring_size
+        self.buffers = [np.empty(frame_shape, dtype=np.uint8) for _ in range(ring_size)]
+        self.slot_seq = [-1] * ring_size
+        self.slot_wall = [0.0] * ring_size
+        self.slot_monotonic = [0.0] * ring_size
+        self.slot_pos = [math.nan] * ring_size
+        self.pins = [0] * ring_size
+        self.seq_to_slot = {}
+        self.latest_seq = -1
+        self._next_slot = 0
+
+        # 订阅者
+        self.subscriptions = []
+        self.condition = threading.Condition()
+
+        # 统计
+        self.read_failures = 0
+        self.pinned_skips = 0
+        self.overruns = 0
+        self.capture_timer = StageTimer()
+        self.first_frame_time = None
+        self.last_frame_time = None
+
+        # 线程控制
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        """启动读帧线程"""
+        if self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """停止读帧线程，唤醒所有等待中的订阅者"""
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=timeout)
+
+    def subscribe(self, name, mode='all'):
+        """添加订阅者，mode为 all 或 latest"""
+        if mode not in ('all', 'latest'):
+            raise ValueError(f"未知的订阅模式: {mode}")
+        with self.condition:
+            subscription = Subscription(self, name, mode)
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            subscription.closed = True
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            self.condition.notify_all()
+
+    def _take_slot(self):
+        """选择下一个可写缓冲，跳过订阅者正在使用的缓冲"""
+        for _ in range(self.ring_size):
+            slot = self._next_slot
+            self._next_slot = (self._next_slot + 1) % self.ring_size
+            if self.pins[slot] == 0:
+                return slot
+            self.pinned_skips += 1
+        return None
+
+    def _read_loop(self):
+        """读帧线程：以摄像头原生帧率读入环形缓冲"""
+        while self.running:
+            with self.condition:
+                slot = self._take_slot()
+                if slot is not None:
+                    # 该缓冲即将被覆盖
+                    self.seq_to_slot.pop(self.slot_seq[slot], None)
+                    self.slot_seq[slot] = -1
+
+            read_start = time.perf_counter()
+            if slot is None:
+                # 所有缓冲都被占用，读出并丢弃该帧
+                self.overruns += 1
+                if not self.cap.grab():
+                    self.read_failures += 1
+                    time.sleep(0.005)
+                continue
+
+            buffer = self.buffers[slot]
+            ret, frame = self.cap.read(buffer)
+            monotonic_time = time.monotonic()
+            wall_time = time.time()
+            self.capture_timer.add(time.perf_counter() - read_start)
+            if not ret:
+                self.read_failures += 1
+                time.sleep(0.005)
+                continue
+            if frame is not buffer:
+                # 摄像头没有直接写入预分配缓冲时复制，分辨率不一致的帧无法分发
+                if frame.shape != buffer.shape:
+                    self.read_failures += 1
+                    continue
+                buffer[...] = frame
+
+            camera_pos = math.nan
+            if self.position_getter:
+                camera_pos = self.position_getter()
+                if camera_pos is None or camera_pos <= 0:
+                    camera_pos = math.nan
+
+            with self.condition:
+                self.latest_seq += 1
+                self.slot_seq[slot] = self.latest_seq
+                self.slot_wall[slot] = wall_time
+                self.slot_monotonic[slot] = monotonic_time
+                self.slot_pos[slot] = camera_pos
+                self.seq_to_slot[self.latest_seq] = slot
+                if self.first_frame_time is None:
+                    self.first_frame_time = wall_time
+                self.last_frame_time = wall_time
+                self.condition.notify_all()
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def _get(self, subscription, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if subscription.closed:
+                    return None
+                if subscription.mode == 'latest' and self.latest_seq >= subscription.next_seq:
+                    subscription.skipped += self.latest_seq - subscription.next_seq
+                    subscription.next_seq = self.latest_seq
+
+                # 落后太多的帧已被覆盖
+                if self.latest_seq - subscription.next_seq >= self.ring_size:
+                    oldest = self.latest_seq - self.ring_size + 1
+                    subscription.dropped += oldest - subscription.next_seq
+                    subscription.next_seq = oldest
+                while subscription.next_seq <= self.latest_seq and subscription.next_seq not in self.seq_to_slot:
+                    subscription.dropped += 1
+                    subscription.next_seq += 1
+
+                if subscription.next_seq <= self.latest_seq:
+                    lag = self.latest_seq - subscription.next_seq + 1
+                    if lag > subscription.max_lag:
+                        subscription.max_lag = lag
+                    seq = subscription.next_seq
+                    slot = self.seq_to_slot[seq]
+                    self.pins[slot] += 1
+                    subscription.next_seq += 1
+                    subscription.received += 1
+                    return BroadcastFrame(seq, slot, self.buffers[slot], self.slot_wall[slot],
+                                          self.slot_monotonic[slot], self.slot_pos[slot])
+
+                if not self.running:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def _release(self, frame):
+        with self.condition:
+            self.pins[frame.slot] -= 1
+
+    def stats(self):
+        """返回读帧统计及各订阅者的延迟与丢帧"""
+        duration = 0.0
+        if self.first_frame_time is not None and self.last_frame_time is not None:
+            duration = self.last_frame_time - self.first_frame_time
+        with self.condition:
+            subscriptions = [subscription.stats() for subscription in self.subscriptions]
+        return {
+            'frames': self.latest_seq + 1,
+            'read_failures': self.read_failures,
+            'overruns': self.overruns,
+            'pinned_skips': self.pinned_skips,
+            'ring_size': self.ring_size,
+            'fps': self.latest_seq / duration if duration > 0 else 0.0,
+            'capture': self.capture_timer.summary(),
+            'subscriptions': subscriptions,
+        }
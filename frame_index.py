@@ -0,0 +1,100 @@
+import os
+import struct
+import numpy as np
+
+'''
+视频逐帧时间索引(.fidx)。
+与视频文件同名的二进制附属文件，每帧一条定长记录:
+    帧序号(u4), 单调时钟采集时间(f8), 系统时间(f8), 摄像头报告的位置(f8, 毫秒, 无则为NaN)
+FrameIndex 以 numpy.memmap 读取，可按时间二分查找帧序号，或按帧序号取时间。
+'''
+
+FRAME_INDEX_MAGIC = b'FRIDX001'
+FRAME_INDEX_EXTENSION = '.fidx'
+FRAME_RECORD_STRUCT = struct.Struct('<Iddd')
+FRAME_RECORD_DTYPE = np.dtype([
+    ('frame', '<u4'),
+    ('monotonic', '<f8'),
+    ('wall', '<f8'),
+    ('camera_pos', '<f8'),
+])
+assert FRAME_RECORD_DTYPE.itemsize == FRAME_RECORD_STRUCT.size
+
+
+def frame_index_path(video_path):
+    """返回视频对应的帧索引文件路径"""
+    return os.path.splitext(video_path)[0] + FRAME_INDEX_EXTENSION
+
+
+class FrameIndexWriter:
+    """逐帧追加时间记录"""
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.file = open(path, 'wb')
+        self.file.write(FRAME_INDEX_MAGIC)
+
+    def write(self, frame, monotonic_time, wall_time, camera_pos=float('nan')):
+        self.file.write(FRAME_RECORD_STRUCT.pack(frame, monotonic_time, wall_time, camera_pos))
+        self.count += 1
+
+    def close(self):
+        """刷新并强制写入磁盘后关闭"""
+        if self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class FrameIndexGroup:
+    """把同一组帧时间写入多个帧索引(如ROI视频和同时录制的低分辨率整帧视频)"""
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, frame, monotonic_time, wall_time, camera_pos=float('nan')):
+        for writer in self.writers:
+            writer.write(frame, monotonic_time, wall_time, camera_pos)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class FrameIndex:
+    """帧时间索引读取接口"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(FRAME_INDEX_MAGIC)) != FRAME_INDEX_MAGIC:
+                raise ValueError(f"不是帧索引文件: {path}")
+        count = (os.path.getsize(path) - len(FRAME_INDEX_MAGIC)) // FRAME_RECORD_DTYPE.itemsize
+        if count:
+            self.records = np.memmap(path, dtype=FRAME_RECORD_DTYPE, mode='r',
+                                     offset=len(FRAME_INDEX_MAGIC), shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=FRAME_RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def times(self, clock='wall'):
+        """返回所有帧的时间，clock为 wall / monotonic / camera_pos"""
+        return self.records[clock]
+
+    def time_of(self, frame, clock='wall'):
+        """按帧序号取时间，frame可以是numpy数组"""
+        return self.records[clock][frame]
+
+    def frame_at(self, t, clock='wall'):
+        """返回时间t时正在显示的帧(采集时间不晚于t的最后一帧)，早于第一帧时返回0"""
+        position = np.searchsorted(self.records[clock], t, side='right') - 1
+        return np.maximum(position, 0)
+
+    def nearest_frame(self, t, clock='wall'):
+        """返回采集时间与t最接近的帧"""
+        times = self.records[clock]
+        position = np.clip(np.searchsorted(times, t), 1, max(len(times) - 1, 1))
+        before = times[position - 1]
+        after = times[np.minimum(position, len(times) - 1)]
+        return np.where(np.abs(np.asarray(t) - before) <= np.abs(after - np.asarray(t)), position - 1, position)
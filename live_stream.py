@@ -0,0 +1,248 @@
+import math
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+'''
+从机到主机的实时PPG数据流。
+从机每解码一批报告就把样本打包成一个UDP数据包发给主机:
+    包头: 标识(4s) 设备号(u1) 包序号(u4) 第一个样本序号(u4) 样本数(u2)
+    样本: 时间戳(f8) PPG(u1) HR(u1) SPO2(u1)，每个11字节
+发送套接字为非阻塞，发送缓冲满时直接丢弃该包并计数，不会阻塞采集线程。
+从机开启信号分析时每秒另发一个分析结果包:
+    标识(4s) 设备号(u1) 时间戳(f8) 峰值HR(f4) 频谱HR(f4) 质量标记(u2)
+主机端 LiveAggregator 为每个从机设备维护定长的numpy环形缓冲，按包序号统计丢包，
+界面按固定的最高刷新率从环形缓冲读取最近的波形。
+'''
+
+LIVE_MAGIC = b'OXL1'
+LIVE_PORT = 5001
+PACKET_HEADER = struct.Struct('<4sBIIH')
+SAMPLE_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('ppg', 'u1'),
+    ('hr', 'u1'),
+    ('spo2', 'u1'),
+])
+MAX_SAMPLES_PER_PACKET = 120  # 1300字节左右，不超过以太网MTU
+QUALITY_MAGIC = b'OXQ1'
+QUALITY_PACKET = struct.Struct('<4sBdffH')
+
+
+def encode_packet(device, seq, first_index, timestamps, ppg, hr, spo2):
+    """把一批样本编码为数据包"""
+    samples = np.empty(len(timestamps), dtype=SAMPLE_DTYPE)
+    samples['timestamp'] = timestamps
+    samples['ppg'] = ppg
+    samples['hr'] = hr
+    samples['spo2'] = spo2
+    return PACKET_HEADER.pack(LIVE_MAGIC, device, seq, first_index, len(samples)) + samples.tobytes()
+
+
+def decode_packet(data):
+    """解码数据包，返回(设备号, 包序号, 第一个样本序号, 样本数组)，不是实时数据包时返回None"""
+    if len(data) < PACKET_HEADER.size:
+        return None
+    magic, device, seq, first_index, count = PACKET_HEADER.unpack_from(data)
+    if magic != LIVE_MAGIC or len(data) != PACKET_HEADER.size + count * SAMPLE_DTYPE.itemsize:
+        return None
+    samples = np.frombuffer(data, dtype=SAMPLE_DTYPE, offset=PACKET_HEADER.size, count=count)
+    return device, seq, first_index, samples
+
+
+def encode_quality_packet(device, timestamp, hr_peak, hr_spectral, flags):
+    """把信号分析结果编码为数据包"""
+    return QUALITY_PACKET.pack(QUALITY_MAGIC, device, timestamp or 0.0, hr_peak, hr_spectral, flags)
+
+
+def decode_quality_packet(data):
+    """解码分析结果包，返回(设备号, 结果字典)，不是分析结果包时返回None"""
+    if len(data) != QUALITY_PACKET.size:
+        return None
+    magic, device, timestamp, hr_peak, hr_spectral, flags = QUALITY_PACKET.unpack(data)
+    if magic != QUALITY_MAGIC:
+        return None
+    return device, {'timestamp': timestamp, 'hr_peak': hr_peak, 'hr_spectral': hr_spectral, 'flags': flags}
+
+
+class LiveStreamSender:
+    """从机端的实时数据发送，发送失败时丢弃，不阻塞调用方"""
+    def __init__(self, host, port=LIVE_PORT, device=0):
+        self.address = (host, port)
+        self.device = device
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.seq = 0
+
+        # 统计
+        self.sent_packets = 0
+        self.dropped_packets = 0
+        self.sent_samples = 0
+
+    def send(self, first_index, timestamps, ppg, hr, spo2):
+        """发送一批样本，过大的批次拆分为多个包"""
+        for start in range(0, len(timestamps), MAX_SAMPLES_PER_PACKET):
+            end = start + MAX_SAMPLES_PER_PACKET
+            packet = encode_packet(self.device, self.seq, first_index + start,
+                                   timestamps[start:end], ppg[start:end], hr[start:end], spo2[start:end])
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            try:
+                self.socket.sendto(packet, self.address)
+                self.sent_packets += 1
+                self.sent_samples += min(end, len(timestamps)) - start
+            except OSError:
+                # 发送缓冲已满或网络不可达
+                self.dropped_packets += 1
+
+    def send_quality(self, latest):
+        """发送最新的信号分析结果(SignalAnalyzer.latest())"""
+        packet = encode_quality_packet(self.device, latest['timestamp'], latest['hr_peak'],
+                                       latest['hr_spectral'], latest['flags'])
+        try:
+            self.socket.sendto(packet, self.address)
+            self.sent_packets += 1
+        except OSError:
+            self.dropped_packets += 1
+
+    def stats(self):
+        return {
+            'sent_packets': self.sent_packets,
+            'dropped_packets': self.dropped_packets,
+            'sent_samples': self.sent_samples,
+        }
+
+    def close(self):
+        self.socket.close()
+
+
+class DeviceRing:
+    """单个设备的定长环形缓冲"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.samples = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self.count = 0            # 累计写入的样本数
+        self.next_seq = None      # 期望的下一个包序号
+        self.packets = 0
+        self.lost_packets = 0
+        self.last_receive = None  # 最后收到数据的time.monotonic()
+        self.quality = None       # 最近一次的信号分析结果
+
+    def add(self, seq, samples):
+        if self.next_seq is not None and seq != self.next_seq:
+            gap = (seq - self.next_seq) & 0xFFFFFFFF
+            # 序号回退说明从机重新开始采集，否则计为丢包
+            if gap < 0x80000000:
+                self.lost_packets += gap
+        self.next_seq = (seq + 1) & 0xFFFFFFFF
+        self.packets += 1
+        self.last_receive = time.monotonic()
+
+        samples = samples[-self.capacity:]
+        position = self.count % self.capacity
+        first = min(len(samples), self.capacity - position)
+        self.samples[position:position + first] = samples[:first]
+        self.samples[:len(samples) - first] = samples[first:]
+        self.count += len(samples)
+
+    def recent(self, n):
+        """按时间顺序返回最近n个样本的副本"""
+        n = min(n, self.count, self.capacity)
+        end = self.count % self.capacity
+        if n <= end:
+            return self.samples[end - n:end].copy()
+        return np.concatenate((self.samples[self.capacity - (n - end):], self.samples[:end]))
+
+
+class LiveAggregator:
+    """
+    主机端的实时数据接收
+    capacity: 每个设备环形缓冲的样本数
+    """
+    def __init__(self, port=LIVE_PORT, capacity=60 * 60, bind_host='0.0.0.0'):
+        self.port = port
+        self.capacity = capacity
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.socket.bind((bind_host, port))
+        self.socket.settimeout(0.5)
+        self.rings = {}  # (ip, 设备号) -> DeviceRing
+        self.lock = threading.Lock()
+        self.invalid_packets = 0
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self._thread.start()
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data, addr = self.socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            packet = decode_packet(data)
+            if packet is None:
+                quality = decode_quality_packet(data)
+                if quality is None:
+                    self.invalid_packets += 1
+                else:
+                    with self.lock:
+                        ring = self.rings.get((addr[0], quality[0]))
+                        if ring:
+                            ring.quality = quality[1]
+                continue
+            device, seq, _, samples = packet
+            key = (addr[0], device)
+            with self.lock:
+                ring = self.rings.get(key)
+                if ring is None:
+                    ring = self.rings[key] = DeviceRing(self.capacity)
+                ring.add(seq, samples)
+
+    def devices(self):
+        with self.lock:
+            return sorted(self.rings)
+
+    def snapshot(self, key, n):
+        """返回设备最近n个样本及状态"""
+        with self.lock:
+            ring = self.rings[key]
+            samples = ring.recent(n)
+            age = time.monotonic() - ring.last_receive if ring.last_receive else math.inf
+            return samples, {
+                'samples': ring.count,
+                'packets': ring.packets,
+                'lost_packets': ring.lost_packets,
+                'age': age,
+                'quality': ring.quality,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.rings = {}
+
+    def stop(self):
+        self.running = False
+        if self._thread:
+            self._thread.join(timeout=1)
+        self.socket.close()
+
+
+def signal_status(samples, age, stale_after=2.0):
+    """根据最近的样本判断信号状态，用于提示指夹脱落等问题"""
+    if age > stale_after:
+        return "无数据"
+    if len(samples) == 0:
+        return "等待数据"
+    ppg = samples['ppg'].astype(np.float32)
+    if ppg.max() - ppg.min() < 3:
+        return "波形平坦"
+    if samples['spo2'][-1] == 0 or samples['hr'][-1] == 0:
+        return "无读数"
+    return "正常"
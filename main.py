@@ -1,4 +1,3 @@
-import cv2
 import socket
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
@@ -7,7 +6,15 @@ import time
 import os
 import datetime
 import numpy as np
-from PIL import Image, ImageTk
+from video_pipeline import format_stats
+from clock_sync import ClockSyncMonitor, format_result
+from command_channel import CommandChannel, format_results
+from discovery import DiscoveryClient, SlaveRegistry, format_slave
+from live_stream import LiveAggregator, signal_status, LIVE_PORT
+from signal_quality import format_flags
+from metrics import MetricsRegistry, start_metrics_server, write_summary, SUMMARY_FILE, MASTER_STATS_PORT
+from session_catalog import write_session_file, master_metadata, index_session
+from file_transfer import TRANSFER_PORT
 
 class DataCollectionSystem:
     """
@@ -22,25 +29,81 @@ class DataCollectionSystem:
         
         # 变量初始化
         self.camera_index = 0
+        self.camera_sources = []      # 摄像头索引或视频文件路径
+        self.cameras = []             # 每路摄像头的CameraRecorder/CameraProcess
         self.is_recording = False
         self.is_previewing = False
         self.session_id = None
         self.cap = None
-        self.out = None
+        self.broadcaster = None       # 第一路摄像头的读帧线程，预览和录制都从这里取帧
         self.preview_thread = None
-        self.record_thread = None
+        self.preview_fps = 15         # 预览帧率
+        self.preview_size = (640, 480)  # 预览分辨率
+        self.preview_frame = None     # 最新的待显示预览帧(RGB)
+        self.preview_pending = False  # 是否已调度主线程显示预览帧
+        self.preview_photo = None
+        self.preview_item = None
+        self.frame_ring_size = 64     # 读帧环形缓冲的帧数
+        self.segment_seconds = 0      # 视频分段时长(秒)，0为不分段
+        self.roi = None               # 人脸区域录制参数，None为录制整帧
+        self.roi_full_scale = 0.25    # 人脸区域录制时同时保存的整帧视频的缩放比例
         self.client_ips = []
+        self.clock_sync = None        # 与从机的时钟同步测量
+        self.sync_interval = 10.0     # 录制中时钟同步的间隔(秒)
+        self.sync_rounds = 8          # 每轮同步请求数
         self.start_time = None
         self.experiment_duration = 1  # 默认录制时长(分钟)
         self.data_dir = os.path.join(os.getcwd(), "experiment_data")
         
+        # 运行时指标
+        self.metrics = MetricsRegistry()
+        self.camera_live_stats = []   # 各路摄像头最近一次的读帧/编码状态(由计时器更新)
+        self.command_log = {}         # 本次会话每条命令的送达结果
+        
         # UDP设置
         self.udp_port = 5000
+        self.transfer_port = TRANSFER_PORT  # 从机数据文件传输端口(TCP)
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.command_channel = CommandChannel(self.udp_socket, self.udp_port, metrics=self.metrics)
+        self.command_lock = threading.Lock()  # 后台线程中的命令按顺序使用同一个套接字
+        self.slave_states = {}        # 每个从机最近一条命令的送达结果
+        
+        # 从机发现
+        self.discovery_targets = ['<broadcast>']  # 发现请求的目标地址
+        self.discovery_timeout = 0.5              # 等待回复的截止时间(秒)
+        self.discovery_interval = 15000           # 自动刷新间隔(毫秒)
+        self.slave_registry = SlaveRegistry(max_age=60.0)
+        self.is_scanning = False
+        
+        # 实时生理数据(从机以 --live-stream 启动时发送)
+        self.live_port = LIVE_PORT
+        self.live_refresh_ms = 200     # 实时波形最高刷新间隔(毫秒)
+        self.live_window = 300         # 显示最近的样本数(60Hz下5秒)
+        self.live_max_rows = 8         # 最多显示的设备数
+        self.live_items = {}           # 每个设备的画布元素
+        try:
+            self.live_aggregator = LiveAggregator(self.live_port)
+            self.live_aggregator.start()
+        except OSError as e:
+            print(f"实时数据端口 {self.live_port} 不可用: {str(e)}")
+            self.live_aggregator = None
+        
+        # 本机统计接口(GET http://127.0.0.1:8700/stats)
+        self.metrics.gauge("recording", lambda: {
+            'is_recording': self.is_recording,
+            'session_id': self.session_id,
+            'elapsed': time.time() - self.start_time if self.is_recording and self.start_time else 0.0,
+            'cameras': self.camera_live_stats,
+        })
+        self.metrics.gauge("slaves", lambda: {ip: result.as_dict() for ip, result in self.slave_states.items()})
+        self.metrics.gauge("live_stream", self.live_stream_stats)
+        self.stats_port = MASTER_STATS_PORT
+        self.metrics_server = start_metrics_server(self.metrics.snapshot, self.stats_port)
         
         # 创建UI
         self.create_ui()
+        self.update_live_panel()
         
         # 确保数据目录存在
         if not os.path.exists(self.data_dir):
@@ -60,17 +123,33 @@ class DataCollectionSystem:
         self.preview_canvas = tk.Canvas(left_frame, bg="black", width=640, height=480)
         self.preview_canvas.pack(padx=5, pady=5, fill=tk.BOTH, expand=True)
         
+        # 实时生理信号
+        self.live_canvas = tk.Canvas(left_frame, bg="black", height=120)
+        self.live_canvas.pack(padx=5, pady=5, fill=tk.X)
+        
         # 摄像头控制按钮
         camera_control_frame = ttk.Frame(left_frame)
         camera_control_frame.pack(fill=tk.X, padx=5, pady=5)
         
         ttk.Label(camera_control_frame, text="摄像头索引:").pack(side=tk.LEFT)
         self.camera_index_var = tk.StringVar(value="0")
-        ttk.Entry(camera_control_frame, textvariable=self.camera_index_var, width=5).pack(side=tk.LEFT, padx=5)
+        ttk.Entry(camera_control_frame, textvariable=self.camera_index_var, width=8).pack(side=tk.LEFT, padx=5)
+        
+        # 多路摄像头时，第一路之外的摄像头在独立进程中采集和编码
+        self.camera_process_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(camera_control_frame, text="多进程", variable=self.camera_process_var).pack(side=tk.LEFT)
         
         self.preview_btn = ttk.Button(camera_control_frame, text="开始预览", command=self.toggle_preview)
         self.preview_btn.pack(side=tk.LEFT, padx=5)
         
+        ttk.Label(camera_control_frame, text="预览帧率:").pack(side=tk.LEFT)
+        self.preview_fps_var = tk.StringVar(value=str(self.preview_fps))
+        ttk.Entry(camera_control_frame, textvariable=self.preview_fps_var, width=4).pack(side=tk.LEFT, padx=5)
+        
+        ttk.Label(camera_control_frame, text="预览分辨率:").pack(side=tk.LEFT)
+        self.preview_size_var = tk.StringVar(value=f"{self.preview_size[0]}x{self.preview_size[1]}")
+        ttk.Entry(camera_control_frame, textvariable=self.preview_size_var, width=9).pack(side=tk.LEFT, padx=5)
+        
         # 右侧：录制控制和设置
         right_frame = ttk.Frame(main_frame)
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, padx=5, pady=5)
@@ -89,6 +168,28 @@ class DataCollectionSystem:
         self.video_filename_var = tk.StringVar(value="video.mp4")
         ttk.Entry(settings_frame, textvariable=self.video_filename_var, width=20).grid(row=1, column=1, padx=5, pady=5, columnspan=2, sticky=tk.W)
         
+        # 时间文字叠加(默认关闭，逐帧时间保存在帧索引文件中)
+        self.overlay_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(settings_frame, text="在画面上叠加时间文字", variable=self.overlay_var).grid(row=3, column=0, columnspan=3, padx=5, pady=5, sticky=tk.W)
+        
+        # 视频分段(崩溃时只损失最后一段，已完成的分段可在录制中并行处理)
+        ttk.Label(settings_frame, text="视频分段(秒, 0为不分段):").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
+        self.segment_var = tk.StringVar(value="0")
+        ttk.Entry(settings_frame, textvariable=self.segment_var, width=10).grid(row=4, column=1, padx=5, pady=5)
+        
+        # 人脸区域录制(只编码裁剪后的人脸区域，降低编码和写盘开销)
+        self.roi_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(settings_frame, text="只录制人脸区域, 输出尺寸:", variable=self.roi_var).grid(row=5, column=0, padx=5, pady=5, sticky=tk.W)
+        self.roi_size_var = tk.StringVar(value="256x256")
+        ttk.Entry(settings_frame, textvariable=self.roi_size_var, width=10).grid(row=5, column=1, padx=5, pady=5)
+        self.roi_full_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(settings_frame, text="同时保存低分辨率整帧", variable=self.roi_full_var).grid(row=5, column=2, padx=5, pady=5, sticky=tk.W)
+        # 人脸检测模型(空为程序目录下 models/ 中的YuNet模型)
+        ttk.Label(settings_frame, text="人脸检测模型(空为默认):").grid(row=6, column=0, padx=5, pady=5, sticky=tk.W)
+        self.roi_model_var = tk.StringVar(value="")
+        ttk.Entry(settings_frame, textvariable=self.roi_model_var, width=30).grid(row=6, column=1, padx=5, pady=5)
+        ttk.Button(settings_frame, text="浏览...", command=self.browse_roi_model).grid(row=6, column=2, padx=5, pady=5)
+        
         # 保存路径设置
         ttk.Label(settings_frame, text="数据保存路径:").grid(row=2, column=0, padx=5, pady=5, sticky=tk.W)
         self.save_path_var = tk.StringVar(value=self.data_dir)
@@ -104,7 +205,23 @@ class DataCollectionSystem:
         self.ip_text.pack(fill=tk.X, padx=5, pady=5)
         self.ip_text.insert(tk.END, "192.168.1.2\n192.168.1.3")
         
-        ttk.Button(ip_frame, text="扫描局域网设备", command=self.scan_network).pack(padx=5, pady=5)
+        scan_frame = ttk.Frame(ip_frame)
+        scan_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(scan_frame, text="扫描局域网设备", command=self.scan_network).pack(side=tk.LEFT, padx=5)
+        self.auto_scan_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(scan_frame, text="自动刷新", variable=self.auto_scan_var,
+                        command=self.auto_scan).pack(side=tk.LEFT, padx=5)
+        
+        # 从机状态：最近一条命令是否确认及延迟
+        slave_frame = ttk.LabelFrame(right_frame, text="从机状态")
+        slave_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        columns = ("ip", "state", "latency", "attempts")
+        self.slave_tree = ttk.Treeview(slave_frame, columns=columns, show="headings", height=4)
+        for column, heading, width in zip(columns, ("从机", "状态", "延迟(ms)", "发送次数"), (110, 90, 70, 60)):
+            self.slave_tree.heading(column, text=heading)
+            self.slave_tree.column(column, width=width, anchor=tk.CENTER)
+        self.slave_tree.pack(fill=tk.X, padx=5, pady=5)
         
         # 录制控制区域
         control_frame = ttk.LabelFrame(right_frame, text="录制控制")
@@ -119,6 +236,10 @@ class DataCollectionSystem:
         self.stop_btn = ttk.Button(control_frame, text="停止录制", command=self.stop_experiment, state=tk.DISABLED)
         self.stop_btn.pack(fill=tk.X, padx=5, pady=5)
         
+        # 停止后并行从所有从机收集本次会话的数据文件
+        self.collect_btn = ttk.Button(control_frame, text="收集从机数据", command=self.collect_slave_data, state=tk.DISABLED)
+        self.collect_btn.pack(fill=tk.X, padx=5, pady=5)
+        
         # 状态显示
         status_frame = ttk.LabelFrame(right_frame, text="状态")
         status_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -128,6 +249,10 @@ class DataCollectionSystem:
         
         self.timer_var = tk.StringVar(value="00:00")
         ttk.Label(status_frame, textvariable=self.timer_var, font=("Arial", 24)).pack(padx=5, pady=5)
+        
+        # 各路摄像头的实际帧率
+        self.camera_fps_var = tk.StringVar(value="")
+        ttk.Label(status_frame, textvariable=self.camera_fps_var, justify=tk.LEFT).pack(padx=5, pady=5)
     
     def browse_save_path(self):
         """选择数据保存路径"""
@@ -136,6 +261,12 @@ class DataCollectionSystem:
             self.save_path_var.set(directory)
             self.data_dir = directory
     
+    def browse_roi_model(self):
+        """选择人脸检测模型文件"""
+        path = filedialog.askopenfilename(filetypes=[("人脸检测模型", "*.onnx *.xml"), ("所有文件", "*.*")])
+        if path:
+            self.roi_model_var.set(path)
+    
     def toggle_preview(self):
         """切换摄像头预览状态"""
         if self.is_previewing:
@@ -146,12 +277,16 @@ class DataCollectionSystem:
     def start_preview(self):
         """开始摄像头预览"""
         try:
-            camera_idx = int(self.camera_index_var.get())
-            self.cap = cv2.VideoCapture(camera_idx)
+            # 预览参数
+            self.preview_fps = float(self.preview_fps_var.get())
+            if self.preview_fps <= 0:
+                raise ValueError("预览帧率必须大于0")
+            width, height = self.preview_size_var.get().lower().split("x")
+            self.preview_size = (int(width), int(height))
             
-            if not self.cap.isOpened():
-                messagebox.showerror("错误", f"无法打开摄像头 {camera_idx}")
-                return
+            self.open_cameras()
+            if not self.broadcaster:
+                raise ValueError("第一路摄像头不在本进程中，无法预览")
             
             self.is_previewing = True
             self.preview_btn.config(text="停止预览")
@@ -165,49 +300,148 @@ class DataCollectionSystem:
         """停止摄像头预览"""
         self.is_previewing = False
         self.preview_btn.config(text="开始预览")
-        if self.cap:
-            self.cap.release()
-            self.cap = None
+        self.release_camera()
+    
+    def open_cameras(self, sources=None, use_process=None):
+        """按配置打开所有摄像头并启动读帧线程，配置未变且已打开时直接返回"""
+        # 摄像头模块依赖cv2，用到时才导入以加快启动
+        from camera_recorder import parse_camera_sources, open_cameras
+        if sources is None:
+            sources = parse_camera_sources(self.camera_index_var.get())
+        if use_process is None:
+            use_process = self.camera_process_var.get()
+        if self.cameras and all(camera.is_open for camera in self.cameras):
+            # 预览中不切换摄像头配置
+            if sources == self.camera_sources or self.is_previewing:
+                return
+        self.release_camera(force=True)
+        
+        cameras = open_cameras(sources, use_process, self.frame_ring_size)
+        
+        self.camera_sources = sources
+        self.cameras = cameras
+        self.broadcaster = cameras[0].broadcaster
+        self.cap = cameras[0].cap
+    
+    def release_camera(self, force=False):
+        """预览和录制都已停止时释放所有摄像头"""
+        if not force and (self.is_previewing or self.is_recording):
+            return
+        for camera in self.cameras:
+            camera.close()
+        self.cameras = []
+        self.camera_sources = []
+        self.broadcaster = None
+        self.cap = None
     
     def update_preview(self):
-        """更新摄像头预览画面"""
-        while self.is_previewing:
-            ret, frame = self.cap.read()
-            if ret:
-                # 转换为tkinter可用的格式
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                img = Image.fromarray(frame_rgb)
-                
-                # 调整尺寸以适应画布
-                canvas_width = self.preview_canvas.winfo_width()
-                canvas_height = self.preview_canvas.winfo_height()
-                
-                if canvas_width > 1 and canvas_height > 1:
-                    img = img.resize((canvas_width, canvas_height), Image.LANCZOS)
+        """预览线程：以latest模式订阅帧，按预览帧率缩小后交给Tk主线程显示"""
+        import cv2
+        subscription = self.broadcaster.subscribe("preview", mode="latest")
+        interval = 1.0 / self.preview_fps
+        next_preview = time.perf_counter()
+        try:
+            while self.is_previewing:
+                # 预览不需要每一帧，等到下一次预览时刻再取最新帧
+                delay = next_preview - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_preview = max(next_preview + interval, time.perf_counter())
                 
-                photo = ImageTk.PhotoImage(image=img)
+                frame = subscription.get(timeout=0.5)
+                if frame is None:
+                    if subscription.closed or not self.broadcaster or not self.broadcaster.running:
+                        break
+                    continue
+                try:
+                    small = cv2.resize(frame.image, self.preview_size, interpolation=cv2.INTER_NEAREST)
+                finally:
+                    subscription.release(frame)
+                self.preview_frame = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
                 
-                # 更新画布
-                self.preview_canvas.create_image(0, 0, image=photo, anchor=tk.NW)
-                self.preview_canvas.image = photo  # 防止垃圾回收
-            
-            time.sleep(0.03)  # 约30fps
+                # 上一帧尚未显示时不重复调度，Tk事件队列不会积压
+                if not self.preview_pending:
+                    self.preview_pending = True
+                    self.root.after(0, self.show_preview_frame)
+        finally:
+            subscription.close()
+    
+    def show_preview_frame(self):
+        """在Tk主线程中显示最新的预览帧，复用同一个画布图像项"""
+        self.preview_pending = False
+        frame = self.preview_frame
+        if frame is None or not self.is_previewing:
+            return
+        
+        from PIL import Image, ImageTk
+        img = Image.fromarray(frame)
+        if self.preview_photo is None or (self.preview_photo.width(), self.preview_photo.height()) != img.size:
+            self.preview_photo = ImageTk.PhotoImage(image=img)
+            if self.preview_item is None:
+                self.preview_item = self.preview_canvas.create_image(0, 0, image=self.preview_photo, anchor=tk.CENTER)
+            else:
+                self.preview_canvas.itemconfig(self.preview_item, image=self.preview_photo)
+        else:
+            self.preview_photo.paste(img)
+        
+        # 画面居中显示
+        self.preview_canvas.coords(self.preview_item,
+                                   self.preview_canvas.winfo_width() // 2,
+                                   self.preview_canvas.winfo_height() // 2)
     
     def scan_network(self):
-        """扫描局域网设备"""
-        # 实际项目中应使用更复杂的扫描方法，这里仅作示例
+        """广播发现请求，收集从机回复后更新IP列表"""
+        if self.is_scanning:
+            return
+        self.is_scanning = True
         self.status_var.set("正在扫描网络...")
         
-        # 模拟扫描过程
         def scan_task():
-            time.sleep(2)  # 模拟扫描延迟
-            example_ips = ["192.168.1.5", "192.168.1.10", "192.168.1.15"]
-            self.root.after(0, lambda: self.ip_text.delete(1.0, tk.END))
-            self.root.after(0, lambda: self.ip_text.insert(tk.END, "\n".join(example_ips)))
-            self.root.after(0, lambda: self.status_var.set("扫描完成"))
+            try:
+                client = DiscoveryClient(self.udp_port, self.discovery_targets, self.discovery_timeout)
+                replies = client.discover()
+            except Exception as e:
+                print(f"扫描网络失败: {str(e)}")
+                replies = {}
+            self.root.after(0, lambda: self.show_discovered(replies))
         
         threading.Thread(target=scan_task, daemon=True).start()
     
+    def show_discovered(self, replies):
+        """在主线程中更新从机列表，移除长时间未回复的从机"""
+        self.is_scanning = False
+        stale = self.slave_registry.update(replies)
+        for ip in stale:
+            print(f"从机 {ip} 长时间未回复，已移除")
+            if self.slave_tree.exists(ip):
+                self.slave_tree.delete(ip)
+        
+        ips = self.slave_registry.ips()
+        for ip in ips:
+            info = self.slave_registry.info(ip)
+            print(format_slave(ip, info))
+            if ip not in self.slave_states:
+                values = (ip, f"{info.get('state', '?')}/{info.get('device', '?')}",
+                          f"{info.get('latency', 0) * 1000:.2f}", "-")
+                if self.slave_tree.exists(ip):
+                    self.slave_tree.item(ip, values=values)
+                else:
+                    self.slave_tree.insert("", tk.END, iid=ip, values=values)
+        
+        # 录制中不修改从机列表
+        if not self.is_recording:
+            self.ip_text.delete(1.0, tk.END)
+            self.ip_text.insert(tk.END, "\n".join(ips))
+        self.status_var.set(f"扫描完成，发现 {len(replies)} 个从机，共 {len(ips)} 个")
+    
+    def auto_scan(self):
+        """勾选自动刷新时定期扫描"""
+        if not self.auto_scan_var.get():
+            return
+        if not self.is_recording:
+            self.scan_network()
+        self.root.after(self.discovery_interval, self.auto_scan)
+    
     def prepare_experiment(self):
         """准备实验"""
         try:
@@ -218,6 +452,19 @@ class DataCollectionSystem:
             # 将分钟转换为秒
             self.experiment_duration = minutes * 60
             
+            self.segment_seconds = float(self.segment_var.get() or 0)
+            if self.segment_seconds < 0:
+                raise ValueError("视频分段时长不能小于0")
+            
+            # 人脸区域录制: 准备时先加载检测模型，避免开始录制时才失败
+            self.roi = None
+            if self.roi_var.get():
+                from roi_recording import roi_options, load_detector
+                self.roi = roi_options({'size': self.roi_size_var.get(),
+                                        'model': self.roi_model_var.get().strip() or None,
+                                        'full_scale': self.roi_full_scale if self.roi_full_var.get() else 0})
+                load_detector(self.roi['model'])
+            
             # 获取从机IP列表
             self.client_ips = [ip.strip() for ip in self.ip_text.get(1.0, tk.END).strip().split("\n") if ip.strip()]
             if not self.client_ips:
@@ -236,24 +483,68 @@ class DataCollectionSystem:
             session_dir = os.path.join(self.data_dir, self.session_id)
             os.makedirs(session_dir, exist_ok=True)
             
-            # 准备摄像头
-            if not self.cap or not self.cap.isOpened():
-                camera_idx = int(self.camera_index_var.get())
-                self.cap = cv2.VideoCapture(camera_idx)
-                if not self.cap.isOpened():
-                    raise ValueError(f"无法打开摄像头 {camera_idx}")
+            # 摄像头在后台打开并等待首帧，与从机准备命令同时进行
+            # Tk变量只能在主线程读取
+            camera_text = self.camera_index_var.get()
+            use_process = self.camera_process_var.get()
+            warmup = {}
+            def warm_up():
+                try:
+                    from camera_recorder import parse_camera_sources, wait_for_frames
+                    self.open_cameras(parse_camera_sources(camera_text), use_process)
+                    wait_for_frames(self.cameras)
+                except Exception as e:
+                    warmup['error'] = e
+            warmup_thread = threading.Thread(target=warm_up, daemon=True)
+            warmup_thread.start()
+            
+            # 本次会话的命令统计
+            self.command_log = {}
+            self.metrics.reset("command.")
             
-            # 发送准备命令到从机，包含生理数据文件名
+            # 发送准备命令到从机，包含生理数据文件名；在后台等待确认，完成后继续准备
             oxygen_filename = f"oxygen_data_{self.session_id}.csv"  # 默认生理数据文件名
-            for ip in self.client_ips:
-                self.send_udp_command(ip, f"PREPARE,{oxygen_filename}")
+            self.prepare_btn.config(state=tk.DISABLED)
+            self.status_var.set("正在准备...")
+            self.send_command(f"PREPARE,{oxygen_filename}",
+                              on_done=lambda results: self.finish_prepare(results, warmup_thread, warmup))
+            
+        except Exception as e:
+            messagebox.showerror("准备失败", str(e))
+    
+    def finish_prepare(self, results, warmup_thread, warmup):
+        """从机确认准备命令后(主线程中)，等待摄像头就绪并开始时钟同步"""
+        # 摄像头仍在预热时稍后再检查，不阻塞界面
+        if warmup_thread.is_alive():
+            self.root.after(50, lambda: self.finish_prepare(results, warmup_thread, warmup))
+            return
+        try:
+            failed = [ip for ip, result in results.items() if not result.ok]
+            if failed:
+                messagebox.showwarning("从机未就绪", "以下从机未确认准备命令:\n" + "\n".join(failed))
+            
+            if 'error' in warmup:
+                raise RuntimeError(f"摄像头准备失败: {str(warmup['error'])}")
+            
+            # 清空上一次会话的实时数据
+            if self.live_aggregator:
+                self.live_aggregator.clear()
+            
+            # 开始前及录制中定期测量从机时钟偏差
+            self.stop_clock_sync()
+            self.clock_sync = ClockSyncMonitor(self.client_ips, self.udp_port,
+                                               interval=self.sync_interval, rounds=self.sync_rounds)
+            self.clock_sync.start()
             
             # 更新UI
             self.status_var.set("实验准备就绪")
             self.start_btn.config(state=tk.NORMAL)
             self.prepare_btn.config(state=tk.DISABLED)
+            self.collect_btn.config(state=tk.DISABLED)
             
         except Exception as e:
+            self.prepare_btn.config(state=tk.NORMAL)
+            self.status_var.set("准备失败")
             messagebox.showerror("准备失败", str(e))
     
     def start_experiment(self):
@@ -265,40 +556,47 @@ class DataCollectionSystem:
             
             # 设置视频输出
             session_dir = os.path.join(self.data_dir, self.session_id)
-            video_path = os.path.join(session_dir, self.video_filename)
-            
-            # 获取摄像头属性
-            width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps = int(self.cap.get(cv2.CAP_PROP_FPS))
             
-            # 创建视频写入器
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            self.out = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
-            
-            # 记录开始时间
+            # 记录开始时间，所有摄像头的帧索引共用同一台机器的时钟
             self.start_time = time.time()
+            self.start_monotonic = time.monotonic()
             
-            # 显示屏幕闪烁作为同步信号
-            self.flash_sync_signal()
-            
-            # 发送开始命令到从机
+            # 发送开始命令到从机，确认结果在后台等待，收到后追加到同步信息
             command_time = time.time()
-            for ip in self.client_ips:
-                self.send_udp_command(ip, f"START,{command_time}")
+            sync_file = os.path.join(session_dir, "sync_info.txt")
+            self.send_command(f"START,{command_time}",
+                              on_done=lambda results: self.write_command_results(sync_file, results))
             
             # 写入同步信息
-            sync_file = os.path.join(session_dir, "sync_info.txt")
-            with open(sync_file, "w") as f:
+            with open(sync_file, "w", encoding="utf-8") as f:
                 f.write(f"实验开始时间: {datetime.datetime.now().isoformat()}\n")
                 f.write(f"视频文件名: {self.video_filename}\n")
                 f.write(f"命令发送时间戳: {command_time}\n")
                 f.write(f"视频开始时间戳: {self.start_time}\n")
+                f.write(f"单调时钟开始时间: {self.start_monotonic}\n")
+                f.write(f"摄像头数量: {len(self.cameras)}\n")
             
             # 开始录制
             self.is_recording = True
-            self.record_thread = threading.Thread(target=self.record_video, daemon=True)
-            self.record_thread.start()
+            self.record_video()
+            
+            from video_segments import segment_index_path
+            from roi_recording import roi_file_path
+            with open(sync_file, "a", encoding="utf-8") as f:
+                for number, camera in enumerate(self.cameras):
+                    f.write(f"摄像头{number}: {camera.source}, 视频文件: {os.path.basename(camera.video_path)}\n")
+                    if self.segment_seconds:
+                        f.write(f"摄像头{number} 分段索引: {os.path.basename(segment_index_path(camera.video_path))}\n")
+                    if self.roi:
+                        f.write(f"摄像头{number} ROI框文件: {os.path.basename(roi_file_path(camera.video_path))}\n")
+            
+            # 结构化会话信息，停止时更新
+            write_session_file(session_dir, master_metadata(
+                self.session_id, 'recording', self.start_time, None, self.video_filename, self.cameras,
+                command_log=self.command_log, roi=self.roi))
+            
+            # 录制开始后显示屏幕闪烁作为同步信号，记录每次切换的显示时间
+            self.flash_sync_signal(session_dir)
             
             # 开始计时器
             self.update_timer()
@@ -309,42 +607,58 @@ class DataCollectionSystem:
             messagebox.showerror("启动失败", str(e))
             self.stop_experiment()
     
-    def flash_sync_signal(self):
-        """显示屏幕闪烁作为同步信号"""
+    def write_command_results(self, sync_file, results):
+        """将命令的确认结果追加到同步信息"""
+        try:
+            with open(sync_file, "a", encoding="utf-8") as f:
+                for line in format_results(results):
+                    f.write(f"从机 {line}\n")
+        except OSError as e:
+            print(f"写入同步信息时出错: {str(e)}")
+    
+    def flash_sync_signal(self, session_dir):
+        """显示屏幕闪烁作为同步信号：由Tk定时器切换颜色，不阻塞主线程，结束后保存显示时间"""
+        from flash_sync import FlashMarkerLog, FLASH_SEQUENCE, FLASH_INTERVAL_MS, MARKER_FILE
         flash_window = tk.Toplevel(self.root)
         flash_window.attributes('-fullscreen', True)
-        flash_window.configure(bg='white')
-        
-        # 闪烁3次
-        for _ in range(3):
-            flash_window.update()
-            time.sleep(0.2)
-            flash_window.configure(bg='black')
-            flash_window.update()
-            time.sleep(0.2)
-            flash_window.configure(bg='white')
-        
-        flash_window.destroy()
+        markers = FlashMarkerLog()
+        colors = list(FLASH_SEQUENCE)
+        
+        def show_next():
+            if not colors or not flash_window.winfo_exists():
+                if flash_window.winfo_exists():
+                    flash_window.destroy()
+                try:
+                    markers.save(os.path.join(session_dir, MARKER_FILE))
+                    with open(os.path.join(session_dir, "sync_info.txt"), "a", encoding="utf-8") as f:
+                        f.write(f"闪烁标记: {MARKER_FILE}, {len(markers.markers)} 次切换\n")
+                except OSError as e:
+                    print(f"保存闪烁标记时出错: {str(e)}")
+                return
+            flash_window.configure(bg=colors.pop(0))
+            # 立即重绘，使记录的时间接近实际显示时间
+            flash_window.update_idletasks()
+            markers.add(flash_window.cget('bg'))
+            self.root.after(FLASH_INTERVAL_MS, show_next)
+        
+        show_next()
     
     def record_video(self):
-        """录制视频线程"""
-        while self.is_recording:
-            ret, frame = self.cap.read()
-            if ret:
-                # 添加时间戳到帧
-                timestamp = time.time() - self.start_time
-                cv2.putText(frame, f"Time: {timestamp:.2f}s", (10, 30), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                
-                # 写入视频
-                self.out.write(frame)
-                
-                # 检查是否超过录制时长
-                if timestamp >= self.experiment_duration:
-                    self.root.after(0, self.stop_experiment)
-                    break
-            
-            time.sleep(0.01)
+        """所有摄像头同时开始录制：各自的编码线程写入视频和帧索引"""
+        from camera_recorder import camera_video_filename, draw_timestamp
+        session_dir = os.path.join(self.data_dir, self.session_id)
+        overlay = draw_timestamp if self.overlay_var.get() else None
+        for number, camera in enumerate(self.cameras):
+            video_path = os.path.join(session_dir, camera_video_filename(self.video_filename, number))
+            camera.start_recording(
+                video_path, self.start_time,
+                duration=self.experiment_duration,
+                # 录制时长以第一路摄像头为准，到时停止所有摄像头
+                on_duration_reached=(lambda: self.root.after(0, self.stop_experiment)) if number == 0 else None,
+                overlay=overlay,
+                segment_seconds=self.segment_seconds or None,
+                roi=self.roi
+            )
     
     def update_timer(self):
         """更新计时器显示"""
@@ -354,57 +668,289 @@ class DataCollectionSystem:
             seconds = int(elapsed % 60)
             self.timer_var.set(f"{minutes:02d}:{seconds:02d}")
             
+            # 各路摄像头实际帧率
+            lines = []
+            live_stats = []
+            for number, camera in enumerate(self.cameras):
+                try:
+                    stats = camera.live_stats()
+                    live_stats.append(stats)
+                    lines.append(f"摄像头{number}: {stats['fps']:.1f} fps, 丢帧 {stats['dropped_frames']}")
+                except Exception as e:
+                    live_stats.append({'error': str(e)})
+                    lines.append(f"摄像头{number}: {str(e)}")
+            self.camera_fps_var.set("\n".join(lines))
+            self.camera_live_stats = live_stats
+            
             # 如果仍在录制，继续更新
             if self.is_recording:
                 self.root.after(1000, self.update_timer)
     
-    def stop_experiment(self):
-        """停止录制"""
+    def stop_experiment(self, wait=False):
+        """停止录制，wait为True时在当前线程等待从机确认(退出程序时)"""
         if not self.is_recording:
             return
         
         # 停止录制
         self.is_recording = False
+        self.stop_btn.config(state=tk.DISABLED)
         
-        # 发送停止命令到从机
+        # 发送停止命令到从机，在后台等待确认的同时停止摄像头，未响应的从机不会延长录制
         stop_time = time.time()
-        for ip in self.client_ips:
-            self.send_udp_command(ip, f"STOP,{stop_time}")
-        
+        command = f"STOP,{stop_time}"
+        if not wait:
+            # 回调在主线程中执行，此时本方法已返回，摄像头统计和时钟同步结果均已就绪
+            self.send_command(command, on_done=lambda results: self.finish_stop(
+                stop_time, camera_stats, clock_sync, results))
+        
+        # 等待各路摄像头队列中剩余的帧编码完成
+        camera_stats = []
+        for number, camera in enumerate(self.cameras):
+            try:
+                stats = camera.stop_recording()
+            except Exception as e:
+                print(f"停止摄像头{number}录制时出错: {str(e)}")
+                stats = None
+            camera_stats.append(stats)
+            if stats:
+                print(f"摄像头{number}:")
+                print("\n".join(format_stats(stats)))
+        
+        # 结束时钟同步，拟合偏差和漂移
+        clock_sync = self.stop_clock_sync()
+        
+        if wait:
+            self.finish_stop(stop_time, camera_stats, clock_sync, self.send_command(command))
+    
+    def finish_stop(self, stop_time, camera_stats, clock_sync, stop_results):
+        """从机确认停止命令后(主线程中)，保存同步信息、指标摘要和会话信息"""
         # 更新同步信息
         if self.session_id:
             session_dir = os.path.join(self.data_dir, self.session_id)
             sync_file = os.path.join(session_dir, "sync_info.txt")
-            with open(sync_file, "a") as f:
+            if clock_sync:
+                clock_sync.save_samples(os.path.join(session_dir, "clock_sync.csv"))
+            with open(sync_file, "a", encoding="utf-8") as f:
                 f.write(f"录制结束时间: {datetime.datetime.now().isoformat()}\n")
                 f.write(f"停止命令时间戳: {stop_time}\n")
                 f.write(f"录制总时长: {stop_time - self.start_time}秒\n")
+                for number, stats in enumerate(camera_stats):
+                    if stats:
+                        for line in format_stats(stats):
+                            f.write(f"摄像头{number} {line}\n")
+                for line in format_results(stop_results):
+                    f.write(f"从机 {line}\n")
+                if clock_sync:
+                    # 对齐时: 主机时间 = 从机时间 - (偏差 + 漂移 * (主机时间 - 参考时间))
+                    f.write("时钟同步样本: clock_sync.csv\n")
+                    for ip, result in clock_sync.results().items():
+                        for line in format_result(ip, result):
+                            f.write(line + "\n")
+            
+            # 机器可读的会话指标摘要，用于监控和告警
+            try:
+                write_summary(os.path.join(session_dir, SUMMARY_FILE), {
+                    'role': 'master',
+                    'session_id': self.session_id,
+                    'start_time': self.start_time,
+                    'stop_time': stop_time,
+                    'duration': stop_time - self.start_time,
+                    'cameras': [{'source': camera.source,
+                                 'video': os.path.basename(camera.video_path) if camera.video_path else None,
+                                 'stats': stats}
+                                for camera, stats in zip(self.cameras, camera_stats)],
+                    'commands': self.command_log,
+                    'clock_sync': clock_sync.results() if clock_sync else None,
+                    'metrics': self.metrics.snapshot(),
+                })
+            except Exception as e:
+                print(f"写入指标摘要时出错: {str(e)}")
+            
+            # 结构化会话信息，并加入数据目录的会话目录
+            try:
+                write_session_file(session_dir, master_metadata(
+                    self.session_id, 'complete', self.start_time, stop_time, self.video_filename, self.cameras,
+                    camera_stats, self.command_log, clock_sync.results() if clock_sync else None,
+                    segment_seconds=self.segment_seconds or None, roi=self.roi))
+            except Exception as e:
+                print(f"写入会话信息时出错: {str(e)}")
+            index_session(session_dir)
         
         # 释放资源
-        if self.out:
-            self.out.release()
-            self.out = None
+        self.release_camera()
         
         # 更新UI
         self.prepare_btn.config(state=tk.NORMAL)
         self.start_btn.config(state=tk.DISABLED)
         self.stop_btn.config(state=tk.DISABLED)
-        self.status_var.set("录制已停止")
+        self.collect_btn.config(state=tk.NORMAL)
+        summaries = [f"{stats['achieved_fps']:.1f}fps/丢帧{stats['dropped_frames']}"
+                     for stats in camera_stats if stats]
+        if summaries:
+            self.status_var.set("录制已停止 (" + ", ".join(summaries) + ")")
+        else:
+            self.status_var.set("录制已停止")
         
         messagebox.showinfo("完成", f"录制已完成，数据保存在: {os.path.join(self.data_dir, self.session_id)}")
     
-    def send_udp_command(self, ip, command):
-        """向指定IP发送UDP命令"""
-        try:
-            self.udp_socket.sendto(command.encode(), (ip, self.udp_port))
-            print(f"已发送命令 '{command}' 到 {ip}:{self.udp_port}")
-        except Exception as e:
-            print(f"发送命令到 {ip} 失败: {str(e)}")
+    def collect_slave_data(self):
+        """在后台线程中从所有从机并行下载本次会话的数据到会话目录的oximeter子目录"""
+        if not self.session_id or self.is_recording:
+            return
+        from file_transfer import pull_session, format_progress, format_transfer, TRANSFER_DIR
+        session_dir = os.path.join(self.data_dir, self.session_id)
+        ips = list(self.client_ips)
+        self.collect_btn.config(state=tk.DISABLED)
+        self.status_var.set("正在收集从机数据...")
+        
+        def collect_task():
+            try:
+                results = pull_session(ips, session_dir, port=self.transfer_port,
+                                       on_progress=lambda progress: self.root.after(
+                                           0, lambda: self.status_var.set(format_progress(progress))))
+            except Exception as e:
+                results = None
+                error = str(e)
+            self.root.after(0, lambda: show_result(results) if results is not None else show_error(error))
+        
+        def show_result(results):
+            self.collect_btn.config(state=tk.NORMAL)
+            lines = [format_transfer(stats) for stats in results.values()]
+            for line in lines:
+                print(line)
+            failed = [ip for ip, stats in results.items() if stats['error']]
+            if failed:
+                messagebox.showwarning("收集数据", "\n".join(lines))
+            else:
+                messagebox.showinfo("收集数据", f"已收集 {len(results)} 个从机的数据到:\n"
+                                    f"{os.path.join(session_dir, TRANSFER_DIR)}")
+        
+        def show_error(error):
+            self.collect_btn.config(state=tk.NORMAL)
+            messagebox.showerror("收集数据失败", error)
+        
+        threading.Thread(target=collect_task, daemon=True).start()
+    
+    def send_command(self, command, on_done=None):
+        """
+        向所有从机并发发送命令
+        on_done为None时在当前线程等待确认并返回结果；否则在后台线程等待，不阻塞界面，
+        结果在主线程中更新从机状态后交给on_done(results)
+        """
+        ips = list(self.client_ips)
+        if on_done is None:
+            with self.command_lock:
+                results = self.command_channel.send(ips, command)
+            return self.show_command_results(command, results)
+        
+        def command_task():
+            with self.command_lock:
+                results = self.command_channel.send(ips, command)
+            self.root.after(0, lambda: on_done(self.show_command_results(command, results)))
+        
+        threading.Thread(target=command_task, daemon=True).start()
+    
+    def show_command_results(self, command, results):
+        """输出命令的确认结果并更新从机状态"""
+        for line in format_results(results):
+            print(line)
+        
+        # 更新从机状态列表
+        name = command.split(',')[0]
+        self.command_log[name] = {ip: result.as_dict() for ip, result in results.items()}
+        for ip in self.slave_tree.get_children():
+            if ip not in results:
+                self.slave_tree.delete(ip)
+        for ip, result in results.items():
+            self.slave_states[ip] = result
+            if result.ok:
+                state = {"PREPARE": "已准备", "START": "录制中", "STOP": "已停止"}.get(name, name)
+            elif result.acknowledged:
+                state = f"{name}失败"
+            else:
+                state = "未响应"
+            latency = f"{result.latency * 1000:.2f}" if result.latency is not None else "-"
+            values = (ip, state, latency, result.attempts)
+            if self.slave_tree.exists(ip):
+                self.slave_tree.item(ip, values=values)
+            else:
+                self.slave_tree.insert("", tk.END, iid=ip, values=values)
+        return results
+    
+    def stop_clock_sync(self, final_round=True):
+        """停止时钟同步测量，返回已停止的测量对象"""
+        clock_sync = self.clock_sync
+        self.clock_sync = None
+        if clock_sync:
+            clock_sync.stop(final_round)
+        return clock_sync
+    
+    def update_live_panel(self):
+        """以固定的最高刷新率绘制各设备最近的PPG波形和HR/SPO2"""
+        if self.live_aggregator:
+            canvas = self.live_canvas
+            width = max(canvas.winfo_width(), 100)
+            height = max(canvas.winfo_height(), 40)
+            devices = self.live_aggregator.devices()
+            shown = devices[:self.live_max_rows]
+            row_height = height / max(len(shown), 1)
+            
+            # 移除已不存在的设备
+            for key in list(self.live_items):
+                if key not in shown:
+                    for item in self.live_items.pop(key):
+                        canvas.delete(item)
+            
+            for row, key in enumerate(shown):
+                samples, info = self.live_aggregator.snapshot(key, self.live_window)
+                status = signal_status(samples, info['age'])
+                if key not in self.live_items:
+                    self.live_items[key] = (canvas.create_line(0, 0, 0, 0, fill="#00ff00"),
+                                            canvas.create_text(5, 0, anchor=tk.NW, fill="white", font=("Arial", 9)))
+                line, text = self.live_items[key]
+                
+                # PPG波形缩放到该设备的行内
+                top = row * row_height
+                label = f"{key[0]}#{key[1]} {status}"
+                if len(samples) >= 2:
+                    ppg = samples['ppg'].astype(np.float32)
+                    low, high = float(ppg.min()), float(ppg.max())
+                    scale = (row_height - 4) / max(high - low, 1.0)
+                    xs = np.linspace(width * 0.25, width - 5, len(ppg))
+                    ys = top + row_height - 2 - (ppg - low) * scale
+                    canvas.coords(line, *np.column_stack((xs, ys)).ravel().tolist())
+                    label += f"\nHR {samples['hr'][-1]}  SpO2 {samples['spo2'][-1]}"
+                quality = info['quality']
+                if quality:
+                    label += f"\n算法HR {quality['hr_peak']:.0f}/{quality['hr_spectral']:.0f} {format_flags(quality['flags'])}"
+                label += f"\n丢包 {info['lost_packets']}"
+                if row == len(shown) - 1 and len(devices) > len(shown):
+                    label += f"  (另有 {len(devices) - len(shown)} 个设备未显示)"
+                canvas.itemconfig(line, fill="#00ff00" if status == "正常" else "#ff4040")
+                canvas.itemconfig(text, text=label)
+                canvas.coords(text, 5, top + 2)
+        
+        self.root.after(self.live_refresh_ms, self.update_live_panel)
+    
+    def live_stream_stats(self):
+        """各从机设备实时数据的收包和丢包统计"""
+        if not self.live_aggregator:
+            return {}
+        stats = {}
+        for key in self.live_aggregator.devices():
+            _, info = self.live_aggregator.snapshot(key, 0)
+            stats[f"{key[0]}#{key[1]}"] = info
+        return stats
     
     def cleanup(self):
         """清理资源"""
         self.stop_preview()
-        self.stop_experiment()
+        self.stop_experiment(wait=True)
+        self.stop_clock_sync(final_round=False)
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.live_aggregator:
+            self.live_aggregator.stop()
         if self.udp_socket:
             self.udp_socket.close()
 
@@ -0,0 +1,236 @@
+import argparse
+import http.server
+import json
+import math
+import os
+import threading
+import time
+import urllib.request
+
+'''
+运行时指标: 计数器、耗时直方图和按需计算的状态值。
+- 热路径上只做O(1)的累加，直方图按对数分桶(每10倍10个桶)估计分位数
+- MetricsServer 在本机提供只读的HTTP统计接口(GET /stats 返回JSON)，便于监控和告警
+- 每次会话结束时由主机/从机写入 metrics_summary.json
+'''
+
+STATS_PATH = "/stats"
+SUMMARY_FILE = "metrics_summary.json"
+MASTER_STATS_PORT = 8700
+SLAVE_STATS_PORT = 8701
+
+
+class LatencyHistogram:
+    """耗时统计: 计数、平均、最大，以及按对数分桶估计的分位数"""
+    MIN_SECONDS = 1e-5        # 第一个桶的上界(10微秒)
+    BUCKETS_PER_DECADE = 10
+    DECADES = 7               # 最大到100秒，更长的计入最后一个桶
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (self.BUCKETS_PER_DECADE * self.DECADES + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if seconds <= self.MIN_SECONDS:
+            index = 0
+        else:
+            index = min(int(math.log10(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_DECADE) + 1,
+                        len(self.buckets) - 1)
+        self.buckets[index] += 1
+
+    def percentile(self, q):
+        """返回q分位数的估计值(秒)，取所在桶的上界，不超过最大值"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count:
+                return min(self.MIN_SECONDS * 10 ** (index / self.BUCKETS_PER_DECADE), self.max)
+        return self.max
+
+    def summary(self):
+        """返回平均/分位数/最大耗时(毫秒)"""
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            'count': self.count,
+            'mean_ms': mean * 1000,
+            'p50_ms': self.percentile(0.5) * 1000,
+            'p90_ms': self.percentile(0.9) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'max_ms': self.max * 1000,
+        }
+
+
+class Counter:
+    """累计计数，同时按约1秒的窗口估计速率"""
+    def __init__(self):
+        self.total = 0
+        self.rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def add(self, n=1):
+        self.total += n
+        self._window_count += n
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            self.rate = self._window_count / (now - self._window_start)
+            self._window_start = now
+            self._window_count = 0
+
+    def summary(self):
+        # 长时间没有计数时速率逐渐降为0
+        idle = time.monotonic() - self._window_start
+        rate = self.rate if idle < 2.0 else self._window_count / idle
+        return {'total': self.total, 'rate': rate}
+
+
+class MetricsRegistry:
+    """按名称管理计数器、直方图和状态值"""
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}       # 名称 -> 返回可JSON序列化数据的函数
+        self.lock = threading.Lock()
+
+    def counter(self, name):
+        with self.lock:
+            counter = self.counters.get(name)
+            if counter is None:
+                counter = self.counters[name] = Counter()
+            return counter
+
+    def histogram(self, name):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            return histogram
+
+    def gauge(self, name, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    def reset(self, prefix=""):
+        """删除名称以prefix开头的计数器和直方图(如新会话开始时)"""
+        with self.lock:
+            for table in (self.counters, self.histograms):
+                for name in [name for name in table if name.startswith(prefix)]:
+                    del table[name]
+
+    def snapshot(self):
+        """返回所有指标的当前值"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+            gauges = dict(self.gauges)
+        values = {}
+        for name, function in gauges.items():
+            try:
+                values[name] = function()
+            except Exception as e:
+                values[name] = f"错误: {str(e)}"
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.start_time,
+            'counters': {name: counter.summary() for name, counter in sorted(counters.items())},
+            'histograms': {name: histogram.summary() for name, histogram in sorted(histograms.items())},
+            'gauges': values,
+        }
+
+
+class _StatsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/", STATS_PATH):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.snapshot(), ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """
+    本机HTTP统计接口
+    snapshot: 返回统计数据(dict)的函数，每次请求时在服务线程中调用
+    """
+    def __init__(self, snapshot, port, host='127.0.0.1'):
+        self.server = http.server.ThreadingHTTPServer((host, port), _StatsHandler)
+        self.server.daemon_threads = True
+        self.server.snapshot = snapshot
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_metrics_server(snapshot, port, host='127.0.0.1'):
+    """启动统计接口，端口为0或被占用时返回None(不影响采集)"""
+    if not port:
+        return None
+    try:
+        server = MetricsServer(snapshot, port, host).start()
+        print(f"统计接口: http://{host}:{server.port}{STATS_PATH}")
+        return server
+    except OSError as e:
+        print(f"统计接口端口 {port} 不可用: {str(e)}")
+        return None
+
+
+def write_summary(path, summary):
+    """写入会话指标摘要，先写临时文件再替换"""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(temp_path, path)
+
+
+def query_stats(port, host='127.0.0.1', timeout=2.0):
+    """读取统计接口"""
+    with urllib.request.urlopen(f"http://{host}:{port}{STATS_PATH}", timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='读取主机或从机的运行时统计')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='统计接口地址')
+    parser.add_argument('--port', type=int, default=SLAVE_STATS_PORT,
+                        help=f'统计接口端口(主机默认{MASTER_STATS_PORT}，从机默认{SLAVE_STATS_PORT})')
+    parser.add_argument('--watch', type=float, default=None, help='每隔指定秒数重复读取')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    while True:
+        try:
+            print(json.dumps(query_stats(args.port, args.host), ensure_ascii=False, indent=2))
+        except OSError as e:
+            print(f"读取统计接口失败: {str(e)}")
+        if not args.watch:
+            break
+        time.sleep(args.watch)
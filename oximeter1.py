@@ -1,50 +1,303 @@
 import time
-import hid
-import csv
 import socket
 import threading
 import os
 import datetime
 import argparse
+import shutil
+from cms50e_decoder import (DecoderState, TimestampReconstructor, pack_reports, decode_reports,
+                            REPORT_SIZE, SAMPLES_PER_REPORT)
+from oximeter_storage import CSVSink, BinarySink, BufferedRowWriter, BINARY_EXTENSION
+from oximeter_devices import (HIDDevice, RawReportRecorder, ReplayDevice, SyntheticDevice,
+                              enumerate_hid_devices, RAW_LOG_EXTENSION)
+from clock_sync import make_sync_reply, SYNC_REQUEST
+from command_channel import (CommandDeduplicator, parse_sequenced_command, make_ack,
+                             STATUS_OK, STATUS_FAILED)
+from discovery import make_discover_reply, DISCOVER_REQUEST
+from live_stream import LiveStreamSender, LIVE_PORT
+from signal_quality import SignalAnalyzer, AnalysisWorker, open_quality_sink, quality_file_name
+from metrics import MetricsRegistry, start_metrics_server, write_summary, SUMMARY_FILE, SLAVE_STATS_PORT
+from session_catalog import write_session_file, master_session_id, index_session
+from file_transfer import TransferServer, TRANSFER_PORT
+
+COLLECTOR_VERSION = "2.1"
 
 '''
 This program is used to extract data information from the Contec CMS50E, 
 including PPG signals, Heart rate signals, and SPO2 signals.
 This version is designed to be controlled remotely via UDP commands from a master computer.
+All CMS50E devices attached to the host are collected at once, one acquisition thread
+and one output file per device, under a single command listener.
 Commands supported:
 - PREPARE: Prepare for data collection
 - START,timestamp: Start collecting data (with master timestamp for synchronization)
 - STOP,timestamp: Stop collecting data (with master timestamp for synchronization)
+- SYNC,id,t1: Clock synchronization ping, answered immediately with SYNCR,id,t1,t2,t3
+- DISCOVER,id: LAN discovery query, answered with HELLO,id,<json status>
+Commands wrapped as SEQ,channel,seq,<command> are acknowledged with ACK,channel,seq,OK|FAIL;
+retransmitted commands are not executed twice.
 '''
 
+
+def device_file_name(file_name, index, device_count):
+    """只有一个设备时沿用原文件名，多个设备时追加设备编号"""
+    if device_count == 1:
+        return file_name
+    base, ext = os.path.splitext(file_name)
+    return f"{base}_dev{index + 1}{ext}"
+
+
+class DeviceWorker:
+    """单个血氧仪的采集线程：读取报告、解码、重建时间戳后写入该设备的数据文件"""
+    def __init__(self, collector, index, device, device_info, file_path):
+        # 设备
+        self.collector = collector
+        self.index = index
+        self.device = device
+        self.device_info = device_info  # 设备路径、序列号等标识
+        self.file_path = file_path
+        
+        # 输出
+        self.writer = None
+        self.live_stream = None
+        self.analysis = None           # 在线信号分析线程
+        
+        # 解码
+        self.decoder_state = None
+        self.timestamp_reconstructor = None
+        
+        # 采集统计
+        self.report_count = 0
+        self.sample_count = 0
+        
+        # 运行时指标
+        metrics = collector.metrics
+        prefix = f"device{index + 1}"
+        self.read_timer = metrics.histogram(f"{prefix}.hid_read")      # 读到报告前阻塞的时间
+        self.decode_timer = metrics.histogram(f"{prefix}.decode")
+        self.report_counter = metrics.counter(f"{prefix}.reports")
+        self.sample_counter = metrics.counter(f"{prefix}.samples")
+        self.read_timeouts = metrics.counter(f"{prefix}.read_timeouts")
+        self.read_errors = metrics.counter(f"{prefix}.read_errors")
+        
+        # 线程控制
+        self.should_stop = False
+        self.thread = None
+    
+    @property
+    def name(self):
+        return f"设备{self.index + 1}"
+    
+    def start(self, sink, live_stream=None, analysis=None):
+        """开始采集，sink为该设备的数据文件"""
+        collector = self.collector
+        self.writer = BufferedRowWriter(
+            sink,
+            max_queue=collector.write_queue_size,
+            batch_size=collector.write_batch_size,
+            flush_interval=collector.flush_interval
+        )
+        self.live_stream = live_stream
+        self.analysis = analysis
+        self.should_stop = False
+        self.thread = threading.Thread(target=self._collect_data_thread, daemon=True)
+        self.thread.start()
+    
+    def stop(self, metadata, timeout=5):
+        """停止采集，写完剩余数据后返回(写入统计, 实时数据统计, 信号分析统计)"""
+        self.should_stop = True
+        if self.thread:
+            self.thread.join(timeout=timeout)
+            self.thread = None
+        
+        writer_stats = None
+        if self.writer:
+            self.writer.sink.set_metadata(**metadata)
+            self.writer.close()
+            writer_stats = self.writer.stats()
+            self.writer = None
+        
+        # 分析线程处理完剩余样本后才关闭实时数据流
+        analysis_stats = None
+        if self.analysis:
+            analysis_stats = self.analysis.stop()
+            self.analysis = None
+        
+        live_stats = None
+        if self.live_stream:
+            live_stats = self.live_stream.stats()
+            self.live_stream.close()
+            self.live_stream = None
+        return writer_stats, live_stats, analysis_stats
+    
+    def close(self):
+        """关闭设备(采集线程结束时自动关闭)"""
+        if self.device:
+            try:
+                self.device.close()
+                print(f"{self.name}已关闭")
+            except:
+                pass
+            self.device = None
+    
+    def _decode_batch(self, reports, arrivals, first_report, data_count):
+        """向量化解码一批报告，重建每个样本的时间戳后放入写入队列，返回新的数据点计数"""
+        buffer, lengths = pack_reports(reports)
+        decoded = decode_reports(buffer, lengths, self.decoder_state)
+        
+        # 以报告最后一个子包的序号拟合接收时间
+        for k, arrival_time in enumerate(arrivals):
+            self.timestamp_reconstructor.add_report(
+                arrival_time, (first_report + k) * SAMPLES_PER_REPORT + SAMPLES_PER_REPORT - 1)
+        sample_index = (first_report + decoded['report_index']) * SAMPLES_PER_REPORT + decoded['sub_index']
+        sample_times = self.timestamp_reconstructor.sample_times(sample_index).tolist()
+        
+        # 放入写入队列，由后台线程保存
+        local_start_time = self.collector.local_start_time
+        master_start_time = self.collector.master_start_time
+        for sample_time, ppg, hr, spo2 in zip(sample_times, decoded['ppg'].tolist(),
+                                              decoded['hr'].tolist(), decoded['spo2'].tolist()):
+            self.writer.put((
+                data_count,
+                sample_time,
+                sample_time - local_start_time,
+                sample_time - master_start_time,
+                ppg,
+                hr,
+                spo2
+            ))
+            data_count += 1
+        
+        # 实时数据流
+        live_stream = self.live_stream
+        if live_stream and sample_times:
+            live_stream.send(data_count - len(sample_times), sample_times,
+                             decoded['ppg'], decoded['hr'], decoded['spo2'])
+        
+        # 在线信号分析，只放入队列，由分析线程处理
+        if self.analysis and sample_times:
+            self.analysis.submit(data_count - len(sample_times), sample_times, decoded['ppg'])
+        return data_count
+    
+    def _collect_data_thread(self):
+        """数据采集线程函数：攒够一批报告后统一解码并放入写入队列"""
+        collector = self.collector
+        # 初始化数据
+        self.report_count = 0
+        self.sample_count = 0
+        self.decoder_state = DecoderState()
+        self.timestamp_reconstructor = TimestampReconstructor()
+        pending_reports = []
+        pending_arrivals = []
+        report_count = 0
+        data_count = 0
+        
+        while not self.should_stop:
+            try:
+                read_start = time.perf_counter()
+                data = self.device.read(REPORT_SIZE, collector.read_timeout_ms)
+                
+                # 获取当前时间
+                current_time = time.time()
+                if data:
+                    self.read_timer.add(time.perf_counter() - read_start)
+                    self.report_counter.add()
+                    pending_reports.append(data)
+                    pending_arrivals.append(current_time)
+                else:
+                    self.read_timeouts.add()
+                
+                # 达到批量大小或最长等待时间后解码
+                if pending_reports and (len(pending_reports) >= collector.decode_batch_size or
+                                        current_time - pending_arrivals[0] >= collector.max_decode_latency):
+                    decode_start = time.perf_counter()
+                    new_count = self._decode_batch(pending_reports, pending_arrivals, report_count, data_count)
+                    self.decode_timer.add(time.perf_counter() - decode_start)
+                    self.sample_counter.add(new_count - data_count)
+                    data_count = new_count
+                    report_count += len(pending_reports)
+                    self.report_count = report_count
+                    self.sample_count = data_count
+                    pending_reports = []
+                    pending_arrivals = []
+            
+            except Exception as e:
+                self.read_errors.add()
+                print(f"{self.name}采集数据时出错: {str(e)}")
+                time.sleep(0.1)
+        
+        # 处理剩余的报告
+        if pending_reports:
+            self.sample_count = self._decode_batch(pending_reports, pending_arrivals, report_count, data_count)
+            self.report_count = report_count + len(pending_reports)
+        
+        self.close()
+
+
 class OximeterDataCollector:
-    def __init__(self, vendor_id, product_id, port=5000):
+    def __init__(self, vendor_id, product_id, port=5000, bind_host='0.0.0.0'):
         # 设备参数
         self.vendor_id = vendor_id
         self.product_id = product_id
-        self.device = None
+        self.device_paths = None       # 只采集这些HID路径的设备，None表示所有匹配的设备
+        self.device_factories = []     # [(设备信息, 返回已打开设备的工厂函数)]，为空时使用HID设备
+        self.raw_log_enabled = False   # 是否同时保存原始报告日志
+        self.workers = []              # 每个设备一个采集线程
         
         # 数据采集状态
         self.is_collecting = False
         self.is_prepared = False
-        self.should_stop = False
-        self.collect_thread = None
         
         # 数据存储
         self.data_dir = os.path.join(os.getcwd(), "oximeter_data")
         self.session_id = None
-        self.csv_file_path = None
+        self.session_dir = None
         self.csv_file_name = "oximeter_data.csv"  # 默认文件名
+        self.output_format = "csv"     # 输出格式: csv 或 bin
+        self.write_queue_size = 20000  # 写入队列容量(行)
+        self.write_batch_size = 256    # 批量写入行数
+        self.flush_interval = 1.0      # 最长刷新间隔(秒)
+        
+        # 解码参数
+        self.decode_batch_size = 4     # 每批解码的报告数
+        self.max_decode_latency = 0.25 # 报告等待解码的最长时间(秒)
+        self.read_timeout_ms = 100     # HID读取超时(毫秒)
         
         # 时间同步
         self.master_start_time = None  # 主机发送的开始时间戳
         self.local_start_time = None   # 本地实际开始时间戳
         self.time_offset = 0           # 主机与从机时间偏差
+        self.sync_requests = 0         # 收到的时钟同步请求数
+        
+        # 实时数据流
+        self.live_stream_enabled = False  # 是否向主机发送实时数据
+        self.live_host = None          # 实时数据接收地址，None表示发送START命令的主机
+        self.live_port = LIVE_PORT
+        self.master_addr = None        # 最近一次START命令的发送方
+        
+        # 在线信号分析
+        self.analysis_enabled = True   # 是否计算信号质量和心率，结果保存到 *_quality.csv 或 *_quality.oxq
+        
+        # 命令确认与去重
+        self.command_deduplicator = CommandDeduplicator()
+        
+        # 运行时指标与本机统计接口
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge("state", lambda: self._discovery_info())
+        self.metrics.gauge("writers", lambda: self.get_writer_stats())
+        self.metrics.gauge("analysis", lambda: {worker.name: worker.analysis.stats()
+                                                for worker in self.workers if worker.analysis})
+        self.stats_port = SLAVE_STATS_PORT  # 0表示不启动统计接口
+        self.metrics_server = None
+        
+        # 会话结束后向主机提供数据文件(TCP)
+        self.transfer_port = TRANSFER_PORT  # 0表示不启动
+        self.transfer_server = None
         
         # UDP通信
         self.udp_port = port
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.bind(('0.0.0.0', self.udp_port))
+        self.udp_socket.bind((bind_host, self.udp_port))
         print(f"UDP监听已启动在端口 {port}")
         
         # 确保数据目录存在
@@ -55,20 +308,111 @@ class OximeterDataCollector:
         """启动UDP命令监听线程"""
         threading.Thread(target=self._listen_for_commands, daemon=True).start()
     
+    def start_metrics_server(self):
+        """启动本机统计接口(GET /stats)"""
+        self.metrics_server = start_metrics_server(self.metrics.snapshot, self.stats_port)
+    
+    def start_transfer_server(self, host='0.0.0.0'):
+        """启动数据文件传输服务，正在准备或采集的会话不提供下载"""
+        if not self.transfer_port:
+            return
+        try:
+            self.transfer_server = TransferServer(
+                self.data_dir, self.transfer_port, host,
+                busy=lambda: self.session_dir if self.is_prepared or self.is_collecting else None).start()
+            print(f"数据传输服务: {host}:{self.transfer_server.port}")
+        except OSError as e:
+            print(f"数据传输端口 {self.transfer_port} 不可用: {str(e)}")
+    
     def _listen_for_commands(self):
         """监听来自主机的UDP命令"""
         while True:
             try:
                 data, addr = self.udp_socket.recvfrom(1024)
+                receive_time = time.time()
                 command = data.decode().strip()
+                
+                # 时钟同步请求立即回复，不打印以免增加延迟
+                if command.startswith(SYNC_REQUEST + ","):
+                    self.udp_socket.sendto(make_sync_reply(command, receive_time).encode(), addr)
+                    self.sync_requests += 1
+                    self.metrics.counter("sync.requests").add()
+                    continue
+                
+                # 局域网发现请求
+                if command.startswith(DISCOVER_REQUEST + ","):
+                    self.udp_socket.sendto(make_discover_reply(command, self._discovery_info()).encode(), addr)
+                    continue
+                
+                # 带序号的命令处理后回复确认，重传的命令直接重发确认
+                sequenced = parse_sequenced_command(command)
+                if sequenced:
+                    channel_id, seq, command = sequenced
+                    reply = self.command_deduplicator.cached_reply(addr[0], channel_id, seq)
+                    if reply is None:
+                        print(f"收到来自 {addr} 的命令: {command}")
+                        status = STATUS_OK if self._timed_process_command(command, addr) else STATUS_FAILED
+                        reply = make_ack(channel_id, seq, status)
+                        self.command_deduplicator.remember(addr[0], channel_id, seq, reply)
+                    else:
+                        self.metrics.counter("command.duplicates").add()
+                    self.udp_socket.sendto(reply.encode(), addr)
+                    continue
+                
                 print(f"收到来自 {addr} 的命令: {command}")
                 
-                self._process_command(command, addr)
+                self._timed_process_command(command, addr)
             except Exception as e:
                 print(f"处理命令时出错: {str(e)}")
     
+    def _device_status(self):
+        """返回血氧仪设备状态"""
+        if self.workers:
+            return f"已打开{len(self.workers)}个"
+        if self.device_factories:
+            return f"模拟设备{len(self.device_factories)}个"
+        try:
+            count = len(enumerate_hid_devices(self.vendor_id, self.product_id))
+            return f"已连接{count}个" if count else "未连接"
+        except Exception:
+            return "未知"
+
+    def _discovery_info(self):
+        """局域网发现回复的内容"""
+        if self.is_collecting:
+            state = "采集中"
+        elif self.is_prepared:
+            state = "已准备"
+        else:
+            state = "空闲"
+        try:
+            disk_free = shutil.disk_usage(self.data_dir).free
+        except OSError:
+            disk_free = 0
+        return {
+            'hostname': socket.gethostname(),
+            'device': self._device_status(),
+            'state': state,
+            'disk_free': disk_free,
+            'version': COLLECTOR_VERSION,
+            'port': self.udp_port,
+            'quality': [worker.analysis.latest() for worker in self.workers if worker.analysis],
+        }
+    
+    def _timed_process_command(self, command, sender_addr):
+        """处理命令并记录处理耗时"""
+        start = time.perf_counter()
+        try:
+            return self._process_command(command, sender_addr)
+        finally:
+            name = command.split(',')[0]
+            if name not in ("PREPARE", "START", "STOP"):
+                name = "other"
+            self.metrics.histogram(f"command.{name}").add(time.perf_counter() - start)
+            self.metrics.counter("command.received").add()
+    
     def _process_command(self, command, sender_addr):
-        """处理接收到的命令"""
+        """处理接收到的命令，返回命令是否执行成功"""
         if command.startswith("PREPARE"):
             # 检查是否包含文件名
             parts = command.split(',')
@@ -76,6 +420,7 @@ class OximeterDataCollector:
                 self.csv_file_name = parts[1]
                 print(f"将使用自定义文件名: {self.csv_file_name}")
             self._prepare_collection()
+            return self.is_prepared
             
         elif command.startswith("START"):
             # 解析主机时间戳
@@ -83,7 +428,10 @@ class OximeterDataCollector:
             if len(parts) > 1:
                 try:
                     self.master_start_time = float(parts[1])
+                    if sender_addr:
+                        self.master_addr = sender_addr[0]
                     self._start_collection()
+                    return self.is_collecting
                 except ValueError:
                     print("无效的开始时间戳")
             else:
@@ -96,33 +444,87 @@ class OximeterDataCollector:
                 try:
                     stop_timestamp = float(parts[1])
                     self._stop_collection(stop_timestamp)
+                    return True
                 except ValueError:
                     print("无效的停止时间戳")
             else:
                 self._stop_collection(None)
+                return True
+        
+        return False
+    
+    def _local_address(self):
+        """主机看到的本机IP地址"""
+        try:
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                probe.connect((self.master_addr, self.udp_port))
+                return probe.getsockname()[0]
+            finally:
+                probe.close()
+        except OSError:
+            return ""
+    
+    def _open_devices(self):
+        """打开所有设备，返回[(设备, 设备信息)]"""
+        if self.device_factories:
+            return [(factory(), dict(info)) for info, factory in self.device_factories]
+        
+        infos = enumerate_hid_devices(self.vendor_id, self.product_id)
+        if self.device_paths:
+            infos = [info for info in infos if info['path'] in self.device_paths]
+        if not infos:
+            raise IOError(f"未找到血氧仪设备 {self.vendor_id:04x}:{self.product_id:04x}")
+        
+        devices = []
+        try:
+            for info in infos:
+                devices.append((HIDDevice(self.vendor_id, self.product_id, info['path']).open(), info))
+        except Exception:
+            for device, _ in devices:
+                device.close()
+            raise
+        return devices
     
     def _prepare_collection(self):
         """准备数据采集"""
         if self.is_prepared:
             return
-            
+        
         try:
-            # 打开设备
-            self.device = hid.device()
-            self.device.open(self.vendor_id, self.product_id)
-            print("设备已打开")
+            # 打开所有设备
+            devices = self._open_devices()
+            print(f"已打开 {len(devices)} 个设备")
             
             # 创建新会话
             self.session_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            session_dir = os.path.join(self.data_dir, self.session_id)
-            os.makedirs(session_dir, exist_ok=True)
+            self.session_dir = os.path.join(self.data_dir, self.session_id)
+            os.makedirs(self.session_dir, exist_ok=True)
             
-            # 使用自定义文件名或默认名称
-            self.csv_file_path = os.path.join(session_dir, self.csv_file_name)
+            # 使用自定义文件名或默认名称，二进制格式替换扩展名
+            file_name = self.csv_file_name
+            if self.output_format == "bin":
+                file_name = os.path.splitext(file_name)[0] + BINARY_EXTENSION
             
-            self.is_prepared = True
-            print(f"数据采集已准备就绪，将保存到: {self.csv_file_path}")
+            self.workers = []
+            self.metrics.reset("device")
+            for index, (device, info) in enumerate(devices):
+                # 保存原始报告日志，便于离线回放和复现问题
+                if self.raw_log_enabled:
+                    raw_log_path = os.path.join(self.session_dir, device_file_name(
+                        "raw_reports" + RAW_LOG_EXTENSION, index, len(devices)))
+                    device = RawReportRecorder(device, raw_log_path)
+                    info['raw_log'] = os.path.basename(raw_log_path)
+                    print(f"原始报告将保存到: {raw_log_path}")
+                
+                file_path = os.path.join(self.session_dir, device_file_name(file_name, index, len(devices)))
+                worker = DeviceWorker(self, index, device, info, file_path)
+                self.workers.append(worker)
+                print(f"{worker.name} ({info.get('path', '')}) 将保存到: {file_path}")
             
+            self.is_prepared = True
+            print("数据采集已准备就绪")
+        
         except Exception as e:
             print(f"准备数据采集时出错: {str(e)}")
     
@@ -131,124 +533,224 @@ class OximeterDataCollector:
         if not self.is_prepared:
             print("设备尚未准备就绪")
             return
-            
+        
         if self.is_collecting:
             print("数据采集已经在进行中")
             return
         
-        self.should_stop = False
         self.local_start_time = time.time()
         self.time_offset = self.local_start_time - self.master_start_time
         print(f"本地时间与主机时间偏差: {self.time_offset:.6f}秒")
         
         # 记录同步信息
-        sync_file = os.path.join(os.path.dirname(self.csv_file_path), "sync_info.txt")
-        with open(sync_file, "w") as f:
+        sync_file = os.path.join(self.session_dir, "sync_info.txt")
+        with open(sync_file, "w", encoding="utf-8") as f:
             f.write(f"主机开始时间戳: {self.master_start_time}\n")
             f.write(f"本地开始时间戳: {self.local_start_time}\n")
             f.write(f"时间偏差: {self.time_offset}\n")
             f.write(f"文件名: {self.csv_file_name}\n")
             f.write(f"同步后校准时间: {datetime.datetime.now().isoformat()}\n")
+            f.write(f"设备数: {len(self.workers)}\n")
+            if self.master_addr:
+                # 离线对齐时按本机地址匹配主机记录的时钟同步结果
+                f.write(f"主机地址: {self.master_addr}\n")
+                f.write(f"本机地址: {self._local_address()}\n")
+            for worker in self.workers:
+                info = worker.device_info
+                f.write(f"{worker.name}: 路径 {info.get('path', '')}, 序列号 {info.get('serial', '')}, "
+                        f"数据文件 {os.path.basename(worker.file_path)}\n")
         
-        # 初始化CSV文件
-        with open(self.csv_file_path, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['数据点', '采集时间戳', '相对时间(秒)', '校准后时间(秒)', 'PPG', 'HR', 'SPO2'])
+        # 结构化会话信息，停止时更新
+        write_session_file(self.session_dir, self._session_metadata('recording'))
         
-        # 启动数据采集线程
-        self.is_collecting = True
-        self.collect_thread = threading.Thread(target=self._collect_data_thread)
-        self.collect_thread.daemon = True
-        self.collect_thread.start()
+        # 实时数据流，发送失败时丢弃，不影响采集
+        live_host = self.live_host or self.master_addr
+        if self.live_stream_enabled and live_host:
+            print(f"实时数据将发送到 {live_host}:{self.live_port}")
         
+        # 每个设备独立的数据文件、后台写入线程和采集线程
+        for worker in self.workers:
+            if self.output_format == "bin":
+                sink = BinarySink(worker.file_path, {
+                    'session_id': self.session_id,
+                    'file_name': os.path.basename(worker.file_path),
+                    'master_start_time': self.master_start_time,
+                    'local_start_time': self.local_start_time,
+                    'time_offset': self.time_offset,
+                    'vendor_id': self.vendor_id,
+                    'product_id': self.product_id,
+                    'device_index': worker.index,
+                    'device_path': worker.device_info.get('path', ''),
+                    'device_serial': worker.device_info.get('serial', ''),
+                })
+            else:
+                sink = CSVSink(worker.file_path)
+            live_stream = None
+            if self.live_stream_enabled and live_host:
+                live_stream = LiveStreamSender(live_host, self.live_port, device=worker.index)
+            analysis = None
+            if self.analysis_enabled:
+                analysis_writer = BufferedRowWriter(
+                    open_quality_sink(quality_file_name(worker.file_path), {
+                        'session_id': self.session_id,
+                        'file_name': os.path.basename(worker.file_path),
+                        'device_index': worker.index,
+                    }),
+                    max_queue=self.write_queue_size,
+                    batch_size=self.write_batch_size,
+                    flush_interval=self.flush_interval
+                )
+                analysis = AnalysisWorker(SignalAnalyzer(), analysis_writer,
+                                          on_update=live_stream.send_quality if live_stream else None)
+            worker.start(sink, live_stream, analysis)
+        
+        self.is_collecting = True
         print("数据采集已开始")
     
     def _stop_collection(self, master_stop_time):
         """停止数据采集"""
         if not self.is_collecting:
             return
-            
-        self.should_stop = True
+        
         local_stop_time = time.time()
+        elapsed = max(local_stop_time - self.local_start_time, 1e-9)
         
-        # 等待采集线程结束
-        if self.collect_thread:
-            self.collect_thread.join(timeout=5)
+        # 等待采集线程结束，写完剩余数据并同步到磁盘
+        results = []
+        for worker in self.workers:
+            writer_stats, live_stats, analysis_stats = worker.stop({
+                'master_stop_time': master_stop_time,
+                'local_stop_time': local_stop_time,
+            })
+            results.append((worker, writer_stats, live_stats, analysis_stats))
+            if writer_stats:
+                print(f"{worker.name}写入统计: 已写入 {writer_stats['written_rows']} 行, "
+                      f"写入出错 {writer_stats['failed_rows']} 行, "
+                      f"丢弃 {writer_stats['dropped_rows']} 行, "
+                      f"最大队列深度 {writer_stats['max_queue_depth']}")
+            print(f"{worker.name}共采集 {worker.report_count} 个报告, {worker.sample_count} 个样本, "
+                  f"平均 {worker.sample_count / elapsed:.2f} 样本/秒")
         
         # 记录同步信息
-        if master_stop_time:
-            sync_file = os.path.join(os.path.dirname(self.csv_file_path), "sync_info.txt")
-            with open(sync_file, "a") as f:
+        sync_file = os.path.join(self.session_dir, "sync_info.txt")
+        with open(sync_file, "a", encoding="utf-8") as f:
+            if master_stop_time:
                 f.write(f"主机停止时间戳: {master_stop_time}\n")
                 f.write(f"本地停止时间戳: {local_stop_time}\n")
                 f.write(f"采集总时长: {local_stop_time - self.local_start_time:.2f}秒\n")
+            f.write(f"时钟同步请求数: {self.sync_requests}\n")
+            for worker, writer_stats, live_stats, analysis_stats in results:
+                # 只有一个设备时保持原有格式
+                prefix = f"{worker.name} " if len(self.workers) > 1 else ""
+                f.write(f"{prefix}采集报告数: {worker.report_count}\n")
+                f.write(f"{prefix}采集样本数: {worker.sample_count}\n")
+                f.write(f"{prefix}平均采集速率: {worker.sample_count / elapsed:.2f}样本/秒\n")
+                if worker.timestamp_reconstructor:
+                    f.write(f"{prefix}估计采样率: {worker.timestamp_reconstructor.sample_rate:.4f}Hz\n")
+                if writer_stats:
+                    f.write(f"{prefix}写入行数: {writer_stats['written_rows']}\n")
+                    f.write(f"{prefix}丢弃行数: {writer_stats['dropped_rows']}\n")
+                    if writer_stats['failed_rows']:
+                        f.write(f"{prefix}写入出错行数: {writer_stats['failed_rows']}\n")
+                    f.write(f"{prefix}最大写入队列深度: {writer_stats['max_queue_depth']}\n")
+                if live_stats:
+                    f.write(f"{prefix}实时数据包: 已发送 {live_stats['sent_packets']}, "
+                            f"丢弃 {live_stats['dropped_packets']}\n")
+                if analysis_stats:
+                    f.write(f"{prefix}信号分析: 样本 {analysis_stats['processed_samples']}, "
+                            f"丢弃批次 {analysis_stats['dropped_batches']}, "
+                            f"出错批次 {analysis_stats['failed_batches']}, "
+                            f"CPU {analysis_stats['cpu_time']:.3f}秒 "
+                            f"({analysis_stats['cpu_per_sample'] * 1e6:.1f}微秒/样本)\n")
+        
+        # 机器可读的会话指标摘要，用于监控和告警
+        devices = []
+        for worker, writer_stats, live_stats, analysis_stats in results:
+            devices.append({
+                'name': worker.name,
+                'path': worker.device_info.get('path', ''),
+                'serial': worker.device_info.get('serial', ''),
+                'file': os.path.basename(worker.file_path),
+                'reports': worker.report_count,
+                'samples': worker.sample_count,
+                'samples_per_second': worker.sample_count / elapsed,
+                'sample_rate': worker.timestamp_reconstructor.sample_rate if worker.timestamp_reconstructor else None,
+                'writer': writer_stats,
+                'live_stream': live_stats,
+                'analysis': analysis_stats,
+            })
+        try:
+            write_summary(os.path.join(self.session_dir, SUMMARY_FILE), {
+                'role': 'slave',
+                'session_id': self.session_id,
+                'master_start_time': self.master_start_time,
+                'master_stop_time': master_stop_time,
+                'local_start_time': self.local_start_time,
+                'local_stop_time': local_stop_time,
+                'elapsed': elapsed,
+                'sync_requests': self.sync_requests,
+                'devices': devices,
+                'metrics': self.metrics.snapshot(),
+            })
+        except Exception as e:
+            print(f"写入指标摘要时出错: {str(e)}")
+        
+        # 结构化会话信息，并加入数据目录的会话目录
+        try:
+            write_session_file(self.session_dir, self._session_metadata(
+                'complete', master_stop_time, local_stop_time, results))
+        except Exception as e:
+            print(f"写入会话信息时出错: {str(e)}")
+        index_session(self.session_dir)
         
+        self.workers = []
         self.is_collecting = False
         self.is_prepared = False
         
         print("数据采集已停止")
     
-    def _collect_data_thread(self):
-        """数据采集线程函数"""
-        # 初始化数据
-        check_bit = 0
-        data_update_bit = 0
-        status_bit = 0
-        PPG_bit = 0
-        HR_bit = 0
-        SPO2_bit = 0
-        data_count = 0
-        
-        while not self.should_stop:
-            try:
-                data = self.device.read(18)
-                
-                # 获取当前时间
-                current_time = time.time()
-                relative_time = current_time - self.local_start_time
-                calibrated_time = current_time - self.master_start_time
-                
-                # 处理数据
-                for i in range(3):
-                    try:
-                        check_bit = data[0 + 6*i]
-                        data_update_bit = data[1 + 6*i]
-                        status_bit = data[2 + 6*i]
-
-                        # 更新数据位
-                        if data_update_bit == 0:
-                            PPG_bit = data[3 + 6*i]
-                        elif data_update_bit == 1:
-                            HR_bit = data[3 + 6 * i]
-                            SPO2_bit = data[4 + 6 * i]
-
-                        # 保存数据到CSV
-                        with open(self.csv_file_path, 'a', newline='') as file:
-                            writer = csv.writer(file)
-                            writer.writerow([
-                                str(data_count), 
-                                str(current_time), 
-                                f"{relative_time:.6f}", 
-                                f"{calibrated_time:.6f}",
-                                str(PPG_bit), 
-                                str(HR_bit), 
-                                str(SPO2_bit)
-                            ])
-                        data_count += 1
-                    except IndexError:
-                        # 忽略不完整的数据帧
-                        pass
-                
-            except Exception as e:
-                print(f"采集数据时出错: {str(e)}")
-                time.sleep(0.1)
-        
-        if self.device:
-            try:
-                self.device.close()
-                print("设备已关闭")
-            except:
-                pass
+    def _session_metadata(self, status, master_stop_time=None, local_stop_time=None, results=None):
+        """从机会话信息: 时间、主机会话编号和每个设备的数据文件"""
+        stats = {worker.name: writer_stats for worker, writer_stats, _, _ in results or []}
+        devices = []
+        for worker in self.workers:
+            writer_stats = stats.get(worker.name)
+            devices.append({
+                'kind': 'oximeter',
+                'name': worker.name,
+                'identifier': worker.device_info.get('path', ''),
+                'serial': worker.device_info.get('serial', ''),
+                'file': os.path.basename(worker.file_path),
+                'count': worker.sample_count,
+                'rate': worker.timestamp_reconstructor.sample_rate if worker.timestamp_reconstructor else None,
+                'dropped': writer_stats['dropped_rows'] if writer_stats else None,
+            })
+        return {
+            'role': 'slave',
+            'session_id': self.session_id,
+            'master_session': master_session_id(self.csv_file_name),
+            'status': status,
+            'start_time': self.local_start_time,
+            'stop_time': local_stop_time,
+            'duration': local_stop_time - self.local_start_time if local_stop_time else None,
+            'master_start_time': self.master_start_time,
+            'master_stop_time': master_stop_time,
+            'time_offset': self.time_offset,
+            'master_addr': self.master_addr,
+            'local_addr': self._local_address() if self.master_addr else None,
+            'format': self.output_format,
+            'sync_requests': self.sync_requests,
+            'devices': devices,
+        }
+    
+    @property
+    def sample_count(self):
+        """所有设备的样本总数"""
+        return sum(worker.sample_count for worker in self.workers)
+    
+    def get_writer_stats(self):
+        """获取每个设备的写入队列深度与丢弃行数"""
+        return {worker.name: worker.writer.stats() for worker in self.workers if worker.writer}
 
 def parse_arguments():
     """解析命令行参数"""
@@ -259,10 +761,43 @@ def parse_arguments():
                         help='设备产品ID (十六进制)')
     parser.add_argument('--port', type=int, default=5000,
                         help='UDP监听端口')
+    parser.add_argument('--bind-host', type=str, default='0.0.0.0',
+                        help='UDP监听地址(同一台机器运行多个从机时可分别绑定127.0.0.x)')
     parser.add_argument('--data-dir', type=str, default=None,
                         help='数据保存目录')
     parser.add_argument('--filename', type=str, default=None,
                         help='自定义数据文件名(将被主机命令覆盖)')
+    parser.add_argument('--format', type=str, choices=['csv', 'bin'], default='csv',
+                        help='数据文件格式: csv文本，或bin定长二进制(可用oximeter_storage.py export转换为CSV)')
+    parser.add_argument('--queue-size', type=int, default=20000,
+                        help='写入队列容量(行)，磁盘跟不上时超出部分将被丢弃')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help='数据文件最长刷新间隔(秒)')
+    parser.add_argument('--raw-log', action='store_true',
+                        help='同时保存原始HID报告日志(.oxraw)')
+    parser.add_argument('--device-path', type=str, nargs='+', default=None,
+                        help='只采集指定HID路径的设备(默认采集所有匹配的设备)')
+    parser.add_argument('--replay', type=str, nargs='+', default=None,
+                        help='回放原始报告日志代替真实设备，每个日志作为一个设备')
+    parser.add_argument('--synthetic', type=int, nargs='?', const=1, default=0,
+                        help='使用指定数量的合成PPG设备代替真实设备')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='回放/合成速度: 1为实时，大于1为加速，0为尽可能快')
+    parser.add_argument('--live-stream', action='store_true',
+                        help='采集时向主机发送实时PPG数据(用于主机界面的实时波形)')
+    parser.add_argument('--live-host', type=str, default=None,
+                        help='实时数据接收地址(默认为发送开始命令的主机)')
+    parser.add_argument('--live-port', type=int, default=LIVE_PORT,
+                        help='实时数据接收端口')
+    parser.add_argument('--no-analysis', action='store_true',
+                        help='不做在线信号质量与心率分析(默认保存到数据文件旁的 *_quality.csv，'
+                             '二进制格式时为 *_quality.oxq)')
+    parser.add_argument('--stats-port', type=int, default=SLAVE_STATS_PORT,
+                        help='本机统计接口端口(http://127.0.0.1:端口/stats)，0为不启动')
+    parser.add_argument('--transfer-port', type=int, default=TRANSFER_PORT,
+                        help='会话结束后向主机提供数据文件的TCP端口，0为不启动')
+    parser.add_argument('--autostart', type=float, default=None,
+                        help='不等待主机命令，直接本地采集指定秒数后退出(用于测试最大采集速率)')
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -271,7 +806,8 @@ if __name__ == '__main__':
     collector = OximeterDataCollector(
         vendor_id=args.vendor_id,
         product_id=args.product_id,
-        port=args.port
+        port=args.port,
+        bind_host=args.bind_host
     )
     
     if args.data_dir:
@@ -280,7 +816,42 @@ if __name__ == '__main__':
     if args.filename:
         collector.csv_file_name = args.filename
     
-    # 启动UDP监听
+    collector.output_format = args.format
+    collector.write_queue_size = args.queue_size
+    collector.flush_interval = args.flush_interval
+    collector.raw_log_enabled = args.raw_log
+    collector.live_stream_enabled = args.live_stream
+    collector.live_host = args.live_host
+    collector.live_port = args.live_port
+    collector.analysis_enabled = not args.no_analysis
+    
+    # 选择设备后端
+    if args.device_path:
+        collector.device_paths = args.device_path
+    if args.replay:
+        collector.device_factories = [
+            ({'path': path, 'serial': ''}, lambda path=path: ReplayDevice(path, speed=args.speed))
+            for path in args.replay
+        ]
+    elif args.synthetic:
+        collector.device_factories = [
+            ({'path': f'synthetic:{n}', 'serial': ''},
+             lambda n=n: SyntheticDevice(heart_rate=72 + 5 * n, speed=args.speed, seed=n))
+            for n in range(args.synthetic)
+        ]
+    
+    if args.autostart:
+        collector._process_command("PREPARE", None)
+        collector._process_command(f"START,{time.time()}", None)
+        time.sleep(args.autostart)
+        collector._process_command(f"STOP,{time.time()}", None)
+        raise SystemExit(0)
+    
+    # 启动UDP监听、统计接口和数据传输服务
+    collector.stats_port = args.stats_port
+    collector.start_metrics_server()
+    collector.transfer_port = args.transfer_port
+    collector.start_transfer_server(args.bind_host)
     collector.start_udp_listener()
     
     # 保持程序运行
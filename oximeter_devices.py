@@ -0,0 +1,350 @@
+import abc
+import argparse
+import math
+import os
+import struct
+import time
+import numpy as np
+
+'''
+血氧仪设备后端。
+所有后端提供与hid.device相同的最小接口: read(max_length, timeout_ms=0) 与 close()，
+OximeterDataCollector 通过 device_factory 创建设备，因此无需真实的CMS50E也能
+运行完整采集流程，用于性能测试和复现现场问题。
+
+- HIDDevice: 真实的HID设备
+- RawReportRecorder: 包装任意设备，把原始18字节报告及接收时间追加到原始日志(.oxraw)
+- ReplayDevice: 按原始时间间隔回放原始日志，可实时、加速或尽可能快
+- SyntheticDevice: 生成合成PPG波形的CMS50E报告
+'''
+
+REPORT_SIZE = 18
+RAW_LOG_MAGIC = b'OXRAW001'
+RAW_LOG_EXTENSION = '.oxraw'
+# 每条记录: 接收时间(f8) + 报告实际长度(u1) + 18字节报告
+RAW_RECORD_STRUCT = struct.Struct(f'<dB{REPORT_SIZE}s')
+RAW_RECORD_DTYPE = np.dtype([
+    ('arrival_time', '<f8'),
+    ('length', 'u1'),
+    ('data', 'u1', (REPORT_SIZE,)),
+])
+assert RAW_RECORD_DTYPE.itemsize == RAW_RECORD_STRUCT.size
+
+
+def enumerate_hid_devices(vendor_id, product_id):
+    """列出所有匹配的HID设备，返回包含路径和序列号的字典列表"""
+    import hid
+    devices = []
+    for info in hid.enumerate(vendor_id, product_id):
+        path = info['path']
+        if isinstance(path, bytes):
+            path = path.decode(errors='replace')
+        if any(device['path'] == path for device in devices):
+            continue
+        devices.append({
+            'path': path,
+            'serial': info.get('serial_number') or '',
+            'product': info.get('product_string') or '',
+        })
+    return devices
+
+
+class HIDDevice:
+    """真实的HID设备，指定path时打开该路径的设备，否则打开第一个匹配的设备"""
+    def __init__(self, vendor_id, product_id, path=None):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.path = path
+        self.device = None
+
+    def open(self):
+        import hid
+        self.device = hid.device()
+        if self.path:
+            self.device.open_path(self.path.encode())
+        else:
+            self.device.open(self.vendor_id, self.product_id)
+        return self
+
+    def read(self, max_length, timeout_ms=0):
+        return self.device.read(max_length, timeout_ms)
+
+    def close(self):
+        if self.device:
+            self.device.close()
+            self.device = None
+
+
+class RawReportRecorder:
+    """包装设备，把每个原始报告及其接收时间追加到原始日志"""
+    def __init__(self, device, log_path):
+        self.device = device
+        self.log_path = log_path
+        self.report_count = 0
+        self.file = open(log_path, 'wb')
+        self.file.write(RAW_LOG_MAGIC)
+
+    def read(self, max_length, timeout_ms=0):
+        data = self.device.read(max_length, timeout_ms)
+        if data:
+            arrival_time = time.time()
+            length = min(len(data), REPORT_SIZE)
+            self.file.write(RAW_RECORD_STRUCT.pack(arrival_time, length, bytes(data[:length])))
+            self.report_count += 1
+        return data
+
+    def close(self):
+        try:
+            self.device.close()
+        finally:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+def read_raw_log(log_path):
+    """以numpy.memmap方式读取原始日志，返回结构化记录数组"""
+    with open(log_path, 'rb') as f:
+        if f.read(len(RAW_LOG_MAGIC)) != RAW_LOG_MAGIC:
+            raise ValueError(f"不是原始报告日志: {log_path}")
+    count = (os.path.getsize(log_path) - len(RAW_LOG_MAGIC)) // RAW_RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=RAW_RECORD_DTYPE)
+    return np.memmap(log_path, dtype=RAW_RECORD_DTYPE, mode='r',
+                     offset=len(RAW_LOG_MAGIC), shape=(count,))
+
+
+def write_raw_log(log_path, arrival_times, reports):
+    """把(接收时间, 报告)序列写成原始日志，用于保存合成数据"""
+    with open(log_path, 'wb') as f:
+        f.write(RAW_LOG_MAGIC)
+        for arrival_time, data in zip(arrival_times, reports):
+            length = min(len(data), REPORT_SIZE)
+            f.write(RAW_RECORD_STRUCT.pack(arrival_time, length, bytes(data[:length])))
+
+
+def decode_raw_log(log_path, csv_path, local_start_time=None, master_start_time=None):
+    """使用与实时采集相同的解码器离线解码原始日志，输出与采集程序相同列的CSV"""
+    from cms50e_decoder import decode_reports, reconstruct_timestamps, SAMPLES_PER_REPORT
+    from oximeter_storage import CSVSink
+
+    records = read_raw_log(log_path)
+    arrival_times = np.asarray(records['arrival_time'])
+    if local_start_time is None:
+        local_start_time = float(arrival_times[0]) if len(arrival_times) else 0.0
+    if master_start_time is None:
+        master_start_time = local_start_time
+
+    decoded = decode_reports(np.asarray(records['data']), np.asarray(records['length']))
+    last_sample_index = np.arange(len(records)) * SAMPLES_PER_REPORT + SAMPLES_PER_REPORT - 1
+    sample_index = decoded['report_index'] * SAMPLES_PER_REPORT + decoded['sub_index']
+    sample_times = reconstruct_timestamps(arrival_times, last_sample_index, sample_index).tolist()
+
+    sink = CSVSink(csv_path)
+    try:
+        sink.write_rows(
+            (count, t, t - local_start_time, t - master_start_time, ppg, hr, spo2)
+            for count, (t, ppg, hr, spo2) in enumerate(zip(
+                sample_times, decoded['ppg'].tolist(), decoded['hr'].tolist(), decoded['spo2'].tolist()))
+        )
+    finally:
+        sink.close()
+    return len(sample_times)
+
+
+class _PacedDevice(abc.ABC):
+    """
+    按时间表输出报告的设备基类
+    speed为1时按原始间隔实时输出，大于1时加速，为0时尽可能快
+    """
+    def __init__(self, speed=1.0, loop=False):
+        self.speed = speed
+        self.loop = loop
+        self.reports_sent = 0
+        self.finished = False
+        self._start_wall = None
+        self._start_source = None
+        self._pending = None
+
+    def _take(self):
+        """取出下一个报告，优先返回上次超时未交付的报告"""
+        if self._pending is not None:
+            item, self._pending = self._pending, None
+            return item
+        return self._next_report()
+
+    @abc.abstractmethod
+    def _next_report(self):
+        """返回(源时间, 报告)，没有更多报告时返回None"""
+
+    @abc.abstractmethod
+    def _rewind(self):
+        """回到第一个报告(循环输出时调用)"""
+
+    def read(self, max_length, timeout_ms=0):
+        item = self._take()
+        if item is None and self.loop:
+            self._rewind()
+            self._start_wall = None
+            item = self._take()
+        if item is None:
+            # 回放结束，模拟设备无数据的超时
+            self.finished = True
+            time.sleep(timeout_ms / 1000.0 if timeout_ms > 0 else 0.1)
+            return []
+
+        source_time, data = item
+        if self.speed > 0:
+            now = time.perf_counter()
+            if self._start_wall is None:
+                self._start_wall = now
+                self._start_source = source_time
+            due = self._start_wall + (source_time - self._start_source) / self.speed
+            wait = due - now
+            if timeout_ms > 0 and wait > timeout_ms / 1000.0:
+                # 超时前没有报告到达，下次读取时再返回该报告
+                self._pending = item
+                time.sleep(timeout_ms / 1000.0)
+                return []
+            if wait > 0:
+                time.sleep(wait)
+
+        self.reports_sent += 1
+        return list(data[:max_length])
+
+    def close(self):
+        pass
+
+
+class ReplayDevice(_PacedDevice):
+    """回放原始日志中的报告，保留原始的到达间隔"""
+    def __init__(self, log_path, speed=1.0, loop=False):
+        super().__init__(speed, loop)
+        self.log_path = log_path
+        self.records = read_raw_log(log_path)
+        self._position = 0
+
+    def _next_report(self):
+        if self._position >= len(self.records):
+            return None
+        record = self.records[self._position]
+        self._position += 1
+        return float(record['arrival_time']), bytes(record['data'][:record['length']])
+
+    def _rewind(self):
+        self._position = 0
+
+
+class SyntheticDevice(_PacedDevice):
+    """
+    合成CMS50E设备
+    按sample_rate生成PPG样本，每个报告3个子包，每秒插入一次HR/SPO2更新子包
+    """
+    def __init__(self, sample_rate=60.0, heart_rate=72, spo2=98, speed=1.0, duration=None, seed=0):
+        super().__init__(speed)
+        self.sample_rate = sample_rate
+        self.heart_rate = heart_rate
+        self.spo2 = spo2
+        self.duration = duration
+        self.random = np.random.default_rng(seed)
+        self._sample_index = 0
+
+    def _ppg_value(self, t):
+        """简单的PPG波形: 收缩峰加重搏波，取值0~100"""
+        phase = (t * self.heart_rate / 60.0) % 1.0
+        systolic = math.exp(-((phase - 0.2) ** 2) / 0.006)
+        dicrotic = 0.35 * math.exp(-((phase - 0.55) ** 2) / 0.01)
+        noise = self.random.normal(0, 0.01)
+        return int(max(0, min(100, 10 + 80 * (systolic + dicrotic + noise))))
+
+    def _next_report(self):
+        t = self._sample_index / self.sample_rate
+        if self.duration is not None and t >= self.duration:
+            return None
+
+        report = []
+        for _ in range(3):
+            t = self._sample_index / self.sample_rate
+            if self._sample_index % int(self.sample_rate) == int(self.sample_rate) - 1:
+                report += [0x01, 1, 0, self.heart_rate, self.spo2, 0]
+            else:
+                report += [0x01, 0, 0, self._ppg_value(t), 0, 0]
+            self._sample_index += 1
+        # 报告在最后一个样本采集完成后到达
+        return t, bytes(report)
+
+    def _rewind(self):
+        self._sample_index = 0
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='血氧仪原始报告日志工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='从HID设备录制原始报告日志')
+    record_parser.add_argument('output', help='输出日志路径(.oxraw)')
+    record_parser.add_argument('--vendor-id', type=lambda x: int(x, 0), default=0x28E9)
+    record_parser.add_argument('--product-id', type=lambda x: int(x, 0), default=0x028A)
+    record_parser.add_argument('--duration', type=float, default=60, help='录制时长(秒)')
+
+    synth_parser = subparsers.add_parser('synthesize', help='生成合成PPG原始报告日志')
+    synth_parser.add_argument('output', help='输出日志路径(.oxraw)')
+    synth_parser.add_argument('--duration', type=float, default=60, help='时长(秒)')
+    synth_parser.add_argument('--sample-rate', type=float, default=60.0, help='采样率(Hz)')
+    synth_parser.add_argument('--heart-rate', type=int, default=72)
+
+    decode_parser = subparsers.add_parser('decode', help='离线解码原始报告日志为CSV')
+    decode_parser.add_argument('input', help='原始报告日志(.oxraw)')
+    decode_parser.add_argument('output', help='输出CSV路径')
+    decode_parser.add_argument('--local-start', type=float, default=None,
+                               help='本地开始时间戳(默认为第一个报告的接收时间)')
+    decode_parser.add_argument('--master-start', type=float, default=None,
+                               help='主机开始时间戳(默认与本地开始时间相同)')
+
+    info_parser = subparsers.add_parser('info', help='显示原始报告日志摘要')
+    info_parser.add_argument('files', nargs='+', help='原始报告日志(.oxraw)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.command == 'record':
+        recorder = RawReportRecorder(HIDDevice(args.vendor_id, args.product_id).open(), args.output)
+        end_time = time.time() + args.duration
+        try:
+            while time.time() < end_time:
+                recorder.read(REPORT_SIZE, 100)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+        print(f"已录制 {recorder.report_count} 个报告到 {args.output}")
+
+    elif args.command == 'synthesize':
+        device = SyntheticDevice(args.sample_rate, args.heart_rate, speed=0, duration=args.duration)
+        start = time.time()
+        times, reports = [], []
+        while True:
+            item = device._next_report()
+            if item is None:
+                break
+            times.append(start + item[0])
+            reports.append(item[1])
+        write_raw_log(args.output, times, reports)
+        print(f"已生成 {len(reports)} 个报告到 {args.output}")
+
+    elif args.command == 'decode':
+        count = decode_raw_log(args.input, args.output, args.local_start, args.master_start)
+        print(f"已解码 {count} 个样本到 {args.output}")
+
+    elif args.command == 'info':
+        for path in args.files:
+            records = read_raw_log(path)
+            if len(records) < 2:
+                print(f"{path}: {len(records)} 个报告")
+                continue
+            duration = records['arrival_time'][-1] - records['arrival_time'][0]
+            print(f"{path}: {len(records)} 个报告, 时长 {duration:.2f}秒, "
+                  f"报告速率 {(len(records) - 1) / duration:.2f}/秒")
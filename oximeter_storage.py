@@ -0,0 +1,338 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+
+'''
+血氧仪数据的落盘模块。
+采集线程只负责把数据行放入有界队列，由独立的写入线程保持文件句柄常开，
+按批量大小/时间间隔刷新，停止时执行fsync，避免磁盘I/O拖慢HID读取。
+
+除CSV外还支持紧凑的二进制格式(.oxb)：
+- 前 HEADER_SIZE 字节为文件头：魔数、文件头长度、记录长度，随后是JSON格式的会话/同步元数据
+- 之后是定长小端记录 RECORD_DTYPE，可直接用 numpy.memmap 读取而无需解析
+相对时间和校准后时间由文件头中的开始时间戳推算，导出CSV时与原格式列一致。
+'''
+
+# 与原有CSV输出保持一致的表头
+CSV_HEADER = ['数据点', '采集时间戳', '相对时间(秒)', '校准后时间(秒)', 'PPG', 'HR', 'SPO2']
+
+# 二进制格式定义
+BINARY_MAGIC = b'OXREC001'
+BINARY_EXTENSION = '.oxb'
+HEADER_SIZE = 4096
+HEADER_PREFIX = struct.Struct('<8sII')
+RECORD_STRUCT = struct.Struct('<IdBBBx')
+RECORD_DTYPE = np.dtype([
+    ('index', '<u4'),
+    ('timestamp', '<f8'),
+    ('ppg', 'u1'),
+    ('hr', 'u1'),
+    ('spo2', 'u1'),
+    ('reserved', 'u1'),
+])
+assert RECORD_DTYPE.itemsize == RECORD_STRUCT.size
+
+
+class CSVSink:
+    """CSV文件输出，整个会话只打开一次文件"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(CSV_HEADER)
+
+    def write_rows(self, rows):
+        """写入一批数据行 (数据点, 时间戳, 相对时间, 校准后时间, PPG, HR, SPO2)"""
+        self.writer.writerows(
+            [str(count), str(timestamp), f"{relative:.6f}", f"{calibrated:.6f}",
+             str(ppg), str(hr), str(spo2)]
+            for count, timestamp, relative, calibrated, ppg, hr, spo2 in rows
+        )
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        """刷新并强制写入磁盘"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def set_metadata(self, **metadata):
+        """CSV格式不保存元数据，同步信息记录在sync_info.txt中"""
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class BinarySink:
+    """
+    定长小端二进制记录输出，文件头保存会话/同步元数据
+    子类可替换魔数和记录格式，复用相同的文件头结构(如信号分析结果)
+    """
+    magic = BINARY_MAGIC
+    record_struct = RECORD_STRUCT
+    record_dtype = RECORD_DTYPE
+
+    def __init__(self, file_path, metadata=None):
+        self.file_path = file_path
+        self.metadata = dict(metadata or {})
+        self.metadata['record_format'] = self.record_dtype.descr
+        self.row_count = 0
+        self.file = open(file_path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        """写入(或重写)文件头，元数据不足部分以空格填充"""
+        self.metadata['row_count'] = self.row_count
+        body = json.dumps(self.metadata, ensure_ascii=False).encode('utf-8')
+        free = HEADER_SIZE - HEADER_PREFIX.size
+        if len(body) > free:
+            raise ValueError(f"元数据过大({len(body)}字节)，文件头最多容纳{free}字节")
+        header = HEADER_PREFIX.pack(self.magic, HEADER_SIZE, self.record_struct.size) + body.ljust(free, b' ')
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.seek(0, os.SEEK_END)
+
+    def write_rows(self, rows):
+        """写入一批数据行，相对时间和校准后时间由文件头推算，不单独保存"""
+        pack = self.record_struct.pack
+        self.file.write(b''.join(
+            pack(count, timestamp, ppg, hr, spo2)
+            for count, timestamp, _, _, ppg, hr, spo2 in rows
+        ))
+        self.row_count += len(rows)
+
+    def set_metadata(self, **metadata):
+        """更新元数据，关闭文件时写入文件头"""
+        self.metadata.update(metadata)
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        """更新文件头后刷新并强制写入磁盘"""
+        try:
+            self._write_header()
+        except ValueError as e:
+            print(f"更新文件头失败: {str(e)}")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def read_binary_header(file_path, magic=BINARY_MAGIC, record_dtype=RECORD_DTYPE):
+    """读取二进制文件头，返回(元数据, 文件头长度)"""
+    with open(file_path, 'rb') as f:
+        prefix = f.read(HEADER_PREFIX.size)
+        file_magic, header_size, record_size = HEADER_PREFIX.unpack(prefix)
+        if file_magic != magic:
+            raise ValueError(f"不是血氧仪二进制数据文件: {file_path}")
+        if record_size != record_dtype.itemsize:
+            raise ValueError(f"不支持的记录长度: {record_size}")
+        body = f.read(header_size - HEADER_PREFIX.size)
+    return json.loads(body.decode('utf-8').rstrip(' ')), header_size
+
+
+def open_binary_recording(file_path, magic=BINARY_MAGIC, record_dtype=RECORD_DTYPE):
+    """以numpy.memmap方式打开二进制数据文件，返回(元数据, 记录数组)"""
+    metadata, header_size = read_binary_header(file_path, magic, record_dtype)
+    record_count = (os.path.getsize(file_path) - header_size) // record_dtype.itemsize
+    if record_count == 0:
+        return metadata, np.zeros(0, dtype=record_dtype)
+    records = np.memmap(file_path, dtype=record_dtype, mode='r',
+                        offset=header_size, shape=(record_count,))
+    return metadata, records
+
+
+def export_csv(binary_path, csv_path=None, chunk_size=65536):
+    """将二进制数据文件转换为与原格式相同列的CSV文件"""
+    if csv_path is None:
+        csv_path = os.path.splitext(binary_path)[0] + '.csv'
+    metadata, records = open_binary_recording(binary_path)
+    local_start_time = metadata.get('local_start_time') or 0.0
+    master_start_time = metadata.get('master_start_time') or 0.0
+
+    sink = CSVSink(csv_path)
+    try:
+        for begin in range(0, len(records), chunk_size):
+            chunk = records[begin:begin + chunk_size]
+            timestamps = chunk['timestamp'].tolist()
+            sink.write_rows(
+                (count, t, t - local_start_time, t - master_start_time, ppg, hr, spo2)
+                for count, t, ppg, hr, spo2 in zip(
+                    chunk['index'].tolist(), timestamps,
+                    chunk['ppg'].tolist(), chunk['hr'].tolist(), chunk['spo2'].tolist())
+            )
+    finally:
+        sink.close()
+    return csv_path
+
+
+_STOP = object()  # 写入线程的结束标记
+
+
+class BufferedRowWriter:
+    """
+    后台批量写入器
+    采集线程调用put()放入数据行，队列满时丢弃并计数，永不阻塞采集线程
+    """
+    def __init__(self, sink, max_queue=20000, batch_size=256, flush_interval=1.0):
+        # 输出目标
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # 有界队列
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_queue = max_queue
+
+        # 统计计数
+        self.dropped_rows = 0
+        self.written_rows = 0
+        self.failed_rows = 0      # 写入出错的行
+        self.batches = 0
+        self.flushes = 0
+        self.max_queue_depth = 0
+
+        # 线程控制
+        self.closed = False
+        self._thread = threading.Thread(target=self._write_thread, daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        """放入一行数据，成功返回True，队列已满或已关闭返回False"""
+        if self.closed:
+            self.dropped_rows += 1
+            return False
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped_rows += 1
+            return False
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return True
+
+    def _write_thread(self):
+        """写入线程：批量取出数据行写入，按大小/时间策略刷新"""
+        pending = 0
+        last_flush = time.monotonic()
+        stopping = False
+
+        while not stopping:
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                first = None
+
+            batch = []
+            if first is _STOP:
+                stopping = True
+            elif first is not None:
+                batch.append(first)
+                while len(batch) < self.batch_size:
+                    try:
+                        row = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if row is _STOP:
+                        stopping = True
+                        break
+                    batch.append(row)
+
+            if batch:
+                try:
+                    self.sink.write_rows(batch)
+                    self.written_rows += len(batch)
+                    pending += len(batch)
+                except Exception as e:
+                    self.failed_rows += len(batch)
+                    print(f"写入数据时出错: {str(e)}")
+                self.batches += 1
+
+            now = time.monotonic()
+            if pending and (pending >= self.batch_size or now - last_flush >= self.flush_interval):
+                try:
+                    self.sink.flush()
+                except Exception as e:
+                    print(f"刷新数据文件时出错: {str(e)}")
+                self.flushes += 1
+                pending = 0
+                last_flush = now
+
+    def stats(self):
+        """返回队列深度与丢弃计数等统计信息"""
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'queue_capacity': self.max_queue,
+            'written_rows': self.written_rows,
+            'failed_rows': self.failed_rows,
+            'dropped_rows': self.dropped_rows,
+            'batches': self.batches,
+            'flushes': self.flushes,
+        }
+
+    def close(self, timeout=10):
+        """写完队列中剩余数据，fsync后关闭文件"""
+        if self.closed:
+            return
+        self.closed = True
+        # 结束标记排在剩余数据之后，写入线程写完后立即退出，不必等待轮询
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+        if self._thread.is_alive():
+            # 写入线程可能仍在写文件，不能关闭
+            print("写入线程未能在超时时间内结束，数据文件未关闭")
+            return
+        # 关闭时正在放入的行不会再被写入
+        self.dropped_rows += self.queue.qsize()
+        try:
+            self.sink.sync()
+        except Exception as e:
+            print(f"同步数据文件时出错: {str(e)}")
+        finally:
+            self.sink.close()
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='血氧仪二进制数据文件工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='将二进制数据文件导出为CSV')
+    export_parser.add_argument('files', nargs='+', help='二进制数据文件(.oxb)')
+    export_parser.add_argument('--output', type=str, default=None,
+                               help='输出CSV路径(仅转换单个文件时有效)')
+
+    info_parser = subparsers.add_parser('info', help='显示二进制数据文件的元数据')
+    info_parser.add_argument('files', nargs='+', help='二进制数据文件(.oxb)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.command == 'export':
+        for path in args.files:
+            output = args.output if len(args.files) == 1 else None
+            print(f"已导出: {export_csv(path, output)}")
+
+    elif args.command == 'info':
+        for path in args.files:
+            metadata, records = open_binary_recording(path)
+            print(f"{path}: {len(records)} 条记录")
+            print(json.dumps(metadata, ensure_ascii=False, indent=2))
@@ -0,0 +1,335 @@
+import csv
+import os
+import time
+import cv2
+import numpy as np
+from metrics import LatencyHistogram
+
+'''
+人脸区域(ROI)录制。
+rPPG只需要人脸区域，整帧编码和写盘是实验室电脑上限制帧率的主要开销:
+- 每隔N帧在缩小的图像上运行OpenCV人脸检测(默认YuNet，见 DEFAULT_YUNET_MODEL)，其间在上一位置附近用模板匹配跟踪，检测/跟踪都失败时保持上一位置
+- 人脸框经指数平滑后扩展边距并调整为输出的宽高比，裁剪后缩放到固定尺寸写入视频
+- 每帧实际裁剪的区域(原始帧坐标)写入旁路文件 <视频名>_roi.csv
+- 可选同时写入一路低分辨率的整帧视频 <视频名>_full.mp4 (有自己的帧索引，与其他视频一样参与对齐)
+'''
+
+ROI_FILE_SUFFIX = "_roi.csv"
+FULL_VIDEO_SUFFIX = "_full"
+ROI_HEADER = ['帧号', 'x', 'y', '宽', '高', '来源']   # 来源: detect 检测 / track 跟踪 / hold 保持上一位置
+DEFAULT_CASCADE = "haarcascade_frontalface_default.xml"
+# 默认人脸检测模型: OpenCV Zoo 的 YuNet，需下载到程序目录下的 models/ 中
+YUNET_MODEL_URL = ("https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/"
+                   "face_detection_yunet_2023mar.onnx")
+DEFAULT_YUNET_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models",
+                                   "face_detection_yunet_2023mar.onnx")
+
+DEFAULT_ROI_OPTIONS = {
+    'size': (256, 256),       # 输出视频尺寸(宽, 高)
+    'detect_interval': 5,     # 每隔多少帧运行一次人脸检测
+    'model': None,            # 人脸检测模型: YuNet ONNX或Haar级联XML文件，None为 DEFAULT_YUNET_MODEL，'none'为不检测(固定中心区域)
+    'detect_width': 320,      # 检测和跟踪使用的缩小图像宽度
+    'margin': 0.25,           # 人脸框每边扩展的比例
+    'smoothing': 0.3,         # 指数平滑系数，越小越平稳
+    'full_scale': 0,          # 低分辨率整帧视频的缩放比例，0为不保存
+}
+
+
+def roi_file_path(video_path):
+    """返回视频对应的ROI框文件路径"""
+    return os.path.splitext(video_path)[0] + ROI_FILE_SUFFIX
+
+
+def full_video_path(video_path):
+    """返回低分辨率整帧视频路径，如 video.mp4 -> video_full.mp4"""
+    base, ext = os.path.splitext(video_path)
+    return base + FULL_VIDEO_SUFFIX + ext
+
+
+def parse_size(text):
+    """解析 宽x高 格式的尺寸"""
+    width, height = (int(value) for value in str(text).lower().split('x'))
+    if width <= 0 or height <= 0:
+        raise ValueError(f"尺寸无效: {text}")
+    return width, height
+
+
+def read_roi_file(path):
+    """读取ROI框文件，返回(帧号数组, 框数组Nx4, 来源列表)"""
+    frames, boxes, sources = [], [], []
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            frames.append(int(row[0]))
+            boxes.append([int(value) for value in row[1:5]])
+            sources.append(row[5])
+    return np.array(frames, dtype=np.int64), np.array(boxes, dtype=np.int64).reshape(-1, 4), sources
+
+
+class FaceDetector:
+    """
+    OpenCV人脸检测，model为.onnx时使用YuNet(FaceDetectorYN)，否则为Haar级联文件
+    model为None时使用 DEFAULT_YUNET_MODEL；该文件不存在时只有带Haar级联的OpenCV 4可退回自带的正脸级联
+    """
+    def __init__(self, model=None):
+        self.cascade = None
+        self.yunet = None
+        if model is None and (os.path.exists(DEFAULT_YUNET_MODEL) or not hasattr(cv2, 'CascadeClassifier')):
+            model = DEFAULT_YUNET_MODEL
+        if model and model.lower().endswith('.onnx'):
+            if not os.path.exists(model):
+                raise ValueError(f"找不到人脸检测模型: {model}，YuNet模型可从 {YUNET_MODEL_URL} 下载")
+            self.yunet = cv2.FaceDetectorYN.create(model, "", (320, 320))
+            self.input_size = None
+            return
+        # OpenCV 5 的主模块不再包含Haar级联
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise ValueError("当前OpenCV不支持Haar级联检测，请指定YuNet人脸检测模型(.onnx)")
+        path = model or os.path.join(cv2.data.haarcascades, DEFAULT_CASCADE)
+        self.cascade = cv2.CascadeClassifier(path)
+        if self.cascade.empty():
+            raise ValueError(f"无法加载人脸检测模型: {path}")
+
+    def detect(self, image, gray):
+        """在缩小的图像上检测人脸，返回[(x, y, 宽, 高)]"""
+        if self.yunet is not None:
+            size = (image.shape[1], image.shape[0])
+            if size != self.input_size:
+                self.yunet.setInputSize(size)
+                self.input_size = size
+            _, faces = self.yunet.detect(image)
+            return [] if faces is None else [tuple(face[:4]) for face in faces]
+        min_size = max(gray.shape[0] // 8, 20)
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+        return [tuple(face) for face in faces]
+
+
+class RoiTracker:
+    """
+    逐帧确定裁剪区域
+    frame_size / output_size: 原始帧和输出视频的(宽, 高)
+    detector: 具有 detect(image, gray) 接口的检测器，None时不检测，使用画面中心的固定区域
+    """
+    def __init__(self, frame_size, output_size, detector=None, detect_interval=5, detect_width=320,
+                 margin=0.25, smoothing=0.3, search=0.5, min_score=0.5):
+        # 参数
+        self.frame_size = frame_size
+        self.aspect = output_size[0] / output_size[1]
+        self.detector = detector
+        self.detect_interval = max(1, detect_interval)
+        self.scale = min(1.0, detect_width / frame_size[0])
+        self.small_size = (max(1, round(frame_size[0] * self.scale)), max(1, round(frame_size[1] * self.scale)))
+        self.margin = margin
+        self.smoothing = smoothing
+        self.search = search
+        self.min_score = min_score
+
+        # 跟踪状态(缩小图像坐标)
+        self.face = None          # 最近一次检测/跟踪到的人脸框
+        self.template = None      # 检测时截取的人脸灰度图
+        self.smoothed = None      # 平滑后的人脸中心和尺寸(原始帧坐标)
+        self.frame_count = 0
+
+        # 统计
+        self.counts = {'detect': 0, 'track': 0, 'hold': 0}
+        self.detect_runs = 0
+        self.detect_timer = LatencyHistogram()
+        self.track_timer = LatencyHistogram()
+
+    def _detect(self, image, gray):
+        start = time.perf_counter()
+        faces = self.detector.detect(image, gray)
+        self.detect_timer.add(time.perf_counter() - start)
+        self.detect_runs += 1
+        if not len(faces):
+            return None
+        if self.face is None:
+            face = max(faces, key=lambda box: box[2] * box[3])
+        else:
+            # 多个人脸时取离上一位置最近的
+            cx, cy = self.face[0] + self.face[2] / 2, self.face[1] + self.face[3] / 2
+            face = min(faces, key=lambda box: (box[0] + box[2] / 2 - cx) ** 2 + (box[1] + box[3] / 2 - cy) ** 2)
+        x, y, w, h = (int(round(value)) for value in face)
+        x, y = max(x, 0), max(y, 0)
+        w, h = min(w, gray.shape[1] - x), min(h, gray.shape[0] - y)
+        if w < 4 or h < 4:
+            return None
+        self.template = gray[y:y + h, x:x + w].copy()
+        return x, y, w, h
+
+    def _track(self, gray):
+        """在上一位置附近用模板匹配查找人脸，相关系数低于min_score时返回None"""
+        start = time.perf_counter()
+        try:
+            x, y, w, h = self.face
+            pad_x, pad_y = int(w * self.search) + 1, int(h * self.search) + 1
+            left, top = max(x - pad_x, 0), max(y - pad_y, 0)
+            right, bottom = min(x + w + pad_x, gray.shape[1]), min(y + h + pad_y, gray.shape[0])
+            window = gray[top:bottom, left:right]
+            th, tw = self.template.shape
+            if window.shape[0] < th or window.shape[1] < tw:
+                return None
+            scores = cv2.matchTemplate(window, self.template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, location = cv2.minMaxLoc(scores)
+            if score < self.min_score:
+                return None
+            return left + location[0], top + location[1], tw, th
+        finally:
+            self.track_timer.add(time.perf_counter() - start)
+
+    def _smooth(self, face):
+        """人脸框(缩小图像坐标)转换到原始帧坐标并做指数平滑"""
+        x, y, w, h = (value / self.scale for value in face)
+        target = np.array([x + w / 2, y + h / 2, w, h])
+        if self.smoothed is None:
+            self.smoothed = target
+        else:
+            self.smoothed = self.smoothed + self.smoothing * (target - self.smoothed)
+
+    def crop_box(self):
+        """由平滑后的人脸框得到裁剪区域(x, y, 宽, 高)，保持输出宽高比并限制在画面内"""
+        frame_w, frame_h = self.frame_size
+        if self.smoothed is None:
+            # 还没有检测到人脸时使用画面中心
+            cx, cy, h = frame_w / 2, frame_h / 2, frame_h * 0.6
+            w = h * self.aspect
+        else:
+            cx, cy, face_w, face_h = self.smoothed
+            w, h = face_w * (1 + 2 * self.margin), face_h * (1 + 2 * self.margin)
+            if w / h < self.aspect:
+                w = h * self.aspect
+            else:
+                h = w / self.aspect
+        fit = min(1.0, frame_w / w, frame_h / h)
+        w, h = max(int(round(w * fit)), 2), max(int(round(h * fit)), 2)
+        x = int(round(min(max(cx - w / 2, 0), frame_w - w)))
+        y = int(round(min(max(cy - h / 2, 0), frame_h - h)))
+        return x, y, w, h
+
+    def update(self, frame):
+        """处理一帧，返回(裁剪区域, 来源)"""
+        source = 'hold'
+        if self.detector is not None or self.template is not None:
+            # 只用于定位，线性插值缩小比INTER_AREA快得多
+            small = cv2.resize(frame, self.small_size, interpolation=cv2.INTER_LINEAR)
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            face = None
+            if self.detector is not None and self.frame_count % self.detect_interval == 0:
+                face = self._detect(small, gray)
+                if face is not None:
+                    source = 'detect'
+            if face is None and self.face is not None and self.template is not None:
+                face = self._track(gray)
+                if face is not None:
+                    source = 'track'
+            if face is not None:
+                self.face = face
+                self._smooth(face)
+        self.frame_count += 1
+        self.counts[source] += 1
+        return self.crop_box(), source
+
+    def stats(self):
+        return {
+            'detect_frames': self.counts['detect'],
+            'track_frames': self.counts['track'],
+            'hold_frames': self.counts['hold'],
+            'detect_runs': self.detect_runs,
+            'detect': self.detect_timer.summary(),
+            'track': self.track_timer.summary(),
+        }
+
+
+class RoiVideoWriter:
+    """
+    只写入人脸区域的视频写入器，接口与cv2.VideoWriter相同，按帧顺序调用write()
+    writer: 输出尺寸的视频写入器(cv2.VideoWriter或SegmentedVideoWriter)
+    full_writer: 可选的低分辨率整帧视频写入器，full_size为其尺寸
+    """
+    timed = True  # write() 接受帧的采集时间，转交给分段写入器
+
+    def __init__(self, writer, tracker, roi_path, output_size, full_writer=None, full_size=None):
+        self.writer = writer
+        self.tracker = tracker
+        self.output_size = output_size
+        self.full_writer = full_writer
+        self.full_size = full_size
+        self.roi_file = open(roi_path, 'w', newline='')
+        self.roi_writer = csv.writer(self.roi_file)
+        self.roi_writer.writerow(ROI_HEADER)
+        self.frame = 0
+
+    @staticmethod
+    def _write(writer, image, wall_time, monotonic_time):
+        if getattr(writer, 'timed', False):
+            writer.write(image, wall_time, monotonic_time)
+        else:
+            writer.write(image)
+
+    def write(self, image, wall_time=None, monotonic_time=None):
+        (x, y, w, h), source = self.tracker.update(image)
+        # 人脸区域按面积平均缩放，保留rPPG需要的像素均值；整帧视频仅供查看，用线性插值
+        crop = cv2.resize(image[y:y + h, x:x + w], self.output_size, interpolation=cv2.INTER_AREA)
+        self._write(self.writer, crop, wall_time, monotonic_time)
+        self.roi_writer.writerow([self.frame, x, y, w, h, source])
+        if self.full_writer is not None:
+            full = cv2.resize(image, self.full_size, interpolation=cv2.INTER_LINEAR)
+            self._write(self.full_writer, full, wall_time, monotonic_time)
+        self.frame += 1
+
+    @property
+    def completed_segments(self):
+        return getattr(self.writer, 'completed_segments', None)
+
+    def roi_stats(self):
+        stats = self.tracker.stats()
+        stats['output_size'] = list(self.output_size)
+        stats['full_size'] = list(self.full_size) if self.full_writer is not None else None
+        return stats
+
+    def release(self):
+        self.writer.release()
+        if self.full_writer is not None:
+            self.full_writer.release()
+        if not self.roi_file.closed:
+            self.roi_file.flush()
+            os.fsync(self.roi_file.fileno())
+            self.roi_file.close()
+
+
+def roi_options(options=None):
+    """用默认值补全ROI录制参数"""
+    merged = dict(DEFAULT_ROI_OPTIONS)
+    merged.update({key: value for key, value in (options or {}).items() if value is not None})
+    merged['size'] = tuple(parse_size(merged['size']) if isinstance(merged['size'], str) else merged['size'])
+    return merged
+
+
+def load_detector(model=None):
+    """加载人脸检测器，model为'none'时返回None(不检测)，加载失败时抛出ValueError"""
+    if model == 'none':
+        return None
+    return FaceDetector(model)
+
+
+def open_roi_writer(video_path, frame_size, options, open_writer):
+    """
+    创建ROI视频写入器，返回(写入器, 整帧视频路径或None)
+    open_writer(path, frame_size): 按录制设置(是否分段)创建视频写入器
+    """
+    options = roi_options(options)
+    tracker = RoiTracker(frame_size, options['size'], detector=load_detector(options['model']),
+                         detect_interval=options['detect_interval'], detect_width=options['detect_width'],
+                         margin=options['margin'], smoothing=options['smoothing'])
+    full_path = full_size = full_writer = None
+    if options['full_scale']:
+        # 编码器要求偶数尺寸
+        full_size = (max(2, int(frame_size[0] * options['full_scale']) // 2 * 2),
+                     max(2, int(frame_size[1] * options['full_scale']) // 2 * 2))
+        full_path = full_video_path(video_path)
+        full_writer = open_writer(full_path, full_size)
+    writer = RoiVideoWriter(open_writer(video_path, options['size']), tracker, roi_file_path(video_path),
+                            options['size'], full_writer, full_size)
+    return writer, full_path
+
@@ -0,0 +1,534 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import socket
+import sqlite3
+import time
+from metrics import write_summary
+
+'''
+结构化会话信息与本地会话目录。
+- 主机和从机在每个会话目录写入 session.json(开始时状态为recording，停止后为complete)，与 sync_info.txt 并存
+- SessionCatalog 用SQLite索引 experiment_data / oximeter_data 下的会话: 时间、时长、设备、文件大小和时钟同步质量；
+  按目录和会话信息文件的修改时间增量更新，没有 session.json 的旧会话从 sync_info.txt 解析导入
+- 命令行: update/rebuild 更新或重建目录，query 按条件查询
+'''
+
+SESSION_FILE = "session.json"
+SESSION_SCHEMA = 1
+CATALOG_FILE = "session_catalog.db"
+MASTER_SESSION_PATTERN = re.compile(r'oxygen_data_(\d{8}_\d{6})')
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    root TEXT NOT NULL,
+    role TEXT,
+    session_id TEXT,
+    master_session TEXT,
+    host TEXT,
+    status TEXT,
+    start_time REAL,
+    stop_time REAL,
+    duration REAL,
+    device_count INTEGER,
+    file_count INTEGER,
+    total_bytes INTEGER,
+    sync_slaves INTEGER,
+    sync_failed INTEGER,
+    sync_max_delay_ms REAL,
+    sync_max_residual_ms REAL,
+    source TEXT,
+    signature TEXT,
+    indexed_at REAL,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS devices (
+    session INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    kind TEXT,
+    name TEXT,
+    identifier TEXT,
+    serial TEXT,
+    file TEXT,
+    count INTEGER,
+    rate REAL,
+    dropped INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    session INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    name TEXT,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS sync (
+    session INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    slave TEXT,
+    offset REAL,
+    drift_ppm REAL,
+    min_delay_ms REAL,
+    residual_ms REAL,
+    rounds INTEGER
+);
+CREATE INDEX IF NOT EXISTS sessions_start ON sessions(start_time);
+CREATE INDEX IF NOT EXISTS sessions_duration ON sessions(duration);
+CREATE INDEX IF NOT EXISTS sessions_master ON sessions(master_session);
+CREATE INDEX IF NOT EXISTS sessions_root ON sessions(root);
+CREATE INDEX IF NOT EXISTS devices_session ON devices(session);
+CREATE INDEX IF NOT EXISTS devices_identifier ON devices(identifier);
+CREATE INDEX IF NOT EXISTS devices_serial ON devices(serial);
+CREATE INDEX IF NOT EXISTS files_session ON files(session);
+CREATE INDEX IF NOT EXISTS sync_session ON sync(session);
+"""
+
+
+def master_session_id(file_name):
+    """从主机指定的数据文件名(oxygen_data_<会话>.csv)中取出主机会话编号"""
+    match = MASTER_SESSION_PATTERN.search(file_name or "")
+    return match.group(1) if match else None
+
+
+def write_session_file(session_dir, metadata):
+    """写入结构化会话信息，先写临时文件再替换"""
+    metadata = dict(metadata)
+    metadata.setdefault('schema', SESSION_SCHEMA)
+    metadata.setdefault('host', socket.gethostname())
+    metadata['updated'] = time.time()
+    write_summary(os.path.join(session_dir, SESSION_FILE), metadata)
+
+
+def master_metadata(session_id, status, start_time, stop_time, video_filename, cameras,
+                    camera_stats=None, command_log=None, clock_sync=None, **extra):
+    """主机会话信息: 摄像头、从机命令送达结果和时钟同步结果"""
+    devices = []
+    for number, camera in enumerate(cameras):
+        stats = (camera_stats or [None] * len(cameras))[number]
+        devices.append({
+            'kind': 'camera',
+            'name': f"摄像头{number}",
+            'identifier': str(camera.source),
+            'file': os.path.basename(camera.video_path) if camera.video_path else None,
+            'count': stats['encoded_frames'] if stats else None,
+            'rate': stats['achieved_fps'] if stats else None,
+            'dropped': stats['dropped_frames'] if stats else None,
+        })
+    metadata = {
+        'role': 'master',
+        'session_id': session_id,
+        'master_session': session_id,
+        'status': status,
+        'start_time': start_time,
+        'stop_time': stop_time,
+        'duration': stop_time - start_time if stop_time else None,
+        'video_filename': video_filename,
+        'devices': devices,
+        'commands': command_log or {},
+        'clock_sync': clock_sync or {},
+    }
+    metadata.update(extra)
+    return metadata
+
+
+def index_session(session_dir):
+    """把会话加入所在数据目录的会话目录(数据目录/session_catalog.db)，出错时只打印"""
+    session_dir = os.path.abspath(session_dir)
+    try:
+        catalog = SessionCatalog(os.path.join(os.path.dirname(session_dir), CATALOG_FILE))
+        try:
+            catalog.update_session(session_dir)
+        finally:
+            catalog.close()
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"更新会话目录时出错: {str(e)}")
+
+
+def _float(value):
+    try:
+        return float(str(value).rstrip('秒').strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def legacy_metadata(session_dir):
+    """从旧的 sync_info.txt 解析会话信息，无法判断角色时返回None"""
+    # 旧文件以系统默认编码写入(如cp936)，按UTF-8读取时中文键无法匹配
+    from align_sessions import read_sync_lines
+    lines = read_sync_lines(os.path.join(session_dir, "sync_info.txt"))
+    info = {}
+    for line in lines:
+        key, sep, value = line.partition(': ')
+        if sep:
+            info.setdefault(key, value)
+
+    session_id = os.path.basename(os.path.normpath(session_dir))
+    if '视频开始时间戳' in info:
+        start_time = _float(info['视频开始时间戳'])
+        stop_time = _float(info.get('停止命令时间戳'))
+        devices = {}
+        commands = {}
+        clock_sync = {}
+        for line in lines:
+            match = re.match(r'^摄像头(\d+): (.*), 视频文件: (.*)$', line)
+            if match:
+                devices.setdefault(int(match.group(1)), {}).update(
+                    identifier=match.group(2), file=match.group(3))
+                continue
+            match = re.match(r'^摄像头(\d+) (编码帧数|实际帧率|丢帧数): ([\d.]+)$', line)
+            if match:
+                key = {'编码帧数': 'count', '实际帧率': 'rate', '丢帧数': 'dropped'}[match.group(2)]
+                devices.setdefault(int(match.group(1)), {})[key] = float(match.group(3))
+                continue
+            match = re.match(r'^从机 ([^\s:]+): (\w+) (\S+?),? ', line + ' ')
+            if match:
+                commands.setdefault(match.group(2), {})[match.group(1)] = {
+                    'status': None if match.group(3) == '未确认' else match.group(3)}
+                continue
+            match = re.match(r'^从机 (\S+) 时钟同步: 无有效样本', line)
+            if match:
+                clock_sync[match.group(1)] = None
+                continue
+            match = re.match(r'^从机 (\S+) (时钟偏差|时钟漂移|往返延迟|同步轮数): (.*)$', line)
+            if match:
+                result = clock_sync.setdefault(match.group(1), {}) or {}
+                clock_sync[match.group(1)] = result
+                numbers = [float(x) for x in re.findall(r'-?\d+(?:\.\d+)?(?:e-?\d+)?', match.group(3))]
+                if match.group(2) == '时钟偏差' and numbers:
+                    result['offset'] = numbers[0]
+                elif match.group(2) == '时钟漂移' and numbers:
+                    result['drift_ppm'] = numbers[0]
+                elif match.group(2) == '往返延迟' and len(numbers) >= 2:
+                    result['min_delay'] = numbers[0] / 1000
+                    result['median_delay'] = numbers[1] / 1000
+                elif match.group(2) == '同步轮数' and len(numbers) >= 3:
+                    result['rounds'] = int(numbers[0])
+                    result['samples'] = int(numbers[1])
+                    result['residual'] = numbers[2] / 1000
+        if not devices and info.get('视频文件名'):
+            # 多摄像头之前的会话只有一个视频
+            devices[0] = {'identifier': '', 'file': info['视频文件名']}
+        return {
+            'role': 'master',
+            'session_id': session_id,
+            'master_session': session_id,
+            'status': 'complete' if stop_time else 'recording',
+            'start_time': start_time,
+            'stop_time': stop_time,
+            'duration': _float(info.get('录制总时长')),
+            'video_filename': info.get('视频文件名'),
+            'devices': [dict({'kind': 'camera', 'name': f"摄像头{number}"}, **device)
+                        for number, device in sorted(devices.items())],
+            'commands': commands,
+            'clock_sync': clock_sync,
+        }
+
+    if '本地开始时间戳' in info:
+        start_time = _float(info['本地开始时间戳'])
+        stop_time = _float(info.get('本地停止时间戳'))
+        devices = {}
+        for line in lines:
+            match = re.match(r'^(设备\d+): 路径 (.*), 序列号 (.*), 数据文件 (.*)$', line)
+            if match:
+                devices.setdefault(match.group(1), {}).update(
+                    identifier=match.group(2), serial=match.group(3), file=match.group(4))
+                continue
+            match = re.match(r'^(?:(设备\d+) )?(采集样本数|估计采样率|丢弃行数): ([\d.]+)', line)
+            if match:
+                key = {'采集样本数': 'count', '估计采样率': 'rate', '丢弃行数': 'dropped'}[match.group(2)]
+                devices.setdefault(match.group(1) or "设备1", {})[key] = float(match.group(3))
+        if '设备1' in devices and 'file' not in devices['设备1'] and info.get('文件名'):
+            devices['设备1']['file'] = info['文件名']
+        return {
+            'role': 'slave',
+            'session_id': session_id,
+            'master_session': master_session_id(info.get('文件名')),
+            'status': 'complete' if stop_time else 'recording',
+            'start_time': start_time,
+            'stop_time': stop_time,
+            'duration': stop_time - start_time if start_time and stop_time else None,
+            'master_start_time': _float(info.get('主机开始时间戳')),
+            'time_offset': _float(info.get('时间偏差')),
+            'master_addr': info.get('主机地址'),
+            'local_addr': info.get('本机地址'),
+            'devices': [dict({'kind': 'oximeter', 'name': name}, **device)
+                        for name, device in sorted(devices.items())],
+        }
+    return None
+
+
+def read_session(session_dir):
+    """读取会话信息，返回(信息, 来源)；不是会话目录时返回(None, None)"""
+    path = os.path.join(session_dir, SESSION_FILE)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f), 'json'
+    if os.path.exists(os.path.join(session_dir, "sync_info.txt")):
+        return legacy_metadata(session_dir), 'legacy'
+    return None, None
+
+
+def session_signature(session_dir):
+    """目录和会话信息文件的修改时间，用于判断是否需要重新索引"""
+    parts = [str(os.stat(session_dir).st_mtime_ns)]
+    for name in (SESSION_FILE, "sync_info.txt"):
+        try:
+            stat = os.stat(os.path.join(session_dir, name))
+            parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        except OSError:
+            parts.append("-")
+    return "/".join(parts)
+
+
+def parse_time(text):
+    """解析 2026-01-31、2026-01-31 08:00 或会话编号 20260131_080000 格式的时间"""
+    for layout in ("%Y%m%d_%H%M%S", "%Y%m%d"):
+        try:
+            return datetime.datetime.strptime(text, layout).timestamp()
+        except ValueError:
+            pass
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+class SessionCatalog:
+    """
+    会话目录(SQLite)
+    path: 数据库文件路径
+    """
+    def __init__(self, path=CATALOG_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(CATALOG_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, roots, rebuild=False):
+        """增量更新各数据目录下的会话，rebuild为True时重新导入全部会话，返回(新增或更新数, 删除数, 未变数)"""
+        updated = removed = unchanged = 0
+        with self.connection:
+            for root in roots:
+                root = os.path.abspath(root)
+                if rebuild:
+                    self.connection.execute("DELETE FROM sessions WHERE root = ?", (root,))
+                known = {row['path']: row['signature'] for row in self.connection.execute(
+                    "SELECT path, signature FROM sessions WHERE root = ?", (root,))}
+                present = set()
+                for entry in sorted(os.scandir(root), key=lambda entry: entry.name) if os.path.isdir(root) else []:
+                    if not entry.is_dir():
+                        continue
+                    path = entry.path
+                    signature = session_signature(path)
+                    if known.get(path) == signature:
+                        present.add(path)
+                        unchanged += 1
+                        continue
+                    try:
+                        if self._index_session(root, path, signature):
+                            present.add(path)
+                            updated += 1
+                    except (OSError, ValueError) as e:
+                        print(f"索引会话 {path} 时出错: {str(e)}")
+                for path in set(known) - present:
+                    self.connection.execute("DELETE FROM sessions WHERE path = ?", (path,))
+                    removed += 1
+        return updated, removed, unchanged
+
+    def update_session(self, session_dir):
+        """索引单个会话(采集程序停止时调用)"""
+        session_dir = os.path.abspath(session_dir)
+        with self.connection:
+            self._index_session(os.path.dirname(session_dir), session_dir, session_signature(session_dir))
+
+    def _index_session(self, root, path, signature):
+        metadata, source = read_session(path)
+        if metadata is None:
+            return False
+        files = []
+        for entry in os.scandir(path):
+            if entry.is_file() and entry.name != SESSION_FILE + ".tmp":
+                files.append((entry.name, entry.stat().st_size))
+
+        # 时钟同步质量: 主机会话记录每个从机的结果
+        clock_sync = metadata.get('clock_sync') or {}
+        results = [result for result in clock_sync.values() if result]
+        delays = [result['min_delay'] * 1000 for result in results if result.get('min_delay') is not None]
+        residuals = [result['residual'] * 1000 for result in results if result.get('residual') is not None]
+
+        self.connection.execute("DELETE FROM sessions WHERE path = ?", (path,))
+        cursor = self.connection.execute(
+            "INSERT INTO sessions (path, root, role, session_id, master_session, host, status, start_time, "
+            "stop_time, duration, device_count, file_count, total_bytes, sync_slaves, sync_failed, "
+            "sync_max_delay_ms, sync_max_residual_ms, source, signature, indexed_at, metadata) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, root, metadata.get('role'), metadata.get('session_id'), metadata.get('master_session'),
+             metadata.get('host'), metadata.get('status'), metadata.get('start_time'), metadata.get('stop_time'),
+             metadata.get('duration'), len(metadata.get('devices', [])), len(files),
+             sum(size for _, size in files), len(clock_sync), len(clock_sync) - len(results),
+             max(delays) if delays else None, max(residuals) if residuals else None,
+             source, signature, time.time(), json.dumps(metadata, ensure_ascii=False, default=str)))
+        session = cursor.lastrowid
+        self.connection.executemany(
+            "INSERT INTO devices (session, kind, name, identifier, serial, file, count, rate, dropped) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(session, device.get('kind'), device.get('name'), device.get('identifier'), device.get('serial'),
+              device.get('file'), device.get('count'), device.get('rate'), device.get('dropped'))
+             for device in metadata.get('devices', [])])
+        self.connection.executemany(
+            "INSERT INTO files (session, name, size) VALUES (?, ?, ?)",
+            [(session, name, size) for name, size in files])
+        self.connection.executemany(
+            "INSERT INTO sync (session, slave, offset, drift_ppm, min_delay_ms, residual_ms, rounds) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(session, ip, result.get('offset'), result.get('drift_ppm'),
+              result['min_delay'] * 1000 if result.get('min_delay') is not None else None,
+              result['residual'] * 1000 if result.get('residual') is not None else None,
+              result.get('rounds'))
+             for ip, result in clock_sync.items() if result])
+        return True
+
+    def query(self, role=None, since=None, until=None, min_duration=None, max_duration=None, device=None,
+              min_bytes=None, max_bytes=None, good_sync=False, max_sync_delay_ms=None,
+              max_sync_residual_ms=None, status=None, limit=None):
+        """
+        按条件查询会话，返回字典列表(按开始时间排序)
+        从机会话的同步质量取同一主机会话(master_session)的结果
+        """
+        conditions = []
+        parameters = []
+        if role:
+            conditions.append("s.role = ?")
+            parameters.append(role)
+        if status:
+            conditions.append("s.status = ?")
+            parameters.append(status)
+        if since is not None:
+            conditions.append("s.start_time >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("s.start_time < ?")
+            parameters.append(until)
+        if min_duration is not None:
+            conditions.append("s.duration >= ?")
+            parameters.append(min_duration)
+        if max_duration is not None:
+            conditions.append("s.duration <= ?")
+            parameters.append(max_duration)
+        if min_bytes is not None:
+            conditions.append("s.total_bytes >= ?")
+            parameters.append(min_bytes)
+        if max_bytes is not None:
+            conditions.append("s.total_bytes <= ?")
+            parameters.append(max_bytes)
+        if device:
+            pattern = f"%{device}%"
+            conditions.append(
+                "(s.host LIKE ? OR EXISTS (SELECT 1 FROM devices d WHERE d.session = s.id AND "
+                "(d.identifier LIKE ? OR d.serial LIKE ? OR d.name LIKE ?)) OR "
+                "EXISTS (SELECT 1 FROM sync y WHERE y.session = s.id AND y.slave LIKE ?))")
+            parameters.extend([pattern] * 5)
+        if good_sync:
+            conditions.append("sync_slaves > 0 AND sync_failed = 0")
+        if max_sync_delay_ms is not None:
+            conditions.append("sync_max_delay_ms <= ?")
+            parameters.append(max_sync_delay_ms)
+        if max_sync_residual_ms is not None:
+            conditions.append("sync_max_residual_ms <= ?")
+            parameters.append(max_sync_residual_ms)
+
+        sql = ("SELECT * FROM (SELECT s.id, s.path, s.role, s.session_id, s.master_session, s.host, s.status, "
+               "s.start_time, s.stop_time, s.duration, s.device_count, s.file_count, s.total_bytes, s.source, "
+               "COALESCE(m.sync_slaves, s.sync_slaves) AS sync_slaves, "
+               "COALESCE(m.sync_failed, s.sync_failed) AS sync_failed, "
+               "COALESCE(m.sync_max_delay_ms, s.sync_max_delay_ms) AS sync_max_delay_ms, "
+               "COALESCE(m.sync_max_residual_ms, s.sync_max_residual_ms) AS sync_max_residual_ms "
+               "FROM sessions s LEFT JOIN sessions m ON s.role = 'slave' AND m.role = 'master' "
+               "AND m.session_id = s.master_session) s")
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY start_time"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def devices(self, session):
+        """返回会话的设备列表"""
+        return [dict(row) for row in self.connection.execute(
+            "SELECT kind, name, identifier, serial, file, count, rate, dropped FROM devices WHERE session = ?",
+            (session,))]
+
+
+def format_session(row):
+    """将查询结果格式化为一行文本"""
+    start = datetime.datetime.fromtimestamp(row['start_time']).strftime("%Y-%m-%d %H:%M:%S") \
+        if row['start_time'] else "-"
+    duration = f"{row['duration'] / 60:.1f}分钟" if row['duration'] else "-"
+    if row['sync_slaves']:
+        delay = row['sync_max_delay_ms']
+        sync = f"同步 {row['sync_slaves'] - row['sync_failed']}/{row['sync_slaves']}" + \
+            (f", 往返 {delay:.2f}ms" if delay is not None else "")
+    else:
+        sync = "无同步"
+    return (f"{row['role']:<6} {row['session_id']} {start} {duration:>10} 设备 {row['device_count']} "
+            f"{row['total_bytes'] / 1e6:.1f}MB {sync} {row['status'] or ''} {row['path']}")
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='会话目录: 索引和查询主机/从机的会话')
+    parser.add_argument('--db', type=str, default=CATALOG_FILE, help='目录数据库文件')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name, description in (('update', '增量更新目录'), ('rebuild', '重新导入全部会话(包括旧的sync_info.txt)')):
+        command = subparsers.add_parser(name, help=description)
+        command.add_argument('roots', nargs='+', help='数据目录(experiment_data、oximeter_data等)')
+
+    query = subparsers.add_parser('query', help='查询会话')
+    query.add_argument('--role', choices=['master', 'slave'], default=None, help='主机或从机会话')
+    query.add_argument('--status', choices=['recording', 'complete'], default=None, help='会话状态')
+    query.add_argument('--since', type=parse_time, default=None, help='开始时间不早于(如 2026-01-31 或 20260131_080000)')
+    query.add_argument('--until', type=parse_time, default=None, help='开始时间早于')
+    query.add_argument('--min-minutes', type=float, default=None, help='最短时长(分钟)')
+    query.add_argument('--max-minutes', type=float, default=None, help='最长时长(分钟)')
+    query.add_argument('--device', type=str, default=None,
+                       help='设备(摄像头、HID路径、序列号、从机IP或主机名，部分匹配)')
+    query.add_argument('--min-mb', type=float, default=None, help='会话文件总大小下限(MB)')
+    query.add_argument('--max-mb', type=float, default=None, help='会话文件总大小上限(MB)')
+    query.add_argument('--good-sync', action='store_true', help='所有从机都有有效的时钟同步结果')
+    query.add_argument('--max-sync-delay-ms', type=float, default=None, help='最大往返延迟(毫秒)')
+    query.add_argument('--max-sync-residual-ms', type=float, default=None, help='最大拟合残差(毫秒)')
+    query.add_argument('--limit', type=int, default=None, help='最多返回的会话数')
+    query.add_argument('--json', action='store_true', help='以JSON输出')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    catalog = SessionCatalog(args.db)
+
+    try:
+        if args.command in ('update', 'rebuild'):
+            start = time.time()
+            updated, removed, unchanged = catalog.update(args.roots, rebuild=args.command == 'rebuild')
+            print(f"新增或更新 {updated} 个会话，删除 {removed} 个，未变 {unchanged} 个，用时 {time.time() - start:.2f}秒")
+        else:
+            rows = catalog.query(
+                role=args.role, status=args.status, since=args.since, until=args.until,
+                min_duration=args.min_minutes * 60 if args.min_minutes is not None else None,
+                max_duration=args.max_minutes * 60 if args.max_minutes is not None else None,
+                device=args.device,
+                min_bytes=args.min_mb * 1e6 if args.min_mb is not None else None,
+                max_bytes=args.max_mb * 1e6 if args.max_mb is not None else None,
+                good_sync=args.good_sync, max_sync_delay_ms=args.max_sync_delay_ms,
+                max_sync_residual_ms=args.max_sync_residual_ms, limit=args.limit)
+            if args.json:
+                for row in rows:
+                    row['devices'] = catalog.devices(row['id'])
+                print(json.dumps(rows, ensure_ascii=False, indent=2))
+            else:
+                for row in rows:
+                    print(format_session(row))
+                print(f"共 {len(rows)} 个会话")
+    finally:
+        catalog.close()
@@ -0,0 +1,514 @@
+import argparse
+import datetime
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from clock_sync import ClockSyncMonitor, format_result
+from command_channel import CommandChannel, format_results
+from discovery import DiscoveryClient, format_slave
+from metrics import MetricsRegistry, start_metrics_server, write_summary, SUMMARY_FILE, MASTER_STATS_PORT
+from session_catalog import write_session_file, master_metadata, index_session
+from video_pipeline import format_stats
+from file_transfer import pull_session, format_transfer, TRANSFER_PORT
+
+'''
+无界面的会话运行程序: 按命令行参数或配置文件依次执行 准备/开始/停止，可排队连续录制多个会话。
+- 不导入Tk/PIL；摄像头模块(cv2)在后台线程中导入并打开摄像头，与从机准备命令同时进行
+- 输出与主机界面相同: 会话目录下的视频、帧索引、sync_info.txt、clock_sync.csv 和 metrics_summary.json
+- 没有屏幕闪烁同步信号，对齐依赖帧索引和时钟同步
+'''
+
+DEFAULT_CONFIG = {
+    'cameras': "0",               # 摄像头索引或视频文件路径，逗号分隔
+    'camera_process': False,      # 第一路之外的摄像头在独立进程中运行
+    'ring_size': 64,              # 读帧环形缓冲的帧数
+    'slaves': [],                 # 从机IP列表
+    'discover': False,            # 未配置从机时通过广播发现
+    'discovery_targets': ['<broadcast>'],
+    'port': 5000,
+    'data_dir': os.path.join(os.getcwd(), "experiment_data"),
+    'video_filename': "video.mp4",
+    'overlay': False,             # 在帧上叠加时间戳(与界面默认一致，关闭以降低每帧开销)
+    'segment_seconds': 0,         # 视频分段时长(秒)，0为不分段
+    'roi': False,                 # 只录制人脸区域
+    'roi_size': "256x256",        # 人脸区域视频的输出尺寸
+    'roi_detect_interval': 5,     # 每隔多少帧运行一次人脸检测
+    'roi_model': None,            # 人脸检测模型(YuNet ONNX或Haar级联XML)，None为models/下的YuNet，'none'为固定中心区域
+    'roi_full_scale': 0,          # 同时保存的低分辨率整帧视频的缩放比例，0为不保存
+    'duration': 60.0,             # 每个会话的录制时长(秒)
+    'pause': 0.0,                 # 会话之间的间隔(秒)
+    'sync_interval': 10.0,        # 录制中时钟同步的间隔(秒)
+    'sync_rounds': 8,             # 每轮同步请求数
+    'stats_port': MASTER_STATS_PORT,
+    'collect': False,             # 每个会话结束后从所有从机收集数据文件
+    'transfer_port': TRANSFER_PORT,
+    'sessions': None,             # 会话列表，每项可覆盖 duration/video_filename/pause
+}
+
+
+def load_config(path=None, overrides=None):
+    """读取JSON配置文件并用命令行参数覆盖，未配置的项使用默认值"""
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            config[key] = value
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"未知的配置项: {', '.join(sorted(unknown))}")
+    return config
+
+
+def normalize_video_filename(name):
+    """缺少扩展名时补充.mp4"""
+    name = (name or "").strip() or "video.mp4"
+    if not name.lower().endswith(('.mp4', '.avi', '.mov', '.wmv')):
+        name += '.mp4'
+    return name
+
+
+class SessionRunner:
+    """
+    无界面的采集会话控制
+    config: load_config() 返回的配置
+    """
+    def __init__(self, config):
+        self.config = config
+        self.launch_time = time.monotonic()   # 第一个会话从程序启动计时，之后从各自的准备开始
+        self.startup = {}
+
+        # 摄像头
+        self.cameras = []
+        self.camera_ready_time = None
+        self.roi = None                # 人脸区域录制参数，None为录制整帧
+        self.warmup_thread = None
+        self.warmup_error = None
+
+        # 会话状态
+        self.session_id = None
+        self.session_dir = None
+        self.session = None            # 当前会话的时长和视频文件名
+        self.start_time = None
+        self.stop_event = threading.Event()
+        self.interrupted = False
+        self.command_log = {}
+        self.clock_sync = None
+        self.summaries = []
+        self.camera_live_stats = []    # 各路摄像头最近一次的读帧/编码状态(由会话线程每秒更新)
+
+        # UDP命令与运行时指标
+        self.metrics = MetricsRegistry()
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.command_channel = CommandChannel(self.udp_socket, config['port'], metrics=self.metrics)
+        self.metrics.gauge("recording", lambda: {'session_id': self.session_id,
+                                                 'recording': self.start_time is not None})
+        # 统计接口在HTTP线程中读取缓存，不直接访问摄像头(子进程摄像头的管道不能与停止录制交错)
+        self.metrics.gauge("cameras", lambda: self.camera_live_stats)
+        self.metrics_server = start_metrics_server(self.metrics.snapshot, config['stats_port'])
+
+        self.client_ips = list(config['slaves'])
+
+    def start_camera_warmup(self):
+        """在后台线程中导入摄像头模块、打开所有摄像头并等待首帧"""
+        def warm_up():
+            try:
+                from camera_recorder import parse_camera_sources, open_cameras, wait_for_frames
+                if self.config['roi']:
+                    # 先加载人脸检测模型，避免开始录制时才失败
+                    from roi_recording import roi_options, load_detector
+                    self.roi = roi_options({'size': self.config['roi_size'],
+                                            'detect_interval': self.config['roi_detect_interval'],
+                                            'model': self.config['roi_model'],
+                                            'full_scale': self.config['roi_full_scale']})
+                    load_detector(self.roi['model'])
+                self.cameras = open_cameras(parse_camera_sources(str(self.config['cameras'])),
+                                            self.config['camera_process'],
+                                            self.config['ring_size'])
+                wait_for_frames(self.cameras)
+                self.camera_ready_time = time.monotonic()
+                print(f"摄像头已就绪: {len(self.cameras)} 路, 启动后 {self.camera_ready_time - self.launch_time:.2f}秒")
+            except Exception as e:
+                self.warmup_error = e
+        self.warmup_thread = threading.Thread(target=warm_up, daemon=True)
+        self.warmup_thread.start()
+
+    def wait_cameras(self):
+        """等待后台预热完成，失败时抛出异常"""
+        if self.warmup_thread:
+            self.warmup_thread.join()
+            self.warmup_thread = None
+        if self.warmup_error:
+            raise RuntimeError(f"摄像头准备失败: {str(self.warmup_error)}")
+
+    def discover_slaves(self):
+        """未配置从机IP时广播发现"""
+        if self.client_ips or not self.config['discover']:
+            return
+        replies = DiscoveryClient(self.config['port'], self.config['discovery_targets']).discover()
+        for ip, info in sorted(replies.items()):
+            print(format_slave(ip, info))
+        self.client_ips = sorted(replies)
+
+    def send_command(self, command):
+        """向所有从机发送命令并等待确认"""
+        if not self.client_ips:
+            return {}
+        results = self.command_channel.send(self.client_ips, command)
+        for line in format_results(results):
+            print(line)
+        name = command.split(',')[0]
+        self.command_log[name] = {ip: result.as_dict() for ip, result in results.items()}
+        return results
+
+    def prepare(self, session):
+        """创建会话目录，摄像头预热与从机准备同时进行"""
+        # 连续的短会话可能在同一秒内开始，会话目录不能重复
+        while True:
+            self.session_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.session_dir = os.path.join(self.config['data_dir'], self.session_id)
+            if not os.path.exists(self.session_dir):
+                break
+            time.sleep(0.1)
+        os.makedirs(self.session_dir)
+        self.command_log = {}
+        self.metrics.reset("command.")
+
+        if not self.cameras:
+            self.start_camera_warmup()
+
+        oxygen_filename = f"oxygen_data_{self.session_id}.csv"
+        results = self.send_command(f"PREPARE,{oxygen_filename}")
+        failed = [ip for ip, result in results.items() if not result.ok]
+        if failed:
+            print("以下从机未确认准备命令: " + ", ".join(failed))
+
+        self.wait_cameras()
+
+        if self.client_ips:
+            self.clock_sync = ClockSyncMonitor(self.client_ips, self.config['port'],
+                                               interval=self.config['sync_interval'],
+                                               rounds=self.config['sync_rounds'])
+            self.clock_sync.start()
+        print(f"会话 {self.session_id} 准备就绪")
+
+    def start(self, session):
+        """发送开始命令并让所有摄像头开始录制"""
+        from camera_recorder import camera_video_filename, draw_timestamp
+        from video_segments import segment_index_path
+        from roi_recording import roi_file_path
+
+        self.session = session
+        self.start_time = time.time()
+        start_monotonic = time.monotonic()
+
+        command_time = time.time()
+        start_results = self.send_command(f"START,{command_time}")
+
+        sync_file = os.path.join(self.session_dir, "sync_info.txt")
+        with open(sync_file, "w", encoding="utf-8") as f:
+            f.write(f"实验开始时间: {datetime.datetime.now().isoformat()}\n")
+            f.write(f"视频文件名: {session['video_filename']}\n")
+            f.write(f"命令发送时间戳: {command_time}\n")
+            f.write(f"视频开始时间戳: {self.start_time}\n")
+            f.write(f"单调时钟开始时间: {start_monotonic}\n")
+            f.write(f"摄像头数量: {len(self.cameras)}\n")
+            f.write("无界面运行: 无屏幕闪烁同步信号\n")
+            for line in format_results(start_results):
+                f.write(f"从机 {line}\n")
+
+        overlay = draw_timestamp if self.config['overlay'] else None
+        segment_seconds = self.config['segment_seconds'] or None
+        for number, camera in enumerate(self.cameras):
+            video_path = os.path.join(self.session_dir, camera_video_filename(session['video_filename'], number))
+            camera.start_recording(
+                video_path, self.start_time,
+                duration=session['duration'],
+                # 录制时长以第一路摄像头为准
+                on_duration_reached=self.stop_event.set if number == 0 else None,
+                overlay=overlay,
+                segment_seconds=segment_seconds,
+                roi=self.roi
+            )
+
+        with open(sync_file, "a", encoding="utf-8") as f:
+            for number, camera in enumerate(self.cameras):
+                f.write(f"摄像头{number}: {camera.source}, 视频文件: {os.path.basename(camera.video_path)}\n")
+                if segment_seconds:
+                    f.write(f"摄像头{number} 分段索引: {os.path.basename(segment_index_path(camera.video_path))}\n")
+                if self.roi:
+                    f.write(f"摄像头{number} ROI框文件: {os.path.basename(roi_file_path(camera.video_path))}\n")
+        write_session_file(self.session_dir, master_metadata(
+            self.session_id, 'recording', self.start_time, None, session['video_filename'], self.cameras,
+            command_log=self.command_log, roi=self.roi, headless=True))
+        print(f"正在记录 {session['duration']:.0f}秒...")
+
+    def wait_first_frame(self, timeout=10):
+        """返回第一路摄像头写入第一帧时距启动的秒数，超时返回None"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not self.stop_event.is_set():
+            if self.cameras[0].live_stats()['encoded_frames'] > 0:
+                return time.monotonic() - self.launch_time
+            time.sleep(0.005)
+        return None
+
+    def update_live_stats(self):
+        """更新各路摄像头的实时状态缓存"""
+        live_stats = []
+        for camera in self.cameras:
+            try:
+                live_stats.append(camera.live_stats())
+            except Exception as e:
+                live_stats.append({'error': str(e)})
+        self.camera_live_stats = live_stats
+
+    def stop(self):
+        """发送停止命令，等待编码完成并写入同步信息和指标摘要"""
+        stop_time = time.time()
+        stop_results = self.send_command(f"STOP,{stop_time}")
+
+        camera_stats = []
+        for number, camera in enumerate(self.cameras):
+            try:
+                stats = camera.stop_recording()
+            except Exception as e:
+                print(f"停止摄像头{number}录制时出错: {str(e)}")
+                stats = None
+            camera_stats.append(stats)
+            if stats:
+                print(f"摄像头{number}:")
+                print("\n".join(format_stats(stats)))
+
+        clock_sync = self.clock_sync
+        self.clock_sync = None
+        if clock_sync:
+            clock_sync.stop()
+
+        sync_file = os.path.join(self.session_dir, "sync_info.txt")
+        if clock_sync:
+            clock_sync.save_samples(os.path.join(self.session_dir, "clock_sync.csv"))
+        with open(sync_file, "a", encoding="utf-8") as f:
+            f.write(f"录制结束时间: {datetime.datetime.now().isoformat()}\n")
+            f.write(f"停止命令时间戳: {stop_time}\n")
+            f.write(f"录制总时长: {stop_time - self.start_time}秒\n")
+            for number, stats in enumerate(camera_stats):
+                if stats:
+                    for line in format_stats(stats):
+                        f.write(f"摄像头{number} {line}\n")
+            for line in format_results(stop_results):
+                f.write(f"从机 {line}\n")
+            if clock_sync:
+                f.write("时钟同步样本: clock_sync.csv\n")
+                for ip, result in clock_sync.results().items():
+                    for line in format_result(ip, result):
+                        f.write(line + "\n")
+
+        summary = {
+            'role': 'master',
+            'headless': True,
+            'session_id': self.session_id,
+            'start_time': self.start_time,
+            'stop_time': stop_time,
+            'duration': stop_time - self.start_time,
+            'cameras': [{'source': camera.source,
+                         'video': os.path.basename(camera.video_path) if camera.video_path else None,
+                         'stats': stats}
+                        for camera, stats in zip(self.cameras, camera_stats)],
+            'commands': self.command_log,
+            'clock_sync': clock_sync.results() if clock_sync else None,
+            'startup': self.startup,
+            'metrics': self.metrics.snapshot(),
+        }
+        try:
+            write_summary(os.path.join(self.session_dir, SUMMARY_FILE), summary)
+        except Exception as e:
+            print(f"写入指标摘要时出错: {str(e)}")
+        try:
+            write_session_file(self.session_dir, master_metadata(
+                self.session_id, 'complete', self.start_time, stop_time, self.session['video_filename'], self.cameras,
+                camera_stats, self.command_log, summary['clock_sync'],
+                segment_seconds=self.config['segment_seconds'] or None, roi=self.roi, headless=True))
+        except Exception as e:
+            print(f"写入会话信息时出错: {str(e)}")
+        index_session(self.session_dir)
+        self.start_time = None
+        self.summaries.append(summary)
+        print(f"录制已完成，数据保存在: {self.session_dir}")
+
+    def run_session(self, session):
+        """执行一个会话: 准备、开始、等待时长或中断、停止"""
+        if self.launch_time is None:
+            self.launch_time = time.monotonic()
+        self.startup = {'launch_to_cameras_ready': None, 'launch_to_first_frame': None}
+        self.stop_event.clear()
+        self.prepare(session)
+        # 摄像头沿用上一个会话时已经就绪
+        self.startup['launch_to_cameras_ready'] = max(self.camera_ready_time - self.launch_time, 0.0)
+        if self.interrupted:
+            return
+        self.start(session)
+        try:
+            self.startup['launch_to_first_frame'] = self.wait_first_frame()
+            if self.startup['launch_to_first_frame'] is not None:
+                print(f"启动到第一帧录制: {self.startup['launch_to_first_frame']:.2f}秒")
+            # 录制时长由第一路摄像头计时，额外等待防止摄像头卡住时无法结束；等待期间每秒更新摄像头状态
+            deadline = time.monotonic() + session['duration'] + 10
+            while time.monotonic() < deadline and not self.stop_event.wait(max(min(1.0, deadline - time.monotonic()), 0)):
+                self.update_live_stats()
+        finally:
+            self.stop()
+            self.launch_time = None
+        if self.config['collect']:
+            self.collect()
+
+    def collect(self):
+        """并行从所有从机收集本次会话的数据到会话目录"""
+        if not self.client_ips:
+            return
+        print("正在收集从机数据...")
+        results = pull_session(self.client_ips, self.session_dir, port=self.config['transfer_port'])
+        for stats in results.values():
+            print(format_transfer(stats))
+
+    def sessions(self):
+        """返回要执行的会话列表"""
+        sessions = self.config['sessions'] or [{}]
+        result = []
+        for session in sessions:
+            result.append({
+                'duration': float(session.get('duration', self.config['duration'])),
+                'video_filename': normalize_video_filename(session.get('video_filename', self.config['video_filename'])),
+                'pause': float(session.get('pause', self.config['pause'])),
+            })
+        for session in result:
+            if session['duration'] <= 0:
+                raise ValueError("录制时长必须大于0")
+        return result
+
+    def run(self):
+        """依次执行所有会话，Ctrl+C停止当前会话后退出"""
+        sessions = self.sessions()
+        self.discover_slaves()
+        if not self.client_ips:
+            print("未配置从机，只录制视频")
+        previous_handler = signal.signal(signal.SIGINT, self._interrupt)
+        try:
+            for number, session in enumerate(sessions):
+                if self.interrupted:
+                    break
+                print(f"会话 {number + 1}/{len(sessions)}")
+                self.run_session(session)
+                if number < len(sessions) - 1 and session['pause'] > 0 and not self.interrupted:
+                    self.stop_event.clear()
+                    self.stop_event.wait(session['pause'])
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+            self.cleanup()
+        return self.summaries
+
+    def _interrupt(self, signum, frame):
+        print("收到中断信号，停止当前会话...")
+        self.interrupted = True
+        self.stop_event.set()
+
+    def cleanup(self):
+        """释放摄像头和网络资源"""
+        if self.warmup_thread:
+            self.warmup_thread.join()
+        for camera in self.cameras:
+            camera.close()
+        self.cameras = []
+        if self.clock_sync:
+            self.clock_sync.stop(final_round=False)
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.udp_socket.close()
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='无界面运行采集会话(准备/开始/停止)')
+    parser.add_argument('--config', type=str, default=None,
+                        help='JSON配置文件(键与命令行参数相同，可包含 sessions 会话列表)')
+    parser.add_argument('--cameras', type=str, default=None,
+                        help='摄像头索引或视频文件路径，逗号分隔')
+    parser.add_argument('--camera-process', action='store_true', default=None,
+                        help='第一路之外的摄像头在独立进程中运行')
+    parser.add_argument('--slaves', type=str, nargs='+', default=None,
+                        help='从机IP列表')
+    parser.add_argument('--discover', action='store_true', default=None,
+                        help='未配置从机时广播发现')
+    parser.add_argument('--port', type=int, default=None,
+                        help='从机UDP命令端口')
+    parser.add_argument('--data-dir', type=str, default=None,
+                        help='数据保存目录')
+    parser.add_argument('--video-filename', type=str, default=None,
+                        help='视频文件名')
+    parser.add_argument('--overlay', action='store_true', default=None,
+                        help='在视频上叠加时间戳(默认不叠加)')
+    parser.add_argument('--segment-seconds', type=float, default=None,
+                        help='视频分段时长(秒)，0为不分段')
+    parser.add_argument('--roi', action='store_true', default=None,
+                        help='只录制人脸区域(定期检测人脸，其间跟踪)')
+    parser.add_argument('--roi-size', type=str, default=None,
+                        help='人脸区域视频的输出尺寸 宽x高')
+    parser.add_argument('--roi-detect-interval', type=int, default=None,
+                        help='每隔多少帧运行一次人脸检测')
+    parser.add_argument('--roi-model', type=str, default=None,
+                        help='人脸检测模型(YuNet ONNX或Haar级联XML)，默认为程序目录下的 '
+                             'models/face_detection_yunet_2023mar.onnx，none为固定中心区域(不检测)')
+    parser.add_argument('--roi-full-scale', type=float, default=None,
+                        help='同时保存低分辨率整帧视频的缩放比例，0为不保存')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='每个会话的录制时长(秒)')
+    parser.add_argument('--count', type=int, default=None,
+                        help='连续录制的会话数')
+    parser.add_argument('--pause', type=float, default=None,
+                        help='会话之间的间隔(秒)')
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help='本机统计接口端口，0为不启动')
+    parser.add_argument('--collect', action='store_true', default=None,
+                        help='每个会话结束后从所有从机收集数据文件')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    overrides = {
+        'cameras': args.cameras,
+        'camera_process': args.camera_process,
+        'slaves': args.slaves,
+        'discover': args.discover,
+        'port': args.port,
+        'data_dir': args.data_dir,
+        'video_filename': args.video_filename,
+        'overlay': args.overlay,
+        'segment_seconds': args.segment_seconds,
+        'roi': args.roi,
+        'roi_size': args.roi_size,
+        'roi_detect_interval': args.roi_detect_interval,
+        'roi_model': args.roi_model,
+        'roi_full_scale': args.roi_full_scale,
+        'duration': args.duration,
+        'pause': args.pause,
+        'stats_port': args.stats_port,
+        'collect': args.collect,
+    }
+    if args.count:
+        overrides['sessions'] = [{} for _ in range(args.count)]
+
+    try:
+        config = load_config(args.config, overrides)
+        runner = SessionRunner(config)
+    except (OSError, ValueError) as e:
+        print(f"配置错误: {str(e)}")
+        raise SystemExit(2)
+
+    summaries = runner.run()
+    print(f"共完成 {len(summaries)} 个会话")
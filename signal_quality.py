@@ -0,0 +1,449 @@
+import argparse
+import csv
+import math
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from cms50e_decoder import NOMINAL_SAMPLE_RATE
+from oximeter_storage import BinarySink, open_binary_recording, BINARY_EXTENSION
+
+'''
+从机端的在线信号分析，与采集线程并行运行。
+采集线程每解码一批样本只把数组引用放入有界队列(满时丢弃该批并计数)，
+分析线程逐个样本做O(1)的处理:
+- 滤波: 指数滑动平均去除基线漂移，二阶低通(RBJ双二阶)去除高频噪声
+- 峰值心率: 滤波后信号的局部极大值，自适应阈值加不应期，取最近若干个心搏间期的中位数
+- 频谱心率: 定长环形缓冲内的加窗FFT，每秒计算一次(均摊到每个样本为常数)
+- 质量标记: 最近1秒内饱和、波形平坦、运动伪影(原始信号差分幅度突增)、长时间没有检测到心搏
+结果逐样本写入数据文件旁的 *_quality.csv；数据文件为二进制格式(.oxb)时写入 *_quality.oxq，
+文件头结构与.oxb相同，记录为 QUALITY_RECORD_DTYPE，可用 --export 转换为CSV。
+最新结果可通过局域网发现回复和实时数据流获取。
+'''
+
+# 质量标记(按位组合)
+FLAG_SATURATED = 1
+FLAG_FLATLINE = 2
+FLAG_MOTION = 4
+FLAG_NO_PULSE = 8
+FLAG_NAMES = [
+    (FLAG_SATURATED, '饱和'),
+    (FLAG_FLATLINE, '平坦'),
+    (FLAG_MOTION, '运动'),
+    (FLAG_NO_PULSE, '无脉搏'),
+]
+
+QUALITY_HEADER = ['数据点', '采集时间戳', '滤波PPG', '峰值HR', '频谱HR', '质量标记']
+
+# 二进制格式的分析结果
+QUALITY_MAGIC = b'OXQUA001'
+QUALITY_BINARY_EXTENSION = '.oxq'
+QUALITY_RECORD_STRUCT = struct.Struct('<IdfffB3x')
+QUALITY_RECORD_DTYPE = np.dtype([
+    ('index', '<u4'),
+    ('timestamp', '<f8'),
+    ('filtered', '<f4'),
+    ('hr_peak', '<f4'),
+    ('hr_spectral', '<f4'),
+    ('flags', 'u1'),
+    ('reserved', 'u1', (3,)),
+])
+assert QUALITY_RECORD_DTYPE.itemsize == QUALITY_RECORD_STRUCT.size
+
+
+def format_flags(flags):
+    """将质量标记格式化为文本"""
+    names = [name for flag, name in FLAG_NAMES if flags & flag]
+    return "/".join(names) if names else "良好"
+
+
+def lowpass_coefficients(cutoff, sample_rate, q=0.7071):
+    """二阶低通滤波器系数(b0, b1, b2, a1, a2)，已按a0归一化"""
+    w0 = 2 * math.pi * cutoff / sample_rate
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+    a0 = 1 + alpha
+    b0 = (1 - cos_w0) / 2 / a0
+    return b0, 2 * b0, b0, -2 * cos_w0 / a0, (1 - alpha) / a0
+
+
+def quality_file_name(file_path):
+    """数据文件对应的信号分析结果文件，二进制数据文件对应二进制结果文件"""
+    base, extension = os.path.splitext(file_path)
+    if extension == BINARY_EXTENSION:
+        return base + "_quality" + QUALITY_BINARY_EXTENSION
+    return base + "_quality.csv"
+
+
+class SignalAnalyzer:
+    """
+    单个设备的在线信号分析，每个样本的处理时间为常数
+    window_seconds: 频谱心率的分析窗口长度
+    """
+    def __init__(self, sample_rate=NOMINAL_SAMPLE_RATE, window_seconds=8.0, lowpass_cutoff=4.0,
+                 baseline_seconds=1.5, saturation_low=0, saturation_high=100, flat_std=0.5,
+                 motion_ratio=3.0, no_pulse_seconds=3.0):
+        # 滤波
+        self.sample_rate = sample_rate
+        self.baseline_alpha = 1.0 / (baseline_seconds * sample_rate)
+        self.coefficients = lowpass_coefficients(lowpass_cutoff, sample_rate)
+        self.baseline = None
+        self.x1 = self.x2 = self.y1 = self.y2 = 0.0
+
+        # 峰值检测
+        self.refractory = 0.27        # 不应期(秒)，对应220次/分
+        self.max_interval = 2.0       # 最长心搏间期(秒)，对应30次/分
+        self.no_pulse_seconds = no_pulse_seconds
+        self.prev = self.prev2 = 0.0
+        self.prev_time = None
+        self.peak_amplitude = 0.0
+        self.amplitude_decay = 1.0 - 1.0 / (5.0 * sample_rate)  # 阈值约5秒衰减，伪影过后能恢复
+        self.last_peak_time = None
+        self.intervals = []           # 最近的心搏间期
+        self.max_intervals = 8
+        self.hr_peak = 0.0
+
+        # 频谱
+        self.window_size = int(window_seconds * sample_rate)
+        self.ring = np.zeros(self.window_size, dtype=np.float64)
+        self.spectral_every = int(sample_rate)
+        self.fft_size = 1 << max(self.window_size - 1, 1).bit_length() + 2
+        self.taper = np.hanning(self.window_size)
+        frequencies = np.fft.rfftfreq(self.fft_size, 1.0 / sample_rate)
+        self.band = np.nonzero((frequencies >= 0.6) & (frequencies <= 3.5))[0]
+        self.hr_spectral = 0.0
+
+        # 质量统计(最近1秒)
+        self.quality_size = int(sample_rate)
+        self.raw_ring = np.zeros(self.quality_size, dtype=np.float64)
+        self.diff_ring = np.zeros(self.quality_size, dtype=np.float64)
+        self.saturated_ring = np.zeros(self.quality_size, dtype=bool)
+        self.raw_sum = self.raw_sumsq = self.diff_sum = 0.0
+        self.saturated_count = 0
+        self.motion_level = 0.0       # 信号正常时差分幅度的慢速平均
+        self.prev_value = None
+        self.saturation_low = saturation_low
+        self.saturation_high = saturation_high
+        self.flat_std = flat_std
+        self.motion_ratio = motion_ratio
+
+        self.count = 0
+        self.flags = 0
+        self.last_timestamp = None
+
+    def _filter(self, value):
+        """去基线后低通滤波"""
+        if self.baseline is None:
+            self.baseline = value
+        self.baseline += self.baseline_alpha * (value - self.baseline)
+        x = value - self.baseline
+        b0, b1, b2, a1, a2 = self.coefficients
+        y = b0 * x + b1 * self.x1 + b2 * self.x2 - a1 * self.y1 - a2 * self.y2
+        self.x2, self.x1 = self.x1, x
+        self.y2, self.y1 = self.y1, y
+        return y
+
+    def _detect_peak(self, timestamp, value, artifact):
+        """上一个样本为局部极大值且超过自适应阈值时记为心搏，有伪影时不检测"""
+        self.peak_amplitude *= self.amplitude_decay
+        if not artifact and self.prev > self.prev2 and self.prev >= value and self.prev > 0.5 * self.peak_amplitude:
+            peak_time = self.prev_time
+            if self.last_peak_time is None or peak_time - self.last_peak_time >= self.refractory:
+                self.peak_amplitude += 0.2 * (self.prev - self.peak_amplitude)
+                if self.last_peak_time is not None:
+                    interval = peak_time - self.last_peak_time
+                    if interval <= self.max_interval:
+                        self.intervals.append(interval)
+                        if len(self.intervals) > self.max_intervals:
+                            self.intervals.pop(0)
+                        self.hr_peak = 60.0 / sorted(self.intervals)[len(self.intervals) // 2]
+                self.last_peak_time = peak_time
+        self.prev2, self.prev, self.prev_time = self.prev, value, timestamp
+
+    def _update_spectrum(self):
+        """环形缓冲内加窗FFT，取心率频带内的最大峰并做抛物线插值"""
+        position = self.count % self.window_size
+        signal = np.concatenate((self.ring[position:], self.ring[:position]))
+        signal = (signal - signal.mean()) * self.taper
+        power = np.abs(np.fft.rfft(signal, self.fft_size)) ** 2
+        band = power[self.band]
+        k = int(np.argmax(band))
+        shift = 0.0
+        if 0 < k < len(band) - 1:
+            left, center, right = band[k - 1], band[k], band[k + 1]
+            denominator = left - 2 * center + right
+            if denominator:
+                shift = 0.5 * (left - right) / denominator
+        self.hr_spectral = 60.0 * (self.band[k] + shift) * self.sample_rate / self.fft_size
+
+    def _update_quality(self, value):
+        """滑动窗口累加量更新质量标记"""
+        slot = self.count % self.quality_size
+        diff = abs(value - self.prev_value) if self.prev_value is not None else 0.0
+        self.prev_value = value
+        saturated = value <= self.saturation_low or value >= self.saturation_high
+        if self.count >= self.quality_size:
+            old = self.raw_ring[slot]
+            self.raw_sum -= old
+            self.raw_sumsq -= old * old
+            self.diff_sum -= self.diff_ring[slot]
+            self.saturated_count -= int(self.saturated_ring[slot])
+        self.raw_ring[slot] = value
+        self.diff_ring[slot] = diff
+        self.saturated_ring[slot] = saturated
+        self.raw_sum += value
+        self.raw_sumsq += value * value
+        self.diff_sum += diff
+        self.saturated_count += int(saturated)
+
+        n = min(self.count + 1, self.quality_size)
+        flags = 0
+        if self.saturated_count > n // 4:
+            flags |= FLAG_SATURATED
+        variance = max(self.raw_sumsq / n - (self.raw_sum / n) ** 2, 0.0)
+        if n == self.quality_size and math.sqrt(variance) < self.flat_std:
+            flags |= FLAG_FLATLINE
+
+        # 运动: 最近1秒的差分幅度明显高于信号正常时
+        level = self.diff_sum / n
+        if n == self.quality_size:
+            if self.motion_level and level > self.motion_ratio * self.motion_level:
+                flags |= FLAG_MOTION
+            elif not flags:
+                self.motion_level += 0.01 * (level - self.motion_level) if self.motion_level else level
+
+        return flags
+
+    def process_sample(self, timestamp, value):
+        """处理一个样本，返回(滤波值, 峰值HR, 频谱HR, 质量标记)"""
+        filtered = self._filter(value)
+        flags = self._update_quality(value)
+        self._detect_peak(timestamp, filtered, flags)
+
+        self.ring[self.count % self.window_size] = filtered
+        self.count += 1
+        if self.count >= self.window_size and self.count % self.spectral_every == 0:
+            self._update_spectrum()
+
+        if self.last_peak_time is None or timestamp - self.last_peak_time > self.no_pulse_seconds:
+            if self.count >= self.quality_size:
+                flags |= FLAG_NO_PULSE
+            self.hr_peak = 0.0
+        if flags & (FLAG_FLATLINE | FLAG_NO_PULSE):
+            self.hr_spectral = 0.0
+
+        self.flags = flags
+        self.last_timestamp = timestamp
+        return filtered, self.hr_peak, self.hr_spectral, flags
+
+    def process(self, first_index, timestamps, ppg):
+        """处理一批样本，返回结果行(数据点, 时间戳, 滤波PPG, 峰值HR, 频谱HR, 质量标记)"""
+        rows = []
+        for index, (timestamp, value) in enumerate(zip(timestamps, ppg), first_index):
+            filtered, hr_peak, hr_spectral, flags = self.process_sample(timestamp, float(value))
+            rows.append((index, timestamp, filtered, hr_peak, hr_spectral, flags))
+        return rows
+
+    def latest(self):
+        """最新的分析结果"""
+        return {
+            'timestamp': self.last_timestamp,
+            'hr_peak': round(self.hr_peak, 1),
+            'hr_spectral': round(self.hr_spectral, 1),
+            'flags': self.flags,
+            'quality': format_flags(self.flags),
+        }
+
+
+class QualityCSVSink:
+    """信号分析结果的CSV输出，接口与oximeter_storage.CSVSink相同"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(QUALITY_HEADER)
+
+    def write_rows(self, rows):
+        self.writer.writerows(
+            [str(index), str(timestamp), f"{filtered:.3f}", f"{hr_peak:.1f}", f"{hr_spectral:.1f}", str(flags)]
+            for index, timestamp, filtered, hr_peak, hr_spectral, flags in rows
+        )
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def set_metadata(self, **metadata):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class QualityBinarySink(BinarySink):
+    """信号分析结果的二进制输出，文件头结构与oximeter_storage.BinarySink相同"""
+    magic = QUALITY_MAGIC
+    record_struct = QUALITY_RECORD_STRUCT
+    record_dtype = QUALITY_RECORD_DTYPE
+
+    def write_rows(self, rows):
+        pack = self.record_struct.pack
+        self.file.write(b''.join(
+            pack(index, timestamp, filtered, hr_peak, hr_spectral, flags)
+            for index, timestamp, filtered, hr_peak, hr_spectral, flags in rows
+        ))
+        self.row_count += len(rows)
+
+
+def open_quality_sink(file_path, metadata=None):
+    """按文件扩展名打开信号分析结果的输出"""
+    if file_path.endswith(QUALITY_BINARY_EXTENSION):
+        return QualityBinarySink(file_path, metadata)
+    return QualityCSVSink(file_path)
+
+
+def export_quality_csv(binary_path, csv_path=None, chunk_size=65536):
+    """将二进制分析结果(.oxq)转换为CSV"""
+    if csv_path is None:
+        csv_path = os.path.splitext(binary_path)[0] + '.csv'
+    _, records = open_binary_recording(binary_path, QUALITY_MAGIC, QUALITY_RECORD_DTYPE)
+    sink = QualityCSVSink(csv_path)
+    try:
+        for begin in range(0, len(records), chunk_size):
+            chunk = records[begin:begin + chunk_size]
+            sink.write_rows(zip(
+                chunk['index'].tolist(), chunk['timestamp'].tolist(), chunk['filtered'].tolist(),
+                chunk['hr_peak'].tolist(), chunk['hr_spectral'].tolist(), chunk['flags'].tolist()))
+    finally:
+        sink.close()
+    return csv_path
+
+
+class AnalysisWorker:
+    """
+    在线分析线程
+    submit()由采集线程调用，只放入数组引用，队列满时丢弃该批并计数，永不阻塞采集线程
+    writer: 结果的写入器(BufferedRowWriter)，on_update: 每秒以最新结果调用一次
+    """
+    def __init__(self, analyzer, writer=None, on_update=None, max_pending=256, update_interval=1.0):
+        self.analyzer = analyzer
+        self.writer = writer
+        self.on_update = on_update
+        self.update_interval = update_interval
+        self.queue = queue.Queue(maxsize=max_pending)
+
+        # 统计
+        self.processed_samples = 0
+        self.dropped_batches = 0
+        self.failed_batches = 0
+        self.cpu_time = 0.0
+
+        self._thread = threading.Thread(target=self._analysis_thread, daemon=True)
+        self._thread.start()
+
+    def submit(self, first_index, timestamps, ppg):
+        """放入一批样本"""
+        try:
+            self.queue.put_nowait((first_index, timestamps, ppg))
+        except queue.Full:
+            self.dropped_batches += 1
+
+    def _analysis_thread(self):
+        last_update = time.monotonic()
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            start = time.thread_time()
+            first_index, timestamps, ppg = batch
+            # 单批出错只丢弃该批，线程继续运行，避免队列填满后stop()无法结束
+            try:
+                rows = self.analyzer.process(first_index, np.asarray(timestamps).tolist(), np.asarray(ppg).tolist())
+            except Exception as e:
+                self.failed_batches += 1
+                print(f"信号分析出错(第{self.failed_batches}批): {str(e)}")
+                continue
+            finally:
+                self.cpu_time += time.thread_time() - start
+            self.processed_samples += len(rows)
+            if self.writer:
+                for row in rows:
+                    self.writer.put(row)
+
+            now = time.monotonic()
+            if self.on_update and now - last_update >= self.update_interval:
+                last_update = now
+                try:
+                    self.on_update(self.analyzer.latest())
+                except Exception as e:
+                    print(f"发送分析结果时出错: {str(e)}")
+
+    def latest(self):
+        return self.analyzer.latest()
+
+    def stop(self, timeout=5):
+        """处理完队列中剩余的样本后停止，返回统计信息"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=timeout)
+        if self._thread.is_alive():
+            print("信号分析线程未能在超时时间内结束")
+        if self.writer:
+            self.writer.close()
+        return self.stats()
+
+    def stats(self):
+        return {
+            'processed_samples': self.processed_samples,
+            'dropped_batches': self.dropped_batches,
+            'failed_batches': self.failed_batches,
+            'cpu_time': self.cpu_time,
+            'cpu_per_sample': self.cpu_time / self.processed_samples if self.processed_samples else 0.0,
+        }
+
+
+def analyze_file(path, sample_rate=NOMINAL_SAMPLE_RATE):
+    """离线分析数据文件(.csv或.oxb)，结果写入 *_quality.csv 或 *_quality.oxq"""
+    if path.endswith(BINARY_EXTENSION):
+        _, records = open_binary_recording(path)
+        index, timestamps, ppg = records['index'], records['timestamp'], records['ppg']
+    else:
+        data = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, 1, 4), ndmin=2)
+        index, timestamps, ppg = data[:, 0].astype(np.int64), data[:, 1], data[:, 2]
+    analyzer = SignalAnalyzer(sample_rate)
+    output = quality_file_name(path)
+    sink = open_quality_sink(output, {'file_name': os.path.basename(path)})
+    try:
+        first = int(index[0]) if len(index) else 0
+        sink.write_rows(analyzer.process(first, timestamps.tolist(), ppg.tolist()))
+    finally:
+        sink.close()
+    return output, analyzer.latest()
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='血氧仪信号质量与心率离线分析')
+    parser.add_argument('files', nargs='+', help='数据文件(.csv或.oxb)，使用--export时为分析结果(.oxq)')
+    parser.add_argument('--sample-rate', type=float, default=NOMINAL_SAMPLE_RATE, help='采样率(Hz)')
+    parser.add_argument('--export', action='store_true', help='将二进制分析结果(*_quality.oxq)转换为CSV')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    for path in args.files:
+        if args.export:
+            print(f"已导出: {export_quality_csv(path)}")
+            continue
+        output, latest = analyze_file(path, args.sample_rate)
+        print(f"已保存: {output} (最后 峰值HR {latest['hr_peak']}, 频谱HR {latest['hr_spectral']}, "
+              f"{latest['quality']})")
@@ -0,0 +1,179 @@
+import threading
+import time
+from metrics import LatencyHistogram
+
+'''
+视频录制流水线。
+帧由 FrameBroadcaster 的读帧线程以摄像头原生帧率读入预分配的环形缓冲并打上时间戳，
+录制流水线以 all 模式订阅，编码线程直接从环形缓冲取帧写入视频(不复制)。
+编码卡顿不会阻塞读帧，落后超过环形缓冲容量的帧计为丢帧。
+每路视频只有一个编码线程: cv2.VideoWriter.write 同时完成编码和写入容器，必须按帧顺序调用，
+多个线程也只能轮流写入，无法并行编码；多路摄像头之间的并行见 CameraProcess。
+'''
+
+
+class StageTimer(LatencyHistogram):
+    """单个流水线阶段的耗时统计"""
+
+
+class VideoPipeline:
+    """
+    订阅 -> 编码 流水线
+    subscription: FrameBroadcaster 的 all 模式订阅
+    writer: cv2.VideoWriter 或具有write接口的对象，timed为True的写入器(如分段写入器)同时接收帧的采集时间
+    start_time: 录制开始的time.time()时间戳，duration秒后调用on_duration_reached
+    overlay: 可选，编码前对帧调用 overlay(frame, elapsed)，注意会修改共享的帧缓冲
+    frame_index: 可选的FrameIndexWriter，每写入一帧记录其时间
+    """
+    def __init__(self, subscription, writer, start_time, duration=None,
+                 on_duration_reached=None, overlay=None, frame_index=None):
+        # 输入输出
+        self.subscription = subscription
+        self.writer = writer
+        self.timed_writer = getattr(writer, 'timed', False)
+        self.start_time = start_time
+        self.duration = duration
+        self.on_duration_reached = on_duration_reached
+        self.overlay = overlay
+        self.frame_index = frame_index
+        self._next_frame = 0
+
+        # 统计
+        self.encoded_frames = 0
+        self.frames_after_stop = 0    # 停止后才取到、未写入的帧
+        self.queue_timer = StageTimer()
+        self.encode_timer = StageTimer()
+        self.index_timer = StageTimer()
+        self.first_frame_time = None
+        self.last_frame_time = None
+
+        # 线程控制
+        self.running = False
+        self.stop_seq = None
+        self._encoder_thread = None
+
+    def start(self):
+        """启动编码线程"""
+        self.running = True
+        self._encoder_thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self._encoder_thread.start()
+
+    def _request_stop(self, last_seq):
+        """停止录制，last_seq及之前的帧仍会写入"""
+        if self.stop_seq is None or last_seq < self.stop_seq:
+            self.stop_seq = last_seq
+        self.running = False
+
+    def stop(self, timeout=10):
+        """停止录制，等待已采集的帧编码完成"""
+        self._request_stop(self.subscription.broadcaster.latest_seq)
+        thread = self._encoder_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=timeout)
+        self.subscription.close()
+
+    def _next(self):
+        """按顺序取下一帧并分配视频帧号，录制结束时返回None"""
+        while True:
+            frame = self.subscription.get(timeout=0.1)
+            if frame is None:
+                if not self.running or self.subscription.closed:
+                    return None
+                continue
+            if self.stop_seq is not None and frame.seq > self.stop_seq:
+                self.frames_after_stop += 1
+                self.subscription.release(frame)
+                return None
+
+            # 检查是否超过录制时长
+            if self.duration is not None and frame.wall_time - self.start_time >= self.duration:
+                if self.running:
+                    self._request_stop(frame.seq)
+                    if self.on_duration_reached:
+                        self.on_duration_reached()
+
+            frame_number = self._next_frame
+            self._next_frame += 1
+            self.queue_timer.add(time.monotonic() - frame.monotonic_time)
+            return frame_number, frame
+
+    def _encode_loop(self):
+        """编码线程：叠加可选的时间信息后按帧顺序写入视频和帧索引"""
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            frame_number, frame = item
+            try:
+                if self.overlay:
+                    self.overlay(frame.image, frame.wall_time - self.start_time)
+
+                encode_start = time.perf_counter()
+                try:
+                    if self.timed_writer:
+                        self.writer.write(frame.image, frame.wall_time, frame.monotonic_time)
+                    else:
+                        self.writer.write(frame.image)
+                    index_start = time.perf_counter()
+                    self.encode_timer.add(index_start - encode_start)
+                    if self.frame_index:
+                        self.frame_index.write(frame_number, frame.monotonic_time,
+                                               frame.wall_time, frame.camera_pos)
+                        self.index_timer.add(time.perf_counter() - index_start)
+                finally:
+                    self.encoded_frames += 1
+                    if self.first_frame_time is None:
+                        self.first_frame_time = frame.wall_time
+                    self.last_frame_time = frame.wall_time
+            finally:
+                self.subscription.release(frame)
+
+    def stats(self):
+        """返回各阶段耗时、排队帧数和丢帧统计"""
+        duration = 0.0
+        if self.first_frame_time is not None and self.last_frame_time is not None:
+            duration = self.last_frame_time - self.first_frame_time
+        broadcaster = self.subscription.broadcaster
+        subscription = self.subscription.stats()
+        return {
+            'captured_frames': subscription['received'] - self.frames_after_stop,
+            'encoded_frames': self.encoded_frames,
+            'dropped_frames': subscription['dropped'],
+            'read_failures': broadcaster.read_failures,
+            'max_queue_depth': subscription['max_lag'],
+            'pool_size': broadcaster.ring_size,
+            'achieved_fps': (self.encoded_frames - 1) / duration if duration > 0 else 0.0,
+            'capture': broadcaster.capture_timer.summary(),
+            'queue_wait': self.queue_timer.summary(),
+            'encode': self.encode_timer.summary(),
+            'index_write': self.index_timer.summary(),
+        }
+
+
+def format_stats(stats):
+    """将流水线统计格式化为会话记录中的文本行"""
+    lines = [
+        f"采集帧数: {stats['captured_frames']}",
+        f"编码帧数: {stats['encoded_frames']}",
+        f"丢帧数: {stats['dropped_frames']}",
+        f"读帧失败次数: {stats['read_failures']}",
+        f"实际帧率: {stats['achieved_fps']:.2f}",
+        f"最大队列深度: {stats['max_queue_depth']}/{stats['pool_size']}",
+    ]
+    for key, label in (('capture', '采集'), ('queue_wait', '排队'), ('encode', '编码'), ('index_write', '帧索引写入')):
+        stage = stats.get(key)
+        if stage:
+            lines.append(f"{label}耗时: 平均 {stage['mean_ms']:.2f}ms, P99 {stage.get('p99_ms', 0):.2f}ms, "
+                         f"最大 {stage['max_ms']:.2f}ms")
+    if 'segments' in stats:
+        lines.append(f"视频分段数: {stats['segments']}")
+    roi = stats.get('roi')
+    if roi:
+        lines.append(f"ROI输出尺寸: {roi['output_size'][0]}x{roi['output_size'][1]}")
+        lines.append(f"ROI来源帧数: 检测 {roi['detect_frames']}, 跟踪 {roi['track_frames']}, 保持 {roi['hold_frames']}")
+        for key, label in (('detect', '人脸检测'), ('track', '人脸跟踪')):
+            stage = roi[key]
+            if stage['count']:
+                lines.append(f"{label}耗时: 平均 {stage['mean_ms']:.2f}ms, P99 {stage.get('p99_ms', 0):.2f}ms, "
+                             f"最大 {stage['max_ms']:.2f}ms")
+    return lines
@@ -0,0 +1,175 @@
+import csv
+import os
+import threading
+import time
+import cv2
+
+'''
+分段视频录制。
+SegmentedVideoWriter 与 cv2.VideoWriter 接口相同，每隔 N 秒或 N 帧切换到新的视频文件，
+切换在编码线程的顺序写入中完成，边界处不丢帧；旧文件在后台线程中关闭(写入moov)，不阻塞编码。
+每个分段关闭完成后按分段顺序追加到会话级分段索引(CSV)，此时该分段已是完整可读的视频，
+后处理程序可以在录制继续的同时并行处理已完成的分段。
+'''
+
+SEGMENT_INDEX_HEADER = ['分段', '文件名', '起始帧', '结束帧', '帧数', '起始时间戳', '结束时间戳', '单调时钟起始', '单调时钟结束']
+
+
+def segment_filename(video_path, segment_number):
+    """返回分段视频路径，如 video.mp4 -> video_seg0001.mp4"""
+    base, ext = os.path.splitext(video_path)
+    return f"{base}_seg{segment_number:04d}{ext}"
+
+
+def segment_index_path(video_path):
+    """返回会话级分段索引路径"""
+    return os.path.splitext(video_path)[0] + "_segments.csv"
+
+
+def read_segment_index(path):
+    """读取分段索引，返回按分段顺序排列的已完成分段的字典列表"""
+    segments = []
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            segments.append({
+                'segment': int(row[0]),
+                'filename': row[1],
+                'start_frame': int(row[2]),
+                'end_frame': int(row[3]),
+                'frame_count': int(row[4]),
+                'start_time': float(row[5]),
+                'end_time': float(row[6]),
+                'start_monotonic': float(row[7]),
+                'end_monotonic': float(row[8]),
+            })
+    # 旧版本按关闭完成的顺序写入，较短的最后一段可能排在前一段之前
+    segments.sort(key=lambda segment: segment['segment'])
+    return segments
+
+
+class SegmentedVideoWriter:
+    """
+    按时长或帧数轮转的视频写入器
+    segment_seconds / segment_frames: 任一达到即切换分段，为None表示不限制
+    frame_offset: 第一帧的全局帧号，与帧索引(.fidx)中的帧序号对应
+    """
+    timed = True  # write() 接受帧的采集时间
+
+    def __init__(self, video_path, fourcc, fps, frame_size, segment_seconds=None, segment_frames=None, frame_offset=0):
+        # 输出设置
+        self.video_path = video_path
+        self.fourcc = fourcc
+        self.fps = fps
+        self.frame_size = frame_size
+        self.segment_seconds = segment_seconds
+        self.segment_frames = segment_frames
+
+        # 分段索引
+        self.index_path = segment_index_path(video_path)
+        self.index_file = open(self.index_path, 'w', newline='')
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(SEGMENT_INDEX_HEADER)
+        self.index_file.flush()
+        self.index_lock = threading.Lock()
+        self._finished = {}       # 已关闭、等待前面的分段关闭后再写入索引的分段
+        self._next_indexed = 1    # 下一个写入索引的分段号
+
+        # 当前分段
+        self.writer = None
+        self.segment_number = 0
+        self.segment = None
+        self.next_frame = frame_offset
+        self.completed_segments = 0
+        self._closers = []
+
+    def _open_segment(self, wall_time, monotonic_time):
+        self.segment_number += 1
+        path = segment_filename(self.video_path, self.segment_number)
+        self.writer = cv2.VideoWriter(path, self.fourcc, self.fps, self.frame_size)
+        self.segment = {
+            'segment': self.segment_number,
+            'filename': os.path.basename(path),
+            'start_frame': self.next_frame,
+            'end_frame': self.next_frame - 1,
+            'start_time': wall_time,
+            'end_time': wall_time,
+            'start_monotonic': monotonic_time,
+            'end_monotonic': monotonic_time,
+        }
+
+    def _close_segment(self):
+        """在后台线程中关闭当前分段，关闭完成后写入分段索引"""
+        if self.writer is None:
+            return
+        writer, segment = self.writer, self.segment
+        self.writer = None
+        self.segment = None
+
+        def finish():
+            try:
+                writer.release()
+            except Exception as e:
+                print(f"关闭分段 {segment['filename']} 时出错: {str(e)}")
+            # 各分段的关闭线程完成顺序不定，按分段号顺序写入索引，读取方按文件顺序拼接分段
+            with self.index_lock:
+                self._finished[segment['segment']] = segment
+                while self._next_indexed in self._finished:
+                    done = self._finished.pop(self._next_indexed)
+                    self.index_writer.writerow([
+                        done['segment'], done['filename'],
+                        done['start_frame'], done['end_frame'],
+                        done['end_frame'] - done['start_frame'] + 1,
+                        done['start_time'], done['end_time'],
+                        done['start_monotonic'], done['end_monotonic'],
+                    ])
+                    self._next_indexed += 1
+                    self.completed_segments += 1
+                self.index_file.flush()
+
+        closer = threading.Thread(target=finish, daemon=True)
+        closer.start()
+        self._closers = [thread for thread in self._closers if thread.is_alive()]
+        self._closers.append(closer)
+
+    def _segment_full(self, wall_time):
+        segment = self.segment
+        frames = self.next_frame - segment['start_frame']
+        if self.segment_frames and frames >= self.segment_frames:
+            return True
+        if self.segment_seconds and wall_time - segment['start_time'] >= self.segment_seconds:
+            return True
+        return False
+
+    def write(self, image, wall_time=None, monotonic_time=None):
+        """写入一帧，达到分段长度时先切换到新文件"""
+        if wall_time is None:
+            wall_time, monotonic_time = time.time(), time.monotonic()
+        if self.writer is not None and self._segment_full(wall_time):
+            self._close_segment()
+        if self.writer is None:
+            self._open_segment(wall_time, monotonic_time)
+
+        self.writer.write(image)
+        self.segment['end_frame'] = self.next_frame
+        self.segment['end_time'] = wall_time
+        self.segment['end_monotonic'] = monotonic_time
+        self.next_frame += 1
+
+    def release(self, timeout=30):
+        """关闭最后一个分段，等待所有分段关闭并写入索引"""
+        self._close_segment()
+        for thread in self._closers:
+            thread.join(timeout=timeout)
+        alive = [thread for thread in self._closers if thread.is_alive()]
+        self._closers = []
+        if alive:
+            # 关闭线程仍会写入索引，不能关闭索引文件
+            print(f"{len(alive)}个分段未能在超时时间内关闭，分段索引未关闭")
+            return
+        with self.index_lock:
+            if not self.index_file.closed:
+                self.index_file.flush()
+                os.fsync(self.index_file.fileno())
+                self.index_file.close()